@@ -1,6 +1,10 @@
 import torch
 import torch.nn.functional as F
-import alt_cuda_corr
+try:
+    import alt_cuda_corr
+except ImportError:
+    # the compiled extension is optional, TorchDirectCorr computes the same correlation
+    alt_cuda_corr = None
 import torch
 import gin
 from utils.memory import report
@@ -25,7 +29,87 @@ class DirectCorr(torch.autograd.Function):
         return fmap1_grad, fmap2_grad, coords_grad
 
 
-def direct_corr(fmaps, x1, ii, jj, DD):
+def bilinear_corners(coords, H2, W2):
+    """ Flat fmap2 indices and bilinear weights of the 4 pixels around each of coords [..., 2],
+        out of bounds pixels get weight 0, like the zero padding of alt_cuda_corr """
+    x, y = coords[..., 0], coords[..., 1]
+    x0, y0 = torch.floor(x), torch.floor(y)
+    dx, dy = x - x0, y - y0
+    corners = []
+    for oy, ox, weight in [(0, 0, (1 - dy) * (1 - dx)), (0, 1, (1 - dy) * dx),
+                           (1, 0, dy * (1 - dx)), (1, 1, dy * dx)]:
+        h2, w2 = y0.long() + oy, x0.long() + ox
+        valid = (h2 >= 0) & (h2 < H2) & (w2 >= 0) & (w2 < W2)
+        index = h2.clamp(0, H2 - 1) * W2 + w2.clamp(0, W2 - 1)
+        corners.append((index, weight * valid))
+    return corners
+
+
+class TorchDirectCorr(torch.autograd.Function):
+    """ PyTorch version of DirectCorr (alt_cuda_corr with radius 0), on any device
+
+    For every pixel of fmap1 [B, H1, W1, C] and each of the N points of coords
+    [B, N, H1, W1, 2] it takes the dot product of the fmap1 feature with fmap2
+    [B, H2, W2, C] bilinearly sampled at the point, giving [B, N, 1, H1, W1].
+    Like the CUDA kernel the gradient only flows to the feature maps. Points are
+    processed in chunks whose gathered features take about memory_budget bytes.
+    """
+
+    @staticmethod
+    def chunk_size(fmap1, memory_budget):
+        # the gathered fmap1 and fmap2 features and their product per point in flight
+        return max(1, int(memory_budget // (3 * fmap1.shape[-1] * fmap1.element_size())))
+
+    @staticmethod
+    def forward(ctx, fmap1, fmap2, coords, memory_budget=2 ** 30):
+        ctx.save_for_backward(fmap1, fmap2, coords)
+        ctx.memory_budget = memory_budget
+        B, H1, W1, C = fmap1.shape
+        _, H2, W2, _ = fmap2.shape
+        N = coords.shape[1]
+        f1 = fmap1.reshape(B, H1 * W1, C)
+        f2 = fmap2.reshape(B, H2 * W2, C)
+        points = coords.reshape(B, N * H1 * W1, 2)
+        corr = torch.zeros(B, N * H1 * W1, dtype=fmap1.dtype, device=fmap1.device)
+        step = TorchDirectCorr.chunk_size(fmap1, memory_budget)
+        for b in range(B):
+            for start in range(0, N * H1 * W1, step):
+                stop = min(start + step, N * H1 * W1)
+                pixels = torch.arange(start, stop, device=fmap1.device) % (H1 * W1)
+                f1_chunk = f1[b, pixels]
+                for index, weight in bilinear_corners(points[b, start:stop], H2, W2):
+                    corr[b, start:stop] += weight * (f1_chunk * f2[b, index]).sum(dim=-1)
+        return corr.view(B, N, 1, H1, W1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        fmap1, fmap2, coords = ctx.saved_tensors
+        B, H1, W1, C = fmap1.shape
+        _, H2, W2, _ = fmap2.shape
+        N = coords.shape[1]
+        f1 = fmap1.reshape(B, H1 * W1, C)
+        f2 = fmap2.reshape(B, H2 * W2, C)
+        points = coords.reshape(B, N * H1 * W1, 2)
+        grad = grad_output.reshape(B, N * H1 * W1)
+        fmap1_grad = torch.zeros_like(f1)
+        fmap2_grad = torch.zeros_like(f2)
+        step = TorchDirectCorr.chunk_size(fmap1, ctx.memory_budget)
+        for b in range(B):
+            for start in range(0, N * H1 * W1, step):
+                stop = min(start + step, N * H1 * W1)
+                pixels = torch.arange(start, stop, device=fmap1.device) % (H1 * W1)
+                f1_chunk = f1[b, pixels]
+                for index, weight in bilinear_corners(points[b, start:stop], H2, W2):
+                    g = (grad[b, start:stop] * weight)[:, None]
+                    fmap1_grad[b].index_add_(0, pixels, g * f2[b, index])
+                    fmap2_grad[b].index_add_(0, index, g * f1_chunk)
+        # the CUDA kernel doesn't differentiate with respect to the coordinates either
+        coords_grad = torch.zeros_like(coords)
+        return fmap1_grad.view_as(fmap1), fmap2_grad.view_as(fmap2), coords_grad, None
+
+
+@gin.configurable()
+def direct_corr(fmaps, x1, ii, jj, DD, memory_budget=2 ** 30):
     fmaps = fmaps.permute(0,1,3,4,2)
     fmaps1 = fmaps[:,ii] / 8.0
     fmaps2 = fmaps[:,jj] / 8.0
@@ -37,7 +121,10 @@ def direct_corr(fmaps, x1, ii, jj, DD):
     x1 = x1.reshape(batch*num, h1, w1, -1, 2)
     x1 = x1.permute(0,3,1,2,4).contiguous()
 
-    corr = DirectCorr.apply(fmaps1, fmaps2, x1)
+    if alt_cuda_corr is not None and fmaps1.is_cuda:
+        corr = DirectCorr.apply(fmaps1, fmaps2, x1)
+    else:
+        corr = TorchDirectCorr.apply(fmaps1, fmaps2, x1, memory_budget)
     corr = corr.permute(0,2,3,4,1)
 
     return corr.reshape(batch*num*h1*w1, 1, 1, DD)
@@ -57,7 +144,7 @@ class CorrBlock:
         disps_input = disps_input.view(batch, opt_num, 1, h1, w1)
 
         if shift:
-            self.disps_origin = torch.where(disps_input < nIncre // 2 * incre, torch.tensor(nIncre // 2 * incre).cuda().float(), disps_input)
+            self.disps_origin = torch.where(disps_input < nIncre // 2 * incre, torch.tensor(nIncre // 2 * incre).to(device).float(), disps_input)
         else:
             self.disps_origin = disps_input.clone()
 
@@ -155,4 +242,4 @@ class CorrBlock:
         fmap2 = fmap2.reshape(batch*num, dim, ht*wd) / 8.0
         
         corr = torch.matmul(fmap1.transpose(1,2), fmap2)
-        return corr.view(batch, num, ht, wd, 1, ht, wd)
\ No newline at end of file
+        return corr.view(batch, num, ht, wd, 1, ht, wd)
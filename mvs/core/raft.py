@@ -1,4 +1,7 @@
+from collections import OrderedDict
+
 from fastcore.all import store_attr
+import numpy as np
 import torch
 import torch.nn as nn
 from core.extractor import BasicEncoder
@@ -9,6 +12,47 @@ import gin
 autocast = torch.cuda.amp.autocast
 
 
+class FeatureCache:
+    """ LRU cache of fnet feature maps keyed by image, shared by the windows of a sequence
+
+    Consecutive windows share most of their images, so when they are processed
+    in order each image only goes through fnet once while it stays among the
+    capacity most recently used ones.
+    """
+
+    def __init__(self, capacity=24):
+        self.capacity = capacity
+        self.fmaps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def capacity_for(offsets):
+        """ smallest capacity with which every shared image is reused, for windows at index + offsets
+
+        An image next comes back one window step (the smallest gap between the
+        window's images) later, after at most the window span plus that step
+        other images were used.
+        """
+        window = np.union1d(offsets, 0)
+        return int(np.ptp(window) + np.diff(window).min())
+
+    def get(self, key, compute):
+        if key in self.fmaps:
+            self.fmaps.move_to_end(key)
+            self.hits += 1
+            return self.fmaps[key]
+        self.misses += 1
+        fmap = compute()
+        self.fmaps[key] = fmap
+        if len(self.fmaps) > self.capacity:
+            self.fmaps.popitem(last=False)
+        return fmap
+
+    def clear(self):
+        self.fmaps.clear()
+
+
 @gin.configurable()
 class RAFT(nn.Module):
     def __init__(self,
@@ -31,7 +75,7 @@ class RAFT(nn.Module):
         self.update_block = UpdateBlock(cascade=cascade, dim_net=dim_net, dim_inp=dim_inp)
 
     @gin.configurable()
-    def forward(self, images, poses, intrinsics, scale=None, do_report=False):
+    def forward(self, images, poses, intrinsics, scale=None, do_report=False, feature_cache=None, image_keys=None):
         if scale is not None: poses[..., :3, 3] *= scale
         test_mode = self.test_mode
         intrinsics = intrinsics.clone()
@@ -65,7 +109,11 @@ class RAFT(nn.Module):
             else:
                 fmaps = []
                 for i in range(num):
-                    fmaps.append(self.fnet(images[:, [i]]))
+                    if feature_cache is None:
+                        fmaps.append(self.fnet(images[:, [i]]))
+                    else:
+                        # fnet normalizes each image on its own, so its features don't depend on the window
+                        fmaps.append(feature_cache.get(image_keys[i], lambda i=i: self.fnet(images[:, [i]])))
                 fmaps = torch.cat(fmaps, 1)
 
             if test_mode: del images
@@ -105,5 +153,5 @@ class RAFT(nn.Module):
                 stage += 1
         if test_mode:
             assert(scale is not None)
-            return disp * scale.cuda()
+            return disp * scale.to(disp.device)
         return predictions
\ No newline at end of file
@@ -7,7 +7,7 @@ import torch
 from scipy.spatial.transform import Rotation as R
 from torch.utils.data import Dataset
 
-from utils.frame_utils import read_gen
+from utils.frame_utils import read_gen_parallel
 import cv2
 import pickle
 import json
@@ -15,7 +15,7 @@ from PIL import Image
 
 @gin.configurable()
 class Waymo(Dataset):
-    def __init__(self, dataset_path, num_frames, min_dist_over_baseline=1, cam_format="TUM", subset=None, window_stride=3, **args):
+    def __init__(self, dataset_path, num_frames, min_dist_over_baseline=1, cam_format="TUM", subset=None, window_stride=3, decode_workers=4, cache_dir=None, **args):
 
         self.images_path = []
         self.poses = []
@@ -75,6 +75,8 @@ class Waymo(Dataset):
         self.image_format = rgb_path[0][-3:]
         self.offsets = np.array([-3*len(sensor_type), -2*len(sensor_type), -1*len(sensor_type), len(sensor_type), 2*len(sensor_type), 3*len(sensor_type)])
         self.window_stride = window_stride
+        self.decode_workers = decode_workers
+        self.cache_dir = cache_dir
 
 
     def __len__(self):
@@ -88,10 +90,9 @@ class Waymo(Dataset):
             indices -= self.window_stride
         assert(indices[0] >= 0)
         indices = [index] + [i for i in indices if i != index]
-        images, poses, intrinsics = [], [], []
+        images = read_gen_parallel([self.images_path[i] for i in indices], self.decode_workers, self.cache_dir)
+        poses, intrinsics = [], []
         for i in indices:
-            image = read_gen(self.images_path[i])
-            images.append(image)
             poses.append(self.poses[i])
             intrinsics.append(self.intrinsics[i])
 
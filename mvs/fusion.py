@@ -1,19 +1,21 @@
 import argparse
 import math
 import os
+import shutil
 
 import cv2
 import gin
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
-from plyfile import PlyData, PlyElement
 from tqdm import tqdm
 
 from datasets import get_test_data_loader
 from utils.bilinear_sampler import bilinear_sampler
 from utils.frame_utils import read_gen
 from utils.frame_utils import write_vis
+from utils.point_cloud import PointCloudWriter
+from utils.view_cache import ViewCache, open_views
 
 cudnn.benchmark = True
 
@@ -82,7 +84,8 @@ def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, i
     return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
 
 
-def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src, thre1=4.4, thre2=1430.):
+# reprojection errors of the reference pixels, they don't depend on the consistency thresholds
+def reprojection_errors(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
     batch, height, width = depth_ref.shape
     y_ref, x_ref = torch.meshgrid(torch.arange(0, height).to(depth_ref.device), torch.arange(0, width).to(depth_ref.device))
     x_ref = x_ref.unsqueeze(0).repeat(batch,  1, 1)
@@ -97,6 +100,28 @@ def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth
     depth_diff = torch.abs(depth_reprojected - depth_ref)
     relative_depth_diff = depth_diff / depth_ref
 
+    return dist, relative_depth_diff, depth_reprojected, x2d_src, y2d_src
+
+
+# largest scale s at which each reference pixel still passes the geometric mask of fusion(),
+# where the thresholds are thre1 * s and thre2 * s
+def consistency_scale(dist, relative_depth_diff, thre1=4., thre2=1300.):
+    # a source view agrees at level i when err * s < i
+    err = torch.maximum(dist * thre1, relative_depth_diff * thre2)
+    err = torch.nan_to_num(err, nan=float('inf'))
+    n_src = err.shape[0]
+    if n_src < 2:
+        return torch.zeros_like(err[0])
+    # at least i source views agree at level i iff the i-th smallest error does
+    err = err.sort(dim=0).values[1:]
+    levels = torch.arange(2, n_src + 1, device=err.device, dtype=err.dtype).view(-1, 1, 1)
+    return (levels / err).amax(dim=0)
+
+
+def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src, thre1=4.4, thre2=1430.):
+    inputs = [depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src]
+    dist, relative_depth_diff, depth_reprojected, x2d_src, y2d_src = reprojection_errors(*inputs)
+
     masks=[]
     for i in range(2,11):
         mask = torch.logical_and(dist < i/thre1, relative_depth_diff < i/thre2)
@@ -113,14 +138,13 @@ def fusion(
         suffix="",
         glb=0.25,
         rescale=1,
+        voxel_size=0.,
+        device=None,
+        max_cached_views=32,
     ):
-    
-    # for the final point cloud
-    vertexs = []
-    vertex_colors = []
-
-    # for each reference view and the corresponding source views
-    ct2 = -1
+    # depths and images are memory-mapped from disk, only the views being fused are kept on the device
+    device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    cache_folder = os.path.join(output_folder, "fusion_cache")
 
     all_images = None
     all_depths = None
@@ -165,8 +189,8 @@ def fusion(
         ref_intrinsics, ref_extrinsics = modify_camera_parameters(ref_intrinsics, ref_extrinsics, scale, index, flag)
 
         if i == 0:
-            all_images = np.zeros((n_images, *ref_img.shape))
-            all_depths = np.zeros((n_images, *ref_depth_est.shape))
+            all_images = open_views(os.path.join(cache_folder, "images.npy"), n_images, ref_img.shape, np.float64)
+            all_depths = open_views(os.path.join(cache_folder, "depths.npy"), n_images, ref_depth_est.shape)
             all_extrinsics = np.zeros((n_images, *ref_extrinsics.shape))
             all_intrinsics = np.zeros((n_images, *ref_intrinsics.shape))
             init_h_image = ref_img.shape[0]
@@ -193,131 +217,128 @@ def fusion(
 
 
     h, w = all_depths[0].shape
-    all_images = torch.from_numpy(np.stack(all_images)).cuda()
-    all_depths = torch.from_numpy(np.stack(all_depths)).float().cuda()
-    all_intrinsics = torch.from_numpy(np.stack(all_intrinsics)).float().cuda()
-    all_extrinsics = torch.from_numpy(np.stack(all_extrinsics)).float().cuda()
+    all_images.flush()
+    all_depths.flush()
+    all_depths = ViewCache(all_depths, device, max_cached_views)
+    all_intrinsics = torch.from_numpy(all_intrinsics).float().to(device)
+    all_extrinsics = torch.from_numpy(all_extrinsics).float().to(device)
+
+    def empty_cache():
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
 
+    def load_views(ref_view, src_views):
+        src_intrinsics, src_extrinsics = all_intrinsics[src_views], all_extrinsics[src_views]
+        src_depth_est = all_depths[src_views]
+        n_src = len(src_views)
+        assert(n_src != 0)
+        ref_depth_est = all_depths[ref_view].unsqueeze(0).repeat(n_src, 1, 1)
+        ref_intrinsics = all_intrinsics[ref_view].unsqueeze(0).repeat(n_src, 1, 1)
+        ref_extrinsics = all_extrinsics[ref_view].unsqueeze(0).repeat(n_src, 1, 1)
+        return ref_depth_est, ref_intrinsics, ref_extrinsics, src_depth_est, src_intrinsics, src_extrinsics
+
+    # the thresholds only scale the reprojection errors, so reproject every (ref, src) pair once
+    # and keep, per reference pixel, the largest scale at which it passes the geometric mask.
+    # the search only needs how many pixels pass, so the float16 scales are counted per value
+    thre1, thre2 = 4, 1300
+    scale_counts = torch.zeros(1 << 16, dtype=torch.int64, device=device)
+    for refid, srcids in tqdm(pair_data):
+        ref_view = refid_to_index[refid]
+        src_views = [refid_to_index[x] for x in srcids]
+        dist, relative_depth_diff = reprojection_errors(*load_views(ref_view, src_views))[:2]
+        scale = consistency_scale(dist, relative_depth_diff, thre1, thre2).half()
+        scale_counts += torch.bincount(scale.view(torch.int16).flatten().long() + (1 << 15), minlength=1 << 16)
+        del dist, relative_depth_diff, scale
+        empty_cache()
+    scale_values = torch.arange(-(1 << 15), 1 << 15, device=device).to(torch.int16).view(torch.float16).float()
 
     thre_left = -2
     thre_right = 2
 
     tot_iter = 10
-    for iter in range(tot_iter):
+    for iter in range(tot_iter - 1):
         thre = (thre_left + thre_right) / 2
         print(f"{iter} {10 ** thre}")
 
+        # every reference view has as many pixels, the mean over views is the mean over pixels
+        geo_mask_mean = scale_counts[scale_values > 10 ** thre].sum().item() / scale_counts.sum().item()
 
-        depth_est = torch.zeros((n_images, h, w)).cuda()
-        # thre = 1.75
-        geo_mask_all = []
-
-        for refid, srcids in pair_data:
-            ref_view = refid_to_index[refid]
-            src_views = [refid_to_index[x] for x in srcids]
-            print(f"ref view {ref_view}")
-            print(src_views)
-            ct2 += 1
-
-            # load the reference image
-            ref_img = all_images[ref_view]
-            # load the estimated depth of the reference view
-            ref_depth_est = all_depths[ref_view]
+        if geo_mask_mean >= glb:
+            thre_left = thre
+        else:
+            thre_right = thre
 
-            # load the camera parameters
-            ref_extrinsics = all_extrinsics[ref_view]
-            ref_intrinsics = all_intrinsics[ref_view]
+    # the final threshold fuses the depths at full precision
+    thre = (thre_left + thre_right) / 2
+    print(f"{tot_iter - 1} {10 ** thre}")
+    # the final point cloud is streamed to disk as views are fused
+    plyfilename = os.path.join(output_folder, 'result.ply')
+    ply_writer = PointCloudWriter(plyfilename, voxel_size)
+    for refid, srcids in pair_data:
+        ref_view = refid_to_index[refid]
+        src_views = [refid_to_index[x] for x in srcids]
+        print(f"ref view {ref_view}")
+        print(src_views)
 
-            # compute the geometric mask
+        # load the reference image
+        ref_img = all_images[ref_view]
 
+        # compute the geometric mask
+        n = 1 + len(src_views)
+        inputs = load_views(ref_view, src_views)
+        ref_depth_est, ref_intrinsics, ref_extrinsics = inputs[:3]
 
-            n = 1 + len(src_views)
+        masks, geo_mask, depth_reprojected, x2d_src, y2d_src, relative_depth_diff = check_geometric_consistency(*inputs, # parallelize it!
+                                                                                    10 ** thre * thre1, 10 ** thre * thre2)
 
-            src_intrinsics, src_extrinsics = all_intrinsics[src_views], all_extrinsics[src_views]
-            src_depth_est = all_depths[src_views]
-            n_src = len(src_views)
-            ref_depth_est = ref_depth_est.unsqueeze(0).repeat(n_src, 1, 1)
-            ref_intrinsics = ref_intrinsics.unsqueeze(0).repeat(n_src, 1, 1)
-            ref_extrinsics = ref_extrinsics.unsqueeze(0).repeat(n_src, 1, 1)
+        geo_mask_sums=[]
+        for i in range(2,n):
+            geo_mask_sums.append(masks[i-2].sum(dim=0).int()) #masks[i-2][0].int())
 
-            assert(n_src != 0)
+        geo_mask_sum = geo_mask.sum(dim=0)
 
-            masks, geo_mask, depth_reprojected, x2d_src, y2d_src, relative_depth_diff = check_geometric_consistency(ref_depth_est, ref_intrinsics, # parallelize it!
-                                                                                        ref_extrinsics,
-                                                                                        src_depth_est,
-                                                                                        src_intrinsics, src_extrinsics,
-                                                                                        10 ** thre * 4, 10 ** thre * 1300)
+        geo_mask=geo_mask_sum>=n
 
-            geo_mask_sums=[]
-            for i in range(2,n):
-                geo_mask_sums.append(masks[i-2].sum(dim=0).int()) #masks[i-2][0].int())
-            
-            geo_mask_sum = geo_mask.sum(dim=0)
+        for i in range (2, n):
+            geo_mask=torch.logical_or(geo_mask,geo_mask_sums[i-2]>=i)
+        depth_est = (depth_reprojected.sum(dim=0) + ref_depth_est[0]) / (geo_mask_sum + 1)
 
-            geo_mask=geo_mask_sum>=n
+        del masks
+        empty_cache()
 
-            for i in range (2, n):
-                geo_mask=torch.logical_or(geo_mask,geo_mask_sums[i-2]>=i)
-            depth_est[ref_view] = (depth_reprojected.sum(dim=0) + ref_depth_est[0]) / (geo_mask_sum + 1)
+        ref_intrinsics = ref_intrinsics[0]
+        ref_extrinsics = ref_extrinsics[0]
 
-            del masks
+        os.makedirs(os.path.join(output_folder, "mask"), exist_ok=True)
 
-            geo_mask_all.append(geo_mask.float().mean().item())
-            torch.cuda.empty_cache()
+        depth_est_averaged = depth_est.cpu().numpy()
+        geo_mask = geo_mask.cpu().numpy()
 
+        depth_est_averaged[~geo_mask] = 0
+        np.save(os.path.join(output_folder, "depths", f"{refid}.npy"), depth_est_averaged)
+        write_vis(os.path.join(output_folder, "depths", f"{refid}_vis.png"), depth_est_averaged)
 
-            if iter == tot_iter - 1:
-                ref_intrinsics = ref_intrinsics[0]
-                ref_extrinsics = ref_extrinsics[0]
-                
-                os.makedirs(os.path.join(output_folder, "mask"), exist_ok=True)
-
-                depth_est_averaged = depth_est[ref_view].cpu().numpy()
-                geo_mask = geo_mask.cpu().numpy()
-
-                depth_est_averaged[~geo_mask] = 0
-                np.save(os.path.join(output_folder, "depths", f"{refid}.npy"), depth_est_averaged)
-                write_vis(os.path.join(output_folder, "depths", f"{refid}_vis.png"), depth_est_averaged)
-
-                save_mask(os.path.join(output_folder, "mask", f"{ref_view}{suffix}.png"), geo_mask)
-                print(f"ref-view{ref_view}, mask:{geo_mask.mean()}")
-                valid_points = geo_mask
-            
-                ref_img = ref_img.cpu().numpy()
-
-                height, width = depth_est_averaged.shape[:2]
-                x, y = np.meshgrid(np.arange(0, width), np.arange(0, height))
-                
-                x, y, depth = x[valid_points], y[valid_points], depth_est_averaged[valid_points]
-                color = ref_img[:, :, :][valid_points]  # hardcoded for DTU dataset
-                xyz_ref = np.matmul(np.linalg.inv(ref_intrinsics.cpu().numpy()),
-                                    np.vstack((x, y, np.ones_like(x))) * depth)
-                xyz_world = np.matmul(np.linalg.inv(ref_extrinsics.cpu().numpy()),
-                                    np.vstack((xyz_ref, np.ones_like(x))))[:3]
-                vertexs.append(xyz_world.transpose((1, 0)))
-                vertex_colors.append((color * 255).astype(np.uint8))
-
-        if np.mean(geo_mask_all) >= glb:
-            thre_left = thre
-        else:
-            thre_right = thre
+        save_mask(os.path.join(output_folder, "mask", f"{ref_view}{suffix}.png"), geo_mask)
+        print(f"ref-view{ref_view}, mask:{geo_mask.mean()}")
+        valid_points = geo_mask
 
-    vertexs = np.concatenate(vertexs, axis=0)
-    vertex_colors = np.concatenate(vertex_colors, axis=0)
-    vertexs = np.array([tuple(v) for v in vertexs], dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
-    vertex_colors = np.array([tuple(v) for v in vertex_colors], dtype=[('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+        ref_img = np.asarray(ref_img)
 
-    vertex_all = np.empty(len(vertexs), vertexs.dtype.descr + vertex_colors.dtype.descr)
-    for prop in vertexs.dtype.names:
-        vertex_all[prop] = vertexs[prop]
-    for prop in vertex_colors.dtype.names:
-        vertex_all[prop] = vertex_colors[prop]
+        height, width = depth_est_averaged.shape[:2]
+        x, y = np.meshgrid(np.arange(0, width), np.arange(0, height))
 
-    el = PlyElement.describe(vertex_all, 'vertex')
+        x, y, depth = x[valid_points], y[valid_points], depth_est_averaged[valid_points]
+        color = ref_img[:, :, :][valid_points]  # hardcoded for DTU dataset
+        xyz_ref = np.matmul(np.linalg.inv(ref_intrinsics.cpu().numpy()),
+                            np.vstack((x, y, np.ones_like(x))) * depth)
+        xyz_world = np.matmul(np.linalg.inv(ref_extrinsics.cpu().numpy()),
+                            np.vstack((xyz_ref, np.ones_like(x))))[:3]
+        ply_writer.add(xyz_world.transpose((1, 0)), (color * 255).astype(np.uint8))
 
-    plyfilename = os.path.join(output_folder, 'result.ply')
-    PlyData([el]).write(plyfilename)
-    print("saving the final model to", plyfilename)
+    num_points = ply_writer.close()
+    del all_images, all_depths
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    print(f"saved the final model with {num_points} points to", plyfilename)
 
 
 
@@ -9,7 +9,7 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 
-from core.raft import RAFT
+from core.raft import RAFT, FeatureCache
 from datasets import get_test_data_loader
 from utils.data_utils import crop_operation, scale_operation
 from utils.frame_utils import write_pfm, write_vis
@@ -24,12 +24,15 @@ def inference(
         crop=None,
         do_report=False,
         write_min_depth=None,
+        feature_cache_size=None,
+        device=None,
     ):
-
-    model = RAFT(test_mode=True).cuda()
+    # without CUDA the correlation falls back to core.corr.TorchDirectCorr
+    device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    model = RAFT(test_mode=True).to(device)
 
     if ckpt is not None:
-        tmp = torch.load(ckpt)
+        tmp = torch.load(ckpt, map_location=device)
         if list(tmp.keys())[0][:7] == "module.":
             model = nn.DataParallel(model)
         model.load_state_dict(tmp, strict=True)
@@ -38,20 +41,27 @@ def inference(
     output_folder = Path(output_folder)
     (output_folder / "depths").mkdir(exist_ok=True, parents=True)
 
+    # the loader walks the sequence in order, so neighboring windows reuse the fnet features of shared images;
+    # by default the cache is sized for the dataset's window (0 disables it)
+    if feature_cache_size is None:
+        feature_cache_size = FeatureCache.capacity_for(test_loader.dataset.offsets)
+    feature_cache = FeatureCache(feature_cache_size) if feature_cache_size > 0 else None
+
     with torch.no_grad():
         for images, poses, intrinsics, image_names, scale in tqdm(test_loader):
-            poses = poses.cuda()
+            poses = poses.to(device)
             images = images.squeeze(0)
             intrinsics = intrinsics.squeeze(0)
             images, intrinsics = scale_operation(images, intrinsics, rescale)
             if not crop is None:
                 crop_h, crop_w = crop
                 images, intrinsics = crop_operation(images, intrinsics, crop_h, crop_w)
-            images = images.unsqueeze(0).cuda()
-            intrinsics = intrinsics.unsqueeze(0).cuda()
+            images = images.unsqueeze(0).to(device)
+            intrinsics = intrinsics.unsqueeze(0).to(device)
             if do_report:
                 tic = time.time()
-            disp_est = model(images, poses, intrinsics, do_report=do_report, scale=scale)
+            disp_est = model(images, poses, intrinsics, do_report=do_report, scale=scale,
+                             feature_cache=feature_cache, image_keys=[name[0] for name in image_names])
             #clip the value minus 0
             disp_est[disp_est < 0] = 1e6
             if do_report:
@@ -67,7 +77,10 @@ def inference(
             #     with open(write_min_depth / f"{image_names[0][0]}.txt", "w") as f:
             #         min_depth = np.quantile(im[im > 0], 0.1) / 2
             #         f.write(f"{min_depth}\n")
-            torch.cuda.empty_cache()
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+        if feature_cache is not None and do_report:
+            print(f"fnet features reused {feature_cache.hits} times, computed {feature_cache.misses} times")
 
 
 if __name__ == '__main__':
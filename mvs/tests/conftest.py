@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import `core` and `utils` the way the entry points do, from mvs/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
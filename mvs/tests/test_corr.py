@@ -0,0 +1,54 @@
+import pytest
+import torch
+from core import corr
+
+
+def random_inputs(B, N, H, W, C, device, dtype=torch.float64):
+    fmap1 = torch.randn(B, H, W, C, dtype=dtype, device=device)
+    fmap2 = torch.randn(B, H, W, C, dtype=dtype, device=device)
+    # points partly outside of fmap2, to exercise the zero padding
+    coords = torch.stack([torch.rand(B, N, H, W, dtype=dtype, device=device) * (W + 4) - 2,
+                          torch.rand(B, N, H, W, dtype=dtype, device=device) * (H + 4) - 2], dim=-1)
+    return fmap1, fmap2, coords
+
+
+def test_torch_direct_corr_gradcheck():
+    torch.manual_seed(0)
+    fmap1, fmap2, coords = random_inputs(1, 2, 4, 5, 4, 'cpu')
+    # a small budget, so that chunk boundaries are crossed
+    apply = lambda f1, f2: corr.TorchDirectCorr.apply(f1, f2, coords, 512)
+    assert torch.autograd.gradcheck(apply, (fmap1.requires_grad_(), fmap2.requires_grad_()))
+
+
+def test_torch_direct_corr_matches_bilinear_sampling():
+    torch.manual_seed(0)
+    fmap1, fmap2, coords = random_inputs(2, 3, 4, 5, 6, 'cpu')
+    out = corr.TorchDirectCorr.apply(fmap1, fmap2, coords, 512)
+    # grid_sample with zero padding, in pixel coordinates
+    B, N, H, W, _ = coords.shape
+    grid = coords.clone()
+    grid[..., 0] = 2 * grid[..., 0] / (W - 1) - 1
+    grid[..., 1] = 2 * grid[..., 1] / (H - 1) - 1
+    sampled = torch.nn.functional.grid_sample(
+        fmap2.permute(0, 3, 1, 2), grid.reshape(B, N * H, W, 2), align_corners=True)
+    sampled = sampled.reshape(B, -1, N, H, W).permute(0, 2, 3, 4, 1)
+    expected = (fmap1[:, None] * sampled).sum(dim=-1)
+    assert torch.allclose(out.reshape(expected.shape), expected)
+
+
+@pytest.mark.skipif(corr.alt_cuda_corr is None or not torch.cuda.is_available(),
+                    reason='needs the alt_cuda_corr extension and a GPU')
+def test_torch_direct_corr_matches_cuda_kernel():
+    torch.manual_seed(0)
+    # the kernel works on blocks of 4 x 8 pixels and 32 channels
+    inputs = random_inputs(2, 3, 12, 16, 64, 'cuda', dtype=torch.float32)
+    grad = torch.randn(2, 3, 1, 12, 16, device='cuda')
+    outputs = []
+    for corr_fn in [lambda *x: corr.DirectCorr.apply(*x),
+                    lambda *x: corr.TorchDirectCorr.apply(*x, 1 << 16)]:
+        fmap1, fmap2 = [x.clone().requires_grad_() for x in inputs[:2]]
+        out = corr_fn(fmap1, fmap2, inputs[2])
+        out.backward(grad)
+        outputs.append([out.detach(), fmap1.grad, fmap2.grad])
+    for name, cuda_out, torch_out in zip(["corr", "fmap1 grad", "fmap2 grad"], *outputs):
+        assert torch.allclose(cuda_out, torch_out, rtol=1e-4, atol=1e-4), name
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+from core.raft import RAFT, FeatureCache
+
+
+def windows(offsets, num_images):
+    # the window of each index, shifted back into the sequence like the datasets do
+    for index in range(num_images):
+        indices = offsets + index
+        while indices[0] < 0:
+            indices = indices + 1
+        while indices[-1] >= num_images:
+            indices = indices - 1
+        yield [index] + [i for i in indices.tolist() if i != index]
+
+
+def run(model, images, poses, intrinsics, offsets, feature_cache=None):
+    outputs = []
+    with torch.no_grad():
+        for window in windows(offsets, len(images)):
+            outputs.append(model(images[None, window].clone(), poses[None, window].clone(),
+                                 intrinsics[None, window], scale=torch.tensor(1.),
+                                 feature_cache=feature_cache, image_keys=window))
+    return outputs
+
+
+def test_feature_cache_matches_uncached_fnet():
+    torch.manual_seed(0)
+    model = RAFT(test_mode=True, cascade=[(8, 8, 1), (-1, 8, 1)]).eval()
+    num_images = 8
+    images = torch.rand(num_images, 3, 32, 32) * 255
+    poses = torch.eye(4).repeat(num_images, 1, 1)
+    poses[:, 0, 3] = torch.arange(num_images) * 0.1
+    intrinsics = torch.tensor([[40., 0, 16], [0, 40, 16], [0, 0, 1]]).repeat(num_images, 1, 1)
+    offsets = np.array([-4, -2, 2, 4])
+
+    num_uses = sum(len(window) for window in windows(offsets, num_images))
+    fnet_calls = []
+    model.fnet.register_forward_hook(lambda *args: fnet_calls.append(1))
+    expected = run(model, images, poses, intrinsics, offsets)
+    assert len(fnet_calls) == num_uses
+
+    fnet_calls.clear()
+    cache = FeatureCache(FeatureCache.capacity_for(offsets))
+    cached = run(model, images, poses, intrinsics, offsets, cache)
+    for out, ref in zip(cached, expected):
+        assert torch.equal(out, ref)
+    assert len(fnet_calls) == cache.misses
+    assert cache.hits + cache.misses == num_uses
+    assert cache.misses < 2 * num_images
+
+
+def test_feature_cache_capacity_for_waymo_window():
+    # each of 3 cameras three frames back and ahead, the window steps by one camera
+    offsets = np.array([-9, -6, -3, 3, 6, 9])
+    capacity = FeatureCache.capacity_for(offsets)
+    assert capacity == 21
+    for size, expected_misses in [(capacity, 60), (capacity - 1, None)]:
+        cache = FeatureCache(size)
+        for window in windows(offsets, 60):
+            for key in window:
+                cache.get(key, lambda: None)
+        if expected_misses is None:
+            assert cache.misses > 60
+        else:
+            assert cache.misses == expected_misses
@@ -1,4 +1,7 @@
 import numpy as np
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from os.path import splitext
 import re
 import cv2
@@ -137,6 +140,32 @@ def read_gen(file_name, pil=False):
     return []
 
 
+def read_gen_cached(file_name, cache_dir=None):
+    """ read_gen with an on-disk cache of decoded arrays keyed by (path, mtime) """
+    if cache_dir is None:
+        return read_gen(file_name)
+    key = f"{os.path.abspath(file_name)}:{os.path.getmtime(file_name)}"
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    data = read_gen(file_name)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, cache_path)
+    return data
+
+
+def read_gen_parallel(file_names, num_workers=4, cache_dir=None):
+    """ Decode a list of files concurrently (cv2 releases the GIL), in order """
+    if num_workers <= 1:
+        return [read_gen_cached(f, cache_dir) for f in file_names]
+    with ThreadPoolExecutor(min(num_workers, len(file_names))) as executor:
+        return list(executor.map(lambda f: read_gen_cached(f, cache_dir), file_names))
+
+
+
 def write_pfm(file: str, image, scale=1):
     with open(file, 'wb') as f:
         color = None
@@ -0,0 +1,100 @@
+import numpy as np
+
+VERTEX_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                         ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+# digits reserved for the vertex count, it is only known once every point is written
+COUNT_DIGITS = 12
+
+# bits per axis of a voxel key
+VOXEL_BITS = 21
+
+
+def vertex_array(xyz, rgb):
+    """ Packs [N, 3] positions and [N, 3] uint8 colors into a PLY vertex array """
+    vertices = np.empty(len(xyz), dtype=VERTEX_DTYPE)
+    for i, name in enumerate(['x', 'y', 'z']):
+        vertices[name] = xyz[:, i]
+    for i, name in enumerate(['red', 'green', 'blue']):
+        vertices[name] = rgb[:, i]
+    return vertices
+
+
+def voxel_keys(xyz, voxel_size):
+    """ One int64 per point identifying the voxel of size voxel_size it falls in """
+    ijk = np.floor(xyz / voxel_size).astype(np.int64) + (1 << (VOXEL_BITS - 1))
+    if ijk.size and (ijk.min() < 0 or ijk.max() >= (1 << VOXEL_BITS)):
+        raise ValueError(f'Points span more than 2^{VOXEL_BITS} voxels of size {voxel_size} per axis.')
+    return (ijk[:, 0] << (2 * VOXEL_BITS)) | (ijk[:, 1] << VOXEL_BITS) | ijk[:, 2]
+
+
+class PointCloudWriter:
+    """ Streams colored points to a binary little-endian PLY file
+
+    Points are written as they are added, in chunks of at most chunk_size, so
+    only one chunk is held in memory besides the caller's arrays. The vertex
+    count is patched into the header on close(). With voxel_size > 0 only the
+    first point added in each voxel is kept, which needs the keys of the
+    occupied voxels (8 bytes each) to be kept around.
+    """
+
+    def __init__(self, path, voxel_size=0., chunk_size=1 << 20):
+        self.path = path
+        self.voxel_size = voxel_size
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.voxels = np.zeros(0, dtype=np.int64)
+        self.file = open(path, 'wb')
+        properties = ''.join(f'property {"float" if VERTEX_DTYPE[n] == np.float32 else "uchar"} {n}\n'
+                             for n in VERTEX_DTYPE.names)
+        header = ('ply\nformat binary_little_endian 1.0\n'
+                  f'element vertex {0:0{COUNT_DIGITS}d}\n{properties}end_header\n')
+        self.count_offset = header.index('element vertex ') + len('element vertex ')
+        self.file.write(header.encode('ascii'))
+
+    def _dedup(self, xyz, rgb):
+        keys = voxel_keys(xyz, self.voxel_size)
+        # first point of each voxel within the chunk, then drop voxels already written
+        keys, first = np.unique(keys, return_index=True)
+        new = ~np.isin(keys, self.voxels, assume_unique=True)
+        keys, first = keys[new], np.sort(first[new])
+        self.voxels = np.union1d(self.voxels, keys)
+        return xyz[first], rgb[first]
+
+    def add(self, xyz, rgb):
+        """ Appends [N, 3] positions and [N, 3] colors in [0, 255] """
+        xyz = np.asarray(xyz).reshape(-1, 3)
+        rgb = np.asarray(rgb).reshape(-1, 3)
+        if len(xyz) != len(rgb):
+            raise ValueError(f'Got {len(xyz)} positions but {len(rgb)} colors.')
+        for start in range(0, len(xyz), self.chunk_size):
+            chunk_xyz = xyz[start:start + self.chunk_size]
+            chunk_rgb = rgb[start:start + self.chunk_size]
+            if self.voxel_size > 0:
+                chunk_xyz, chunk_rgb = self._dedup(chunk_xyz, chunk_rgb)
+            self.file.write(vertex_array(chunk_xyz, chunk_rgb).tobytes())
+            self.count += len(chunk_xyz)
+
+    def close(self):
+        """ Writes the vertex count to the header and closes the file, returns the count """
+        if self.file.closed:
+            return self.count
+        if self.count >= 10 ** COUNT_DIGITS:
+            raise ValueError(f'Too many points for a PLY header: {self.count}.')
+        self.file.seek(self.count_offset)
+        self.file.write(f'{self.count:0{COUNT_DIGITS}d}'.encode('ascii'))
+        self.file.close()
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_point_cloud(path, xyz, rgb, voxel_size=0.):
+    """ Writes colored points to a binary PLY file, returns the number of points written """
+    with PointCloudWriter(path, voxel_size) as writer:
+        writer.add(xyz, rgb)
+    return writer.count
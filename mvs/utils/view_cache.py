@@ -0,0 +1,43 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def open_views(path, n_views, shape, dtype=np.float32):
+    """ A [n_views, *shape] array memory-mapped from path, created zeroed """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_views, *shape))
+
+
+class ViewCache:
+    """ LRU working set of the views of a memory-mapped array, as tensors on a device
+
+    Only the views that were requested last stay on the device, at most
+    capacity of them, the others are read back from disk when needed again.
+    """
+
+    def __init__(self, views, device, capacity=32):
+        self.views = views
+        self.device = device
+        self.capacity = capacity
+        self.cache = OrderedDict()
+
+    def get(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        view = torch.from_numpy(np.array(self.views[index])).to(self.device)
+        self.cache[index] = view
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return view
+
+    def __getitem__(self, indices):
+        if isinstance(indices, (list, tuple)):
+            return torch.stack([self.get(i) for i in indices])
+        return self.get(indices)
+
+    def clear(self):
+        self.cache.clear()
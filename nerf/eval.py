@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import sys
@@ -7,7 +8,9 @@ from absl import app
 import gin
 from internal import configs
 from internal import datasets
+from internal import frame_queue
 from internal import image
+from internal import image_writer
 from internal import models
 from internal import raw_utils
 from internal import ref_utils
@@ -98,11 +101,11 @@ def main(unused_argv):
     if config.eval_raw_affine_cc:
         cc_fun = raw_utils.match_images_affine
     else:
-        cc_fun = image.color_correct
+        cc_fun = functools.partial(image.color_correct, num_samples=config.eval_cc_num_samples)
 
     model = accelerator.prepare(model)
 
-    metric_harness = image.MetricHarness()
+    metric_harness = image.MetricHarness(accelerator.device)
 
     last_step = 0
     out_dir = os.path.join(config.exp_path,
@@ -112,6 +115,7 @@ def main(unused_argv):
     if not config.eval_only_once:
         summary_writer = tensorboardX.SummaryWriter(
             os.path.join(config.exp_path, 'eval'))
+    writer = image_writer.ImageWriter(config)
     while True:
         step = checkpoints.restore_checkpoint(config.checkpoint_dir, accelerator, logger)
         if step <= last_step:
@@ -129,7 +133,16 @@ def main(unused_argv):
         metrics_cc = []
         showcases = []
         render_times = []
-        for idx, (batch, eval_camidx) in enumerate(dataloader):
+        metric_frames = []
+        render_frames = []
+        if config.render_frame_parallel:
+            # Every process renders whole frames taken from a shared queue.
+            queue = frame_queue.FrameQueue(os.path.join(config.exp_path, '.eval_frame_queue'),
+                                           num_eval, accelerator)
+            frames = ((idx, dataset[idx]) for idx in queue)
+        else:
+            frames = enumerate(dataloader)
+        for idx, (batch, eval_camidx) in frames:
             batch = accelerate.utils.send_to_device(batch, accelerator.device)
             eval_camidx = accelerate.utils.send_to_device(eval_camidx, accelerator.device)
             eval_start_time = time.time()
@@ -138,12 +151,16 @@ def main(unused_argv):
                 continue
             logger.info(f'Evaluating image {idx + 1}/{dataset.size}')
             rendering = models.render_image(model, accelerator,
-                                            batch, False, 1, config, eval_camidx=((eval_camidx//3)*21+eval_camidx%3))
+                                            batch, False, 1, config, eval_camidx=((eval_camidx//3)*21+eval_camidx%3),
+                                            compute_normals=config.compute_normal_metrics or config.render_normals,
+                                            local=config.render_frame_parallel)
 
-            if not accelerator.is_main_process:  # Only record via host 0.
+            # Only record via host 0, unless every host renders its own frames.
+            if not (accelerator.is_main_process or config.render_frame_parallel):
                 continue
 
             render_times.append((time.time() - eval_start_time))
+            render_frames.append(idx)
             logger.info(f'Rendered in {render_times[-1]:0.3f}s')
 
             cc_start_time = time.time()
@@ -175,8 +192,7 @@ def main(unused_argv):
                     rgb_gt = crop_fn(rgb_gt)
 
                 residual = np.sum(np.abs(rgb_gt - rgb), axis=-1)
-                metric = metric_harness(rgb, rgb_gt)
-                metric_cc = metric_harness(rgb_cc, rgb_gt)
+                metric, metric_cc = metric_harness.evaluate([rgb, rgb_cc], [rgb_gt, rgb_gt])
 
                 if config.compute_disp_metrics:
                     for tag in ['mean', 'median']:
@@ -201,26 +217,35 @@ def main(unused_argv):
 
                 metrics.append(metric)
                 metrics_cc.append(metric_cc)
+                metric_frames.append(idx)
 
             if config.eval_save_output and (config.eval_render_interval > 0):
                 if (idx % config.eval_render_interval) == 0:
-                    utils.save_img_u8(postprocess_fn(rendering['rgb']),
-                                      path_fn(f'color_{idx:03d}.png'))
-                    utils.save_img_u8(postprocess_fn(rendering['rgb_cc']),
-                                      path_fn(f'color_cc_{idx:03d}.png'))
-                    utils.save_img_u8(postprocess_fn(batch['rgb'][:,:,:3]),
-                                      path_fn(f'color_gt{idx:03d}.png'))
+                    writer.save_img_u8(postprocess_fn(rendering['rgb']),
+                                       path_fn(f'color_{idx:03d}.png'))
+                    writer.save_img_u8(postprocess_fn(rendering['rgb_cc']),
+                                       path_fn(f'color_cc_{idx:03d}.png'))
+                    writer.save_img_u8(postprocess_fn(batch['rgb'][:,:,:3]),
+                                       path_fn(f'color_gt{idx:03d}.png'))
                     for key in ['distance_mean', 'distance_median']:
                         if key in rendering:
-                            utils.save_img_f32(rendering[key],
-                                               path_fn(f'{key}_{idx:03d}.tiff'))
+                            writer.save_img_f32(rendering[key],
+                                                path_fn(f'{key}_{idx:03d}.tiff'))
 
                     for key in ['normals']:
                         if key in rendering:
-                            utils.save_img_u8(rendering[key] / 2. + 0.5,
-                                              path_fn(f'{key}_{idx:03d}.png'))
+                            writer.save_img_u8(rendering[key] / 2. + 0.5,
+                                               path_fn(f'{key}_{idx:03d}.png'))
+
+                    writer.save_img_f32(rendering['acc'], path_fn(f'acc_{idx:03d}.tiff'))
+
+        # The outputs of this checkpoint have to be complete before moving on.
+        writer.flush()
 
-                    utils.save_img_f32(rendering['acc'], path_fn(f'acc_{idx:03d}.tiff'))
+        if config.render_frame_parallel:
+            # Collect the per-frame results of every process, in frame order.
+            _, render_times = frame_queue.gather_by_frame(render_frames, render_times)
+            _, metrics, metrics_cc = frame_queue.gather_by_frame(metric_frames, metrics, metrics_cc)
 
         if (not config.eval_only_once) and accelerator.is_main_process:
             summary_writer.add_scalar('eval_median_render_time', np.median(render_times),
@@ -304,6 +329,7 @@ def main(unused_argv):
         if int(step) >= num_steps:
             break
         last_step = step
+    writer.close()
     logger.info('Finish evaluation.')
 
 
@@ -6,6 +6,7 @@ import cv2
 import numpy as np
 from absl import app
 import gin
+from internal import chunking
 from internal import configs
 from internal import datasets
 from internal import models
@@ -38,10 +39,8 @@ def evaluate_density(model, accelerator: accelerate.Accelerator,
     Returns:
         A torch tensor with the SDF values evaluated at the given points.
     """
-    z = []
-    for _, pnts in enumerate(tqdm(torch.split(points, config.render_chunk_size, dim=0),
-                                  desc="Evaluating density", leave=False,
-                                  disable=not accelerator.is_main_process)):
+    def evaluate_chunk(idx0, idx1):
+        pnts = points[idx0:idx1]
         rays_remaining = pnts.shape[0] % accelerator.num_processes
         if rays_remaining != 0:
             padding = accelerator.num_processes - rays_remaining
@@ -55,10 +54,17 @@ def evaluate_density(model, accelerator: accelerate.Accelerator,
         chunk_stds = torch.full_like(chunk_means[..., 0], std_value)
         raw_density = model.nerf_mlp.predict_density(chunk_means[:, None], chunk_stds[:, None], no_warp=True)[0]
         density = F.softplus(raw_density + model.nerf_mlp.density_bias)
+        return density, padding
+
+    def gather_chunk(chunk):
+        density, padding = chunk
         density = accelerator.gather(density)
         if padding > 0:
             density = density[: -padding]
-        z.append(density)
+        return density
+
+    tuner = chunking.get_tuner('evaluate_density', config, accelerator)
+    z = tuner.map(evaluate_chunk, points.shape[0], gather_fn=gather_chunk, desc="Evaluating density")
     z = torch.cat(z, dim=0)
     return z
 
@@ -77,10 +83,8 @@ def evaluate_color(model, accelerator: accelerate.Accelerator,
     Returns:
         A torch tensor with the SDF values evaluated at the given points.
     """
-    z = []
-    for _, pnts in enumerate(tqdm(torch.split(points, config.render_chunk_size, dim=0),
-                                  desc="Evaluating color",
-                                  disable=not accelerator.is_main_process)):
+    def evaluate_chunk(idx0, idx1):
+        pnts = points[idx0:idx1]
         rays_remaining = pnts.shape[0] % accelerator.num_processes
         if rays_remaining != 0:
             padding = accelerator.num_processes - rays_remaining
@@ -96,10 +100,17 @@ def evaluate_color(model, accelerator: accelerate.Accelerator,
         ray_results = model.nerf_mlp(False, chunk_means[:, None, None], chunk_stds[:, None, None],
                                      chunk_viewdirs)
         rgb = ray_results['rgb'][:, 0]
+        return rgb, padding
+
+    def gather_chunk(chunk):
+        rgb, padding = chunk
         rgb = accelerator.gather(rgb)
         if padding > 0:
             rgb = rgb[: -padding]
-        z.append(rgb)
+        return rgb
+
+    tuner = chunking.get_tuner('evaluate_color', config, accelerator)
+    z = tuner.map(evaluate_chunk, points.shape[0], gather_fn=gather_chunk, desc="Evaluating color")
     z = torch.cat(z, dim=0)
     return z
 
@@ -109,14 +120,11 @@ def evaluate_color_projection(model, accelerator: accelerate.Accelerator, vertic
     normals = auto_normals(vertices, faces.long())
     viewdirs = -normals
     origins = vertices - 0.005 * viewdirs
-    vc = []
-    chunk = config.render_chunk_size
     model.num_levels = 1
     model.opaque_background = True
-    for i in tqdm(range(0, origins.shape[0], chunk),
-                  desc="Evaluating color projection",
-                  disable=not accelerator.is_main_process):
-        cur_chunk = min(chunk, origins.shape[0] - i)
+
+    def evaluate_chunk(i, i_end):
+        cur_chunk = i_end - i
         rays_remaining = cur_chunk % accelerator.num_processes
         rays_per_host = cur_chunk // accelerator.num_processes
         if rays_remaining != 0:
@@ -124,8 +132,8 @@ def evaluate_color_projection(model, accelerator: accelerate.Accelerator, vertic
             rays_per_host += 1
         else:
             padding = 0
-        start = i + accelerator.process_index * rays_per_host
-        stop = start + rays_per_host
+        start = min(i + accelerator.process_index * rays_per_host, i_end)
+        stop = min(start + rays_per_host, i_end)
 
         batch = {
             'origins': origins[start:stop],
@@ -136,7 +144,10 @@ def evaluate_color_projection(model, accelerator: accelerate.Accelerator, vertic
             'near': torch.full_like(origins[start:stop, ..., :1], 0),
             'far': torch.full_like(origins[start:stop, ..., :1], 0.01),
         }
-        batch = accelerator.pad_across_processes(batch)
+        # Pad locally to the same number of rays in every process, the chunk
+        # must not communicate before it is known to fit in memory.
+        batch = tree_map(lambda v: torch.cat([v, v.new_zeros((rays_per_host - v.shape[0],) + v.shape[1:])]),
+                         batch)
         with accelerator.autocast():
             renderings, ray_history = model(
                 False,
@@ -148,12 +159,18 @@ def evaluate_color_projection(model, accelerator: accelerate.Accelerator, vertic
 
         rgb /= acc.clamp_min(1e-5)[..., None]
         rgb = rgb.clamp(0, 1)
+        return rgb, padding
 
+    def gather_chunk(chunk):
+        rgb, padding = chunk
         rgb = accelerator.gather(rgb)
         rgb[torch.isnan(rgb) | torch.isinf(rgb)] = 1
         if padding > 0:
             rgb = rgb[: -padding]
-        vc.append(rgb)
+        return rgb
+
+    tuner = chunking.get_tuner('evaluate_color_projection', config, accelerator)
+    vc = tuner.map(evaluate_chunk, origins.shape[0], gather_fn=gather_chunk, desc="Evaluating color projection")
     vc = torch.cat(vc, dim=0)
     return vc
 
@@ -4,6 +4,7 @@ from internal import stepfun
 from internal import utils
 import numpy as np
 import scipy
+import torch
 
 
 def convert_to_ndc(origins,
@@ -557,6 +558,81 @@ def pixels_to_rays(pix_x_int, pix_y_int, pixtocams,
     return origins, directions, viewdirs, radii, imageplane
 
 
+def pixels_to_rays_torch(pix_x_int, pix_y_int, pixtocams, camtoworlds,
+                         distortion_params=None,
+                         pixtocam_ndc=None,
+                         camtype=ProjectionType.PERSPECTIVE):
+    """Torch port of pixels_to_rays(), for casting rays on the training device.
+
+  Follows pixels_to_rays() step by step so that, given float64 cameras, the
+  results match the numpy path. Lens distortion and NDC are not supported.
+
+  Args:
+    pix_x_int: int tensor, shape SH, x coordinates of image pixels.
+    pix_y_int: int tensor, shape SH, y coordinates of image pixels.
+    pixtocams: float tensor, broadcastable to SH + [3, 3], inverse intrinsics.
+    camtoworlds: float tensor, broadcastable to SH + [3, 4], camera extrinsics.
+    distortion_params: must be None, raises a ValueError otherwise.
+    pixtocam_ndc: must be None, raises a ValueError otherwise.
+    camtype: camera_utils.ProjectionType, fisheye or perspective camera.
+
+  Returns:
+    origins, directions, viewdirs, radii, imageplane as in pixels_to_rays().
+  """
+    if distortion_params is not None:
+        raise ValueError('pixels_to_rays_torch does not support lens distortion')
+    if pixtocam_ndc is not None:
+        raise ValueError('pixels_to_rays_torch does not support NDC rays')
+    dtype = pixtocams.dtype
+
+    def pix_to_dir(x, y):
+        x = x.to(dtype)
+        y = y.to(dtype)
+        return torch.stack([x + .5, y + .5, torch.ones_like(x)], dim=-1)
+
+    pixel_dirs_stacked = torch.stack([
+        pix_to_dir(pix_x_int, pix_y_int),
+        pix_to_dir(pix_x_int + 1, pix_y_int),
+        pix_to_dir(pix_x_int, pix_y_int + 1)
+    ], dim=0)
+
+    mat_vec_mul = lambda A, b: torch.matmul(A, b[..., None])[..., 0]
+
+    camera_dirs_stacked = mat_vec_mul(pixtocams, pixel_dirs_stacked)
+
+    if camtype == 'panoroma':
+        camera_dirs_stacked = torch.stack([torch.sin(camera_dirs_stacked[:, :, :, 0]),
+                                           camera_dirs_stacked[:, :, :, 1],
+                                           torch.cos(camera_dirs_stacked[:, :, :, 0])], dim=-1)
+
+    if camtype == ProjectionType.FISHEYE:
+        theta = torch.sqrt(torch.sum(torch.square(camera_dirs_stacked[..., :2]), dim=-1))
+        theta = torch.clamp_max(theta, np.pi)
+
+        sin_theta_over_theta = torch.sin(theta) / theta
+        camera_dirs_stacked = torch.stack([
+            camera_dirs_stacked[..., 0] * sin_theta_over_theta,
+            camera_dirs_stacked[..., 1] * sin_theta_over_theta,
+            torch.cos(theta),
+        ], dim=-1)
+
+    # Flip from OpenCV to OpenGL coordinate system.
+    camera_dirs_stacked = camera_dirs_stacked * camera_dirs_stacked.new_tensor([1., -1., -1.])
+
+    imageplane = camera_dirs_stacked[0, ..., :2]
+
+    directions, dx, dy = mat_vec_mul(camtoworlds[..., :3, :3], camera_dirs_stacked)
+
+    origins = torch.broadcast_to(camtoworlds[..., :3, -1], directions.shape)
+    viewdirs = directions / torch.linalg.norm(directions, dim=-1, keepdim=True)
+
+    dx_norm = torch.linalg.norm(dx - directions, dim=-1)
+    dy_norm = torch.linalg.norm(dy - directions, dim=-1)
+
+    radii = (0.5 * (dx_norm + dy_norm))[..., None] * 2 / np.sqrt(12)
+    return origins, directions, viewdirs, radii, imageplane
+
+
 def cast_ray_batch(cameras, pixels, camtype):
     """Maps from input cameras and Pixel batch to output Ray batch.
 
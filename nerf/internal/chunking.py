@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import gin
+from internal import utils
+import torch
+from tqdm import tqdm
+
+_tuners = {}
+
+
+def _is_oom(e):
+    return isinstance(e, MemoryError) or 'out of memory' in str(e).lower()
+
+
+def _total_cpu_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _cpu_rss():
+    """Current resident set size of this process, in bytes."""
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _cpu_peak_rss():
+    """Peak resident set size of this process since the last reset, in bytes."""
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return _cpu_rss()
+
+
+def _reset_cpu_peak_rss():
+    """Resets the peak RSS to the current RSS, returns False if the kernel refuses."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class ChunkTuner:
+    """Sizes the chunks rays or points are processed in from a memory budget.
+
+  The first chunks are used as probes: the peak memory they use is measured
+  and the chunk size is scaled so that the next chunk fills
+  `render_memory_budget` of the device memory (or of the RAM, on CPU). Once the
+  size settles it is stored in `render_chunk_cache`, keyed by the chunk kind,
+  the gin config and the device, and later runs start from it directly. A
+  chunk running out of memory is retried at half the size, in every process,
+  and the smaller size is kept as an upper bound.
+
+  On CPU the probes measure the resident set size from /proc (Linux only), the
+  peak of each chunk when the kernel lets it be reset, its RSS once done
+  otherwise. Running out of RAM usually gets the process killed by the OOM
+  killer rather than raising MemoryError, so there is no retry to fall back to:
+  keep `render_memory_budget` well below 1 on CPU, it is a fraction of the
+  physical memory and doesn't account for other processes.
+  """
+
+    def __init__(self, name, config, accelerator, local=False):
+        self.accelerator = accelerator
+        # Local tuners split work only within this process.
+        self.num_processes = 1 if local else accelerator.num_processes
+        self.device = accelerator.device
+        self.cuda = self.device.type == 'cuda'
+        self.budget = config.render_memory_budget
+        self.cache_path = config.render_chunk_cache
+        if self.cuda:
+            props = torch.cuda.get_device_properties(self.device)
+            device_name, self.total_memory = props.name, props.total_memory
+        else:
+            device_name, self.total_memory = 'cpu', _total_cpu_memory()
+        config_hash = hashlib.sha1(gin.config_str().encode()).hexdigest()[:16]
+        self.key = f'{name}:{config_hash}:{device_name}:{self.total_memory}'
+        self.chunk_size = config.render_chunk_size
+        self.max_chunk_size = None
+        self._previous_size = None
+        self.tuned = self.budget <= 0 or not (self.cuda or os.path.exists('/proc/self/statm'))
+        self._peak_reset = False
+        cached = self._load().get(self.key)
+        if cached is not None:
+            self.chunk_size, self.max_chunk_size = cached['chunk_size'], cached['max_chunk_size']
+            self.tuned = True
+        # Every process has to split the work the same way.
+        self.chunk_size = self._agree(self.chunk_size)
+        self.tuned = bool(self._agree(int(self.tuned)))
+
+    def _load(self):
+        if self.cache_path is None or not utils.file_exists(self.cache_path):
+            return {}
+        with utils.open_file(self.cache_path, 'r') as fp:
+            return json.load(fp)
+
+    def _save(self):
+        if self.cache_path is None or not self.accelerator.is_main_process:
+            return
+        cache = self._load()
+        cache[self.key] = {'chunk_size': self.chunk_size, 'max_chunk_size': self.max_chunk_size}
+        utils.makedirs(os.path.dirname(os.path.abspath(self.cache_path)))
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with utils.open_file(tmp_path, 'w') as fp:
+            json.dump(cache, fp, indent=2)
+        os.replace(tmp_path, self.cache_path)
+
+    def _round(self, size):
+        # Keep chunks splittable evenly across processes.
+        step = 256 * self.num_processes
+        size = max(step, int(size) // step * step)
+        if self.max_chunk_size is not None:
+            size = min(size, self.max_chunk_size)
+        return size
+
+    def _memory_used(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device)
+        # Without a reset the peak is the lifetime one, which says nothing about
+        # this chunk.
+        return _cpu_peak_rss() if self._peak_reset else _cpu_rss()
+
+    def _start_probe(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return torch.cuda.memory_allocated(self.device)
+        self._peak_reset = _reset_cpu_peak_rss()
+        return _cpu_rss()
+
+    def _end_probe(self, baseline, num_items):
+        used = self._memory_used()
+        per_item = (used - baseline) / num_items
+        budget = self.budget * self.total_memory - baseline
+        size = self.chunk_size
+        if per_item > 0 and budget > 0:
+            # Grow or shrink by at most 2x per probe, the estimate is rough.
+            size = self._round(min(max(budget / per_item, size / 2), size * 2))
+        size = self._agree(size)
+        # Estimates close to a multiple of the rounding step can alternate
+        # between the two sizes around it, settle on the smaller one.
+        if abs(size - self.chunk_size) <= 0.1 * self.chunk_size or size == self._previous_size:
+            size = min(size, self.chunk_size)
+            self.chunk_size = size
+            self.tuned = True
+            self._save()
+        self._previous_size = self.chunk_size
+        self.chunk_size = size
+
+    def _agree(self, size):
+        """The smallest of the values of `size` in all processes."""
+        if self.num_processes == 1:
+            return size
+        return int(self.accelerator.gather(torch.tensor([size], device=self.device)).min())
+
+    def _all(self, ok):
+        if self.num_processes == 1:
+            return ok
+        flags = self.accelerator.gather(torch.tensor([ok], device=self.device))
+        return bool(flags.all())
+
+    def map(self, fn, num_items, gather_fn=None, desc=None, verbose=True):
+        """Applies `fn` to consecutive chunks of `num_items` items.
+
+    Args:
+      fn: function, fn(start, stop) processes items [start, stop) and returns
+        their result. It must not communicate with other processes, since a
+        chunk running out of memory in one process is retried in all of them.
+      num_items: int, the number of items.
+      gather_fn: function, optional, applied to each result of `fn` once every
+        process completed the chunk, eg. to gather it across processes.
+      desc: str, description of the progress bar.
+      verbose: bool, if False don't show a progress bar.
+
+    Returns:
+      The list of the results of each chunk, in order.
+    """
+        outputs = []
+        start = 0
+        pbar = tqdm(total=num_items, desc=desc, leave=False,
+                    disable=not (self.accelerator.is_main_process and verbose))
+        while start < num_items:
+            stop = min(start + self.chunk_size, num_items)
+            baseline = None if self.tuned else self._start_probe()
+            try:
+                output = fn(start, stop)
+                ok = True
+            except (RuntimeError, MemoryError) as e:
+                if not _is_oom(e):
+                    raise
+                output, ok = None, False
+            if not self._all(ok):
+                output = None
+                if self.cuda:
+                    torch.cuda.empty_cache()
+                if self.chunk_size <= self._round(1):
+                    raise MemoryError(f'Out of memory with the smallest chunk size {self.chunk_size}.')
+                self.max_chunk_size = self._round(self.chunk_size // 2)
+                self.chunk_size = self.max_chunk_size
+                self._save()
+                continue
+            if baseline is not None and stop - start == self.chunk_size:
+                self._end_probe(baseline, stop - start)
+            outputs.append(output if gather_fn is None else gather_fn(output))
+            pbar.update(stop - start)
+            start = stop
+        pbar.close()
+        return outputs
+
+
+def get_tuner(name, config, accelerator, local=False):
+    """The ChunkTuner of chunk kind `name`, shared by every call in a process."""
+    key = (name, local)
+    if key not in _tuners:
+        _tuners[key] = ChunkTuner(name, config, accelerator, local=local)
+    return _tuners[key]
@@ -52,12 +52,23 @@ class Config:
     data_dir: Optional[str] = "data/carla_pic_0603_Town01"  # Input data directory.
     vocab_tree_path: Optional[str] = None  # Path to vocab tree for COLMAP.
     render_chunk_size: int = 15000  # Chunk size for whole-image renderings.
+    render_memory_budget: float = 0.  # Memory fraction chunks are sized to fill, 0 keeps render_chunk_size.
+    render_chunk_cache: Optional[str] = None  # JSON file caching tuned chunk sizes.
     num_showcase_images: int = 5  # The number of test-set images to showcase.
     deterministic_showcase: bool = True  # If True, showcase the same images.
     vis_num_rays: int = 16  # The number of rays to visualize.
     # Decimate images for tensorboard (ie, x[::d, ::d]) to conserve memory usage.
     vis_decimate: int = 0
     training_views: int = 210
+    train_frames: int = 150  # Number of frames of the sequence used for training.
+    stream_window: int = 0  # Training images resident at once, 0 loads them all.
+    stream_overlap: int = 0  # Images shared by consecutive stream windows.
+    stream_replay: int = 0  # Old images kept resident as a replay buffer.
+    stream_steps_per_window: int = 1000  # Training steps spent on each window.
+    image_store: bool = False  # Pack resized frames into a shared uint8 memmap.
+    image_store_dir: Optional[str] = None  # Where to put the store, default data_dir.
+    image_decode_workers: int = 8  # Threads used to decode and resize frames.
+    image_cache_dir: Optional[str] = None  # On-disk cache of decoded, resized frames.
 
     # Only used by train.py:
     max_steps: int = 25000  # The number of optimization steps.
@@ -67,6 +78,17 @@ class Config:
     checkpoints_total_limit: int = 1
     gradient_scaling: bool = False  # If True, scale gradients as in https://gradient-scaling.github.io/.
     virtual_poses: bool = False
+    virtual_table_size: int = 16384  # Max valid pixels kept per virtual pose pair, 0 keeps all (unbounded disk use).
+    device_rays: bool = False  # Workers emit pixel coordinates, rays are cast on device.
+    batch_ring: bool = False  # Feed training from an endless shared-memory batch ring.
+    batch_ring_slots: int = 16  # Number of preallocated batches in the ring.
+    batch_ring_workers: int = 8  # Producer processes filling the batch ring.
+    prefetch_batches: int = 0  # Batches kept transferred to the device ahead of use.
+    error_sampling: bool = False  # Sample training pixels by a running error map.
+    error_map_cell: int = 16  # Size in pixels of an error map cell.
+    error_map_decay: float = 0.9  # Decay of the error map moving average.
+    error_sampling_floor: float = 0.2  # Fraction of patches sampled uniformly.
+    error_map_update_every: int = 16  # Training steps between error map blends.
     print_every: int = 100  # The number of steps between reports to tensorboard.
     train_render_every: int = 500  # Steps between test set renders when training
     data_loss_type: str = 'charb'  # What kind of loss to use ('mse' or 'charb').
@@ -110,10 +132,13 @@ class Config:
     eval_dataset_limit: int = np.iinfo(np.int32).max  # Num test images to eval.
     eval_quantize_metrics: bool = True  # If True, run metrics on 8-bit images.
     eval_crop_borders: int = 0  # Ignore c border pixels in eval (x[c:-c, c:-c]).
+    eval_cc_num_samples: int = 0  # Pixels color correction is fit on, 0 for all.
 
     # Only used by render.py
     render_video_fps: int = 60  # Framerate in frames-per-second.
     render_video_crf: int = 18  # Constant rate factor for ffmpeg video quality.
+    render_stream_video: bool = False  # Encode videos while rendering, not from saved frames.
+    render_save_frames: bool = True  # Save every rendered frame to disk.
     render_path_frames: int = 120  # Number of frames in render path.
     z_variation: float = 0.  # How much height variation in render path.
     z_phase: float = 0.  # Phase offset for height variation in render path.
@@ -125,7 +150,9 @@ class Config:
     render_focal: Optional[float] = None  # Render focal length.
     render_camtype: Optional[str] = None  # 'perspective', 'fisheye', or 'pano'.
     render_spherical: bool = False  # Render spherical 360 panoramas.
-    render_save_async: bool = True  # Save to CNS using a separate thread.
+    render_save_async: bool = True  # Save rendered images on background threads.
+    render_normals: bool = False  # Render normals, needs density gradients.
+    render_frame_parallel: bool = False  # Processes render whole frames from a shared queue.
 
     render_spline_keyframes: Optional[str] = None  # Text file containing names of
     # images to be used as spline
@@ -1,11 +1,16 @@
 import abc
+import concurrent.futures
 import copy
+import hashlib
 import json
+import logging
 import os
-import cv2
+import shutil
+import tempfile
 from internal import camera_utils
 from internal import configs
 # from internal import image as lib_image
+from internal import image_store
 from internal import raw_utils
 from internal import utils
 from internal import train_utils
@@ -114,6 +119,206 @@ def load_blender_posedata(data_dir, split=None):
     return names, poses, pixtocam, params, camtype
 
 
+class StaleFrameError(Exception):
+    """A FrameWindow read raced with advance() and may hold the wrong image."""
+
+
+class FrameWindow:
+    """Sliding window of resident training images for long sequences.
+
+  Only `window + replay` images are kept, as uint8, in a shared-memory buffer
+  that DataLoader workers read from and the trainer refills through advance().
+  The window moves along the sequence by `window - overlap` images every
+  `steps_per_window` training steps. Images leaving it are offered to a replay
+  buffer (reservoir sampled, so it stays a uniform sample of the past) that
+  keeps them trainable.
+
+  The images entering the next window are decoded on a background thread while
+  training on the current one, so advance() mostly just copies them in. Reads
+  are checked against a version counter that advance() bumps around every
+  change (a seqlock), a read that raced with it raises StaleFrameError and has
+  to be drawn again from resident_frames().
+
+  Indexing with [image_idx, y, x] uses sequence-wide image indices, like a full
+  [N, height, width, 3] image array would. Other per-frame arrays (depths, sky
+  masks) can be paged through the same slots with add_layer().
+  """
+
+    def __init__(self, image_paths, width, height, window, overlap, replay,
+                 steps_per_window, num_workers=8, cache_dir=None):
+        if not 0 <= overlap < window:
+            raise ValueError(f'stream_overlap {overlap} must be in [0, {window})')
+        self.image_paths = image_paths
+        self.width = width
+        self.height = height
+        self.window = min(window, len(image_paths))
+        self.stride = window - overlap
+        self.replay = replay
+        self.steps_per_window = steps_per_window
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.shape = (len(image_paths), height, width, 3)
+        self.dtype = np.uint8
+
+        num_slots = self.window + replay
+        self._buffer = torch.zeros((num_slots, height, width, 3), dtype=torch.uint8).share_memory_()
+        self._frame_slot = torch.full((len(image_paths),), -1, dtype=torch.int64).share_memory_()
+        self._slot_frame = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+        # Odd while advance() is remapping slots.
+        self._version = torch.zeros((1,), dtype=torch.int64).share_memory_()
+        self._start = None
+        self._num_seen = 0
+        self._executor = None
+        self._prefetch = None
+        # name -> (per-frame source, shared buffer with one row per slot).
+        self._layers = {}
+        self.advance(0)
+
+    def __getstate__(self):
+        # Only the trainer advances the window, workers get no prefetch thread.
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_prefetch'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._read(self._buffer, key)
+
+    def _read(self, buffer, key):
+        frame, *rest = key if isinstance(key, tuple) else (key,)
+        version = self._version.numpy()
+        before = version[0]
+        slot = self._frame_slot.numpy()[frame]
+        pixels = np.array(buffer.numpy()[(slot,) + tuple(rest)])
+        if before % 2 or version[0] != before or np.any(slot < 0):
+            raise StaleFrameError(f'Frames moved out of the window while reading {frame}')
+        return pixels
+
+    def resident_frames(self):
+        return np.flatnonzero(self._frame_slot.numpy() >= 0)
+
+    def add_layer(self, name, source):
+        """Pages a per-frame array through the window's slots.
+
+    Args:
+      name: str, name of the layer.
+      source: anything indexable by frame that returns that frame's array, e.g.
+        an [N, height, width, ...] memmap. It is only read by advance().
+
+    Returns:
+      A FrameLayer, indexed like the window itself.
+    """
+        first = np.array(source[0])
+        buffer = torch.zeros((len(self._slot_frame),) + first.shape,
+                             dtype=torch.from_numpy(first).dtype).share_memory_()
+        for slot, frame in enumerate(self._slot_frame.tolist()):
+            if frame >= 0:
+                buffer[slot] = torch.from_numpy(np.array(source[frame]))
+        self._layers[name] = (source, buffer)
+        return FrameLayer(self, buffer, len(source))
+
+    def _window_start(self, step):
+        return min((step // self.steps_per_window) * self.stride,
+                   len(self.image_paths) - self.window)
+
+    def _decode(self, frames):
+        paths = [self.image_paths[f] for f in frames]
+        decoded = image_store.decode_images(paths, self.width, self.height,
+                                            self.num_workers, self.cache_dir)
+        return {frame: np.clip(np.round(image[..., :3]), 0, 255).astype(np.uint8)
+                for frame, (image, _) in zip(frames, decoded)}
+
+    def _decode_window(self, start):
+        """Decoded images of the window at `start` that are not in a window slot yet."""
+        in_window = set(self._slot_frame.numpy()[:self.window].tolist())
+        missing = [f for f in range(start, start + self.window) if f not in in_window]
+        images = {}
+        if self._prefetch is not None and self._prefetch[0] == start:
+            images = self._prefetch[1].result()
+        self._prefetch = None
+        images.update(self._decode([f for f in missing if f not in images]))
+        return {f: images[f] for f in missing}
+
+    def _start_prefetch(self, start):
+        if start == self._start or (self._prefetch is not None and self._prefetch[0] == start):
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        resident = set(range(self._start, self._start + self.window))
+        frames = [f for f in range(start, start + self.window) if f not in resident]
+        self._prefetch = (start, self._executor.submit(self._decode, frames))
+
+    def _assign(self, frame, slot):
+        old = self._slot_frame[slot].item()
+        if old >= 0 and self._frame_slot[old].item() == slot:
+            self._frame_slot[old] = -1
+        self._slot_frame[slot] = frame
+        self._frame_slot[frame] = slot
+
+    def advance(self, step):
+        """Pages images in and out for the window of training step `step`.
+
+    Starts decoding the images of the next window once the current one is in
+    place, so they are ready by the time the window moves.
+    """
+        start = self._window_start(step)
+        if start != self._start:
+            images = self._decode_window(start)
+            layer_rows = {name: {f: torch.from_numpy(np.array(source[f])) for f in images}
+                          for name, (source, _) in self._layers.items()}
+            window = set(range(start, start + self.window))
+            slot_frame = self._slot_frame.numpy()
+            leaving = [(f, s) for s, f in enumerate(slot_frame[:self.window])
+                       if f >= 0 and f not in window]
+            free = [s for s in range(self.window)
+                    if slot_frame[s] < 0 or slot_frame[s] not in window]
+            self._version += 1
+            # Leaving images that win a replay slot are copied there from their
+            # window slot before it is refilled.
+            for frame, old_slot in leaving:
+                self._num_seen += 1
+                if self.replay == 0:
+                    continue
+                if self._num_seen <= self.replay:
+                    replay_slot = self.window + self._num_seen - 1
+                else:
+                    replay_slot = np.random.randint(0, self._num_seen)
+                    if replay_slot >= self.replay:
+                        continue
+                    replay_slot += self.window
+                self._buffer[replay_slot] = self._buffer[old_slot]
+                for _, buffer in self._layers.values():
+                    buffer[replay_slot] = buffer[old_slot]
+                self._assign(frame, replay_slot)
+            for slot, frame in zip(free, sorted(images)):
+                self._buffer[slot] = torch.from_numpy(images[frame])
+                for name, (_, buffer) in self._layers.items():
+                    buffer[slot] = layer_rows[name][frame]
+                self._assign(frame, slot)
+            self._version += 1
+            self._start = start
+        self._start_prefetch(self._window_start(step + self.steps_per_window))
+
+
+class FrameLayer:
+    """A per-frame array paged through the slots of a FrameWindow."""
+
+    def __init__(self, frames, buffer, num_frames):
+        self._frames = frames
+        self._buffer = buffer
+        self.shape = (num_frames,) + tuple(buffer.shape[1:])
+        self.dtype = buffer.numpy().dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._frames._read(self._buffer, key)
+
+
 class Dataset(torch.utils.data.Dataset):
     """Dataset Base Class.
 
@@ -191,6 +396,8 @@ class Dataset(torch.utils.data.Dataset):
         self._num_border_pixels_to_mask = config.num_border_pixels_to_mask
         self._apply_bayer_mask = config.apply_bayer_mask
         self._render_spherical = False
+        self._device_rays = config.device_rays and split == 'train'
+        self._device_cameras = {}
 
         self.config = config
         self.global_rank = config.global_rank
@@ -248,10 +455,30 @@ class Dataset(torch.utils.data.Dataset):
         else:
             self._n_examples = self.camtoworlds.shape[0]
 
+        if config.error_sampling and self.mode == 'train':
+            # Shared with DataLoader workers, which sample from it, while the
+            # trainer updates it through update_error_map().
+            cell = config.error_map_cell
+            self._error_map = torch.ones(self._n_examples,
+                                         -(-self.height // cell),
+                                         -(-self.width // cell)).share_memory_()
+            # Residual sums and counts per cell since the last blend, on the
+            # training device, see update_error_map().
+            self._error_sums = None
+            self._error_counts = None
+            self._error_steps = 0
+
         self.cameras = (self.pixtocams,
                         self.camtoworlds,
                         self.distortion_params,
                         self.pixtocam_ndc)
+        if self._device_rays and (self.distortion_params is not None or self.pixtocam_ndc is not None):
+            raise ValueError('device_rays does not support lens distortion or NDC rays')
+
+        if self.config.virtual_poses and self.mode == 'train':
+            self._load_virtual_tables()
+        if isinstance(self.images, FrameWindow):
+            self._page_frame_arrays()
 
         # Seed the queue with one batch to avoid race condition.
         if self.mode == 'train' and not config.compute_visibility:
@@ -288,6 +515,74 @@ class Dataset(torch.utils.data.Dataset):
       focal: float, focal length to use for ideal pinhole rendering.
     """
 
+    def _load_images(self, image_paths):
+        """Loads RGB images resized to (self.width, self.height).
+
+    With config.stream_window only a FrameWindow of the images is resident.
+    With config.image_store the frames come from a uint8 memmap that is packed
+    on first use, otherwise they are decoded into a float array in [0, 1].
+    Either way frames are decoded by config.image_decode_workers threads and go
+    through the on-disk cache in config.image_cache_dir, if set.
+
+    Args:
+      image_paths: list of str, image files to load, in order.
+
+    Returns:
+      images: [N, height, width, 3] array of RGB images.
+      shapes: [N, 2] int array, (height, width) of each image on disk.
+    """
+        if self.config.stream_window > 0 and self.mode == 'train':
+            # Only image headers are read here, pixels are paged in by FrameWindow.
+            shapes = [Image.open(image_path).size[::-1] for image_path in image_paths]
+            images = FrameWindow(image_paths, self.width, self.height,
+                                 self.config.stream_window, self.config.stream_overlap,
+                                 self.config.stream_replay, self.config.stream_steps_per_window,
+                                 self.config.image_decode_workers, self.config.image_cache_dir)
+            return images, np.array(shapes)
+        if self.config.image_store:
+            store_dir = self.config.image_store_dir or self.data_dir
+            store_path = os.path.join(
+                store_dir, 'image_store',
+                f'{self.mode}_cam{self.config.cam_type}_{self.width}x{self.height}')
+            return image_store.open_images(store_path, image_paths, self.width, self.height,
+                                           self.config.image_decode_workers,
+                                           self.config.image_cache_dir)
+        images = []
+        shapes = []
+        for image, shape in image_store.decode_images(image_paths, self.width, self.height,
+                                                      self.config.image_decode_workers,
+                                                      self.config.image_cache_dir):
+            images.append(image / 255.)
+            shapes.append(shape)
+        return np.array(images), np.array(shapes)
+
+    def _page_frame_arrays(self):
+        """Pages the per-frame depths and sky masks through the images' FrameWindow.
+
+    They are moved to an unlinked file in config.image_cache_dir (or the temp
+    dir), so only the rows in the window and replay slots stay in memory.
+    """
+        cache_dir = self.config.image_cache_dir
+        if cache_dir:
+            utils.makedirs(cache_dir)
+        for name in ('disp_images', 'sky_segments'):
+            array = getattr(self, name, None)
+            if not isinstance(array, np.ndarray) or array.ndim < 2 or len(array) != len(self.images):
+                continue
+            if not isinstance(array, np.memmap):
+                spilled = np.memmap(tempfile.TemporaryFile(dir=cache_dir),
+                                    dtype=array.dtype, mode='w+', shape=array.shape)
+                spilled[:] = array
+                array = spilled
+            setattr(self, name, self.images.add_layer(name, array))
+
+    def _get_rgb(self, cam_idx, pix_y_int, pix_x_int):
+        """Gathers RGB values, normalizing uint8 images only at the sampled pixels."""
+        rgb = self.images[cam_idx, pix_y_int, pix_x_int]
+        if rgb.dtype == np.uint8:
+            rgb = rgb.astype(np.float32) / 255.
+        return rgb
+
     def _make_ray_batch(self,
                         pix_x_int,
                         pix_y_int,
@@ -346,11 +641,14 @@ class Dataset(torch.utils.data.Dataset):
         if not self.config.virtual_poses or self.split == utils.DataSplit.TEST:
             pixels = dict(pix_x_int=pix_x_int, pix_y_int=pix_y_int, **ray_kwargs)
 
-            # Slow path, do ray computation using numpy (on CPU).
-            batch = camera_utils.cast_ray_batch(self.cameras, pixels, self.camtype)
-            batch['cam_dirs'] = -self.camtoworlds[ray_kwargs['cam_idx'][..., 0]][..., :3, 2]
+            if self._device_rays:
+                batch = self._make_pixel_batch(pixels)
+            else:
+                # Slow path, do ray computation using numpy (on CPU).
+                batch = camera_utils.cast_ray_batch(self.cameras, pixels, self.camtype)
+                batch['cam_dirs'] = -self.camtoworlds[ray_kwargs['cam_idx'][..., 0]][..., :3, 2]
             if not self.render_path:
-                batch['rgb'] = self.images[cam_idx, pix_y_int, pix_x_int]
+                batch['rgb'] = self._get_rgb(cam_idx, pix_y_int, pix_x_int)
             if self._load_disps:
                 batch['disps'] = self.disp_images[cam_idx, pix_y_int, pix_x_int]
             if self._load_normals:
@@ -362,11 +660,14 @@ class Dataset(torch.utils.data.Dataset):
         else:
             pixels_with_src = dict(pix_x_int=pixel_x_int_with_src, pix_y_int=pixel_y_int_with_src, **ray_kwargs)
 
-            # Slow path, do ray computation using numpy (on CPU).
-            batch = camera_utils.cast_ray_batch(self.cameras, pixels_with_src, self.camtype)
-            batch['cam_dirs'] = -self.camtoworlds[ray_kwargs['cam_idx'][..., 0]][..., :3, 2]
+            if self._device_rays:
+                batch = self._make_pixel_batch(pixels_with_src)
+            else:
+                # Slow path, do ray computation using numpy (on CPU).
+                batch = camera_utils.cast_ray_batch(self.cameras, pixels_with_src, self.camtype)
+                batch['cam_dirs'] = -self.camtoworlds[ray_kwargs['cam_idx'][..., 0]][..., :3, 2]
             if not self.render_path:
-                batch['rgb'] = self.images[cam_idx_with_ref, pixel_y_int_with_ref, pixel_x_int_with_ref]
+                batch['rgb'] = self._get_rgb(cam_idx_with_ref, pixel_y_int_with_ref, pixel_x_int_with_ref)
             if self._load_disps:
                 batch['disps'] = self.disp_images[cam_idx_with_ref, pixel_y_int_with_ref, pixel_x_int_with_ref]
             if self._load_normals:
@@ -378,10 +679,151 @@ class Dataset(torch.utils.data.Dataset):
             batch['cam_idx'] =  broadcast_scalar(cam_idx_with_ref)[..., 0]     
 
         
-        return {k: torch.from_numpy(v.copy()).float() if v is not None else None for k, v in batch.items()}
+        return {k: torch.from_numpy(v.copy()).float() if isinstance(v, np.ndarray) else v
+                for k, v in batch.items()}
+
+    def _make_pixel_batch(self, pixels):
+        """Keeps only what is needed to cast rays later, see cast_device_rays()."""
+        pix_x_int, pix_y_int, cam_idx = np.broadcast_arrays(
+            pixels['pix_x_int'], pixels['pix_y_int'], pixels['cam_idx'][..., 0])
+        batch = {
+            'pix_x_int': torch.from_numpy(pix_x_int.astype(np.int32)),
+            'pix_y_int': torch.from_numpy(pix_y_int.astype(np.int32)),
+            'ray_cam_idx': torch.from_numpy(cam_idx.astype(np.int32)),
+        }
+        if self._apply_bayer_mask:
+            batch['lossmult'] = pixels['lossmult']
+        return batch
+
+    def cast_device_rays(self, batch):
+        """Casts the rays of a config.device_rays training batch on its device.
+
+    Workers only emit integer pixel coordinates and camera indices. This fills
+    in the ray fields that _make_ray_batch() computes with numpy otherwise,
+    using float64 camera tables cached once per device so that the results
+    match the numpy path.
+
+    Args:
+      batch: dict of tensors produced by _make_ray_batch() with device rays.
+
+    Returns:
+      The batch, updated in place with origins, directions, viewdirs, radii,
+      imageplane, cam_dirs, lossmult, near, far and cam_idx.
+    """
+        pix_x_int = batch.pop('pix_x_int')
+        pix_y_int = batch.pop('pix_y_int')
+        ray_cam_idx = batch.pop('ray_cam_idx').long()
+        device = pix_x_int.device
+        if device not in self._device_cameras:
+            self._device_cameras[device] = tuple(
+                torch.from_numpy(np.asarray(x, dtype=np.float64)).to(device)
+                for x in (self.pixtocams, self.camtoworlds))
+        pixtocams, camtoworlds = self._device_cameras[device]
+        camtoworlds = camtoworlds[ray_cam_idx]
+        rays = camera_utils.pixels_to_rays_torch(
+            pix_x_int, pix_y_int, pixtocams[ray_cam_idx], camtoworlds,
+            self.distortion_params, self.pixtocam_ndc, self.camtype)
+        for k, v in zip(['origins', 'directions', 'viewdirs', 'radii', 'imageplane'], rays):
+            batch[k] = v.float()
+        batch['cam_dirs'] = -camtoworlds[..., :3, 2].float()
+        ones = torch.ones_like(batch['radii'])
+        if batch.get('lossmult') is None:
+            batch['lossmult'] = ones
+        batch['near'] = ones * self.near
+        batch['far'] = ones * self.far
+        if 'cam_idx' not in batch:
+            batch['cam_idx'] = ray_cam_idx[..., None].float()
+        return batch
+
+    def _virtual_pairs(self):
+        """All (virtual source, reference) candidates that _next_train() may draw."""
+        virtual_case = 9
+        interval = [-2*self.cam_num, -1*self.cam_num, 0, self.cam_num, 2*self.cam_num]
+        pairs = []
+        for src in range(self.n_examples*virtual_case):
+            src_true = src // virtual_case
+            for offset in interval:
+                ref = src_true + offset
+                if not (ref >= 0 and ref < self._n_examples):
+                    ref = src_true
+                pairs.append((src, ref))
+        return np.array(pairs)
+
+    def _load_virtual_tables(self):
+        """Loads (building if needed) the valid-pixel tables for virtual poses.
+
+    For every candidate (virtual source, reference) pair this stores the output
+    of train_utils.img_warping_table() next to the dataset, so _next_train()
+    only has to gather from it. The tables of all pairs are concatenated in one
+    memory-mapped int32 [num_rows, 2] array, pair i owning rows offsets[i] to
+    offsets[i + 1]. Each pair keeps a fixed uniform subset of at most
+    config.virtual_table_size valid pixels, which bounds the disk space (8 bytes
+    per row) but restricts the pixels a pair can ever be sampled at. With 0
+    every valid pixel is stored, which for long full resolution sequences can
+    take hundreds of GB. An upper bound of the size is logged before building,
+    with a warning if it exceeds the free disk space. Tables are keyed by a hash of the poses, intrinsics,
+    depths and table size, and rebuilt when they change. Building is not
+    coordinated between processes, train.py loads the dataset on the main
+    process first so that the others find the tables on disk.
+    """
+        pairs = self._virtual_pairs()
+        max_size = self.config.virtual_table_size
+        key = hashlib.sha1()
+        for x in (pairs, self.camtoworlds, self.virtual_poses, self.pixtocams,
+                  self.disp_images, np.array([max_size])):
+            key.update(np.ascontiguousarray(x).tobytes())
+        prefix = os.path.join(self.data_dir, 'virtual_tables', key.hexdigest())
+        tables_path, offsets_path = prefix + '_tables.bin', prefix + '_offsets.npy'
+        counts_path = prefix + '_counts.npy'
+        if not utils.file_exists(counts_path):
+            utils.makedirs(os.path.dirname(prefix))
+            num_built = int(np.sum(pairs[:, 1] >= 3 * self.cam_num))
+            rows = self.width * self.height if max_size <= 0 else min(max_size, self.width * self.height)
+            max_bytes = num_built * rows * 2 * np.dtype(np.int32).itemsize
+            free_bytes = shutil.disk_usage(os.path.dirname(prefix)).free
+            log = logging.warning if max_bytes > free_bytes else logging.info
+            log(f'Building virtual pose tables for {num_built} pairs, up to {max_bytes / 2**30:.1f} GiB '
+                f'in {os.path.dirname(prefix)} ({free_bytes / 2**30:.1f} GiB free)')
+            offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+            counts = np.zeros(len(pairs), dtype=np.int64)
+            tmp_path = f'{tables_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as fp:
+                for i, (src, ref) in enumerate(tqdm(pairs, desc='Building virtual pose tables')):
+                    offsets[i + 1] = offsets[i]
+                    if ref < 3 * self.cam_num:
+                        continue
+                    ref_pose_opencv = self.camtoworlds[ref].squeeze() @ np.diag([1., -1., -1., 1.])
+                    src_pose_opencv = self.virtual_poses[src].squeeze() @ np.diag([1., -1., -1., 1.])
+                    virtual_intrinsic = np.linalg.inv(self.pixtocams[ref].squeeze())
+                    table, counts[i] = train_utils.img_warping_table(
+                        ref_pose_opencv, src_pose_opencv, self.disp_images[ref].squeeze(),
+                        virtual_intrinsic, max_size)
+                    fp.write(table.tobytes())
+                    offsets[i + 1] += len(table)
+            os.replace(tmp_path, tables_path)
+            # The counts are written last, they mark the tables as complete.
+            for path, x in ((offsets_path, offsets), (counts_path, counts)):
+                np.save(f'{path}.{os.getpid()}.tmp.npy', x)
+                os.replace(f'{path}.{os.getpid()}.tmp.npy', path)
+        self._virtual_pair_idx = pairs
+        self._virtual_offsets = np.load(offsets_path)
+        if self._virtual_offsets[-1] > 0:
+            self._virtual_tables = np.memmap(tables_path, dtype=np.int32, mode='r').reshape(-1, 2)
+        else:
+            self._virtual_tables = np.zeros((0, 2), dtype=np.int32)
+        self._virtual_counts = np.load(counts_path)
 
     def _next_train(self, item):
         """Sample next training batch (random rays)."""
+        while True:
+            try:
+                return self._sample_train()
+            except StaleFrameError:
+                # The FrameWindow moved while sampling, draw again from the new one.
+                pass
+
+    def _sample_train(self):
+        """Draws one training batch, raises StaleFrameError if the window moved."""
         # We assume all images in the dataset are the same resolution, so we can use
         # the same width/height for sampling all pixels coordinates in the batch.
         # Batch/patch sampling parameters.
@@ -397,61 +839,47 @@ class Dataset(torch.utils.data.Dataset):
         # Random pixel patch y-coordinates.
         pix_y_int = np.random.randint(lower_border, self.height - upper_border,
                                       (num_patches, 1, 1))
+        # Random camera indices.
+        if self._batching == utils.BatchingMethod.ALL_IMAGES:
+            cam_idx = np.random.randint(0, self._n_examples, (num_patches, 1, 1))
+        else:
+            cam_idx = np.random.randint(0, self._n_examples, (1,))
+        if isinstance(self.images, FrameWindow):
+            resident = self.images.resident_frames()
+            cam_idx = resident[np.random.randint(0, len(resident), cam_idx.shape)]
+        if self.config.error_sampling:
+            self._sample_by_error(pix_x_int, pix_y_int, cam_idx, lower_border, upper_border)
+            error_cell = self._error_cell(pix_x_int, pix_y_int, cam_idx)
         # Add patch coordinate offsets.
         # Shape will broadcast to (num_patches, _patch_size, _patch_size).
         patch_dx_int, patch_dy_int = camera_utils.pixel_coordinates(
             self._patch_size, self._patch_size)
         pix_x_int = pix_x_int + patch_dx_int
         pix_y_int = pix_y_int + patch_dy_int
-        # Random camera indices.
-        if self._batching == utils.BatchingMethod.ALL_IMAGES:
-            cam_idx = np.random.randint(0, self._n_examples, (num_patches, 1, 1))
-        else:
-            cam_idx = np.random.randint(0, self._n_examples, (1,))
 
         if self.config.virtual_poses:
-            virtual_case = 9
-            while True:
-                cam_idx_virtual_poses_src = np.random.randint(0, self.n_examples*virtual_case)
-                cam_idx_virtual_poses_src_true = cam_idx_virtual_poses_src // virtual_case
-                interval = [-2*self.cam_num, -1*self.cam_num, 0, self.cam_num, 2*self.cam_num]
-                random_interval = np.random.randint(0, len(interval))
-                if (cam_idx_virtual_poses_src_true + interval[random_interval] >= 0) and (cam_idx_virtual_poses_src_true + interval[random_interval] < self._n_examples):
-                    cam_idx_virtual_poses_ref = cam_idx_virtual_poses_src_true + interval[random_interval]
-                else:
-                    cam_idx_virtual_poses_ref = cam_idx_virtual_poses_src_true
-                
-                if cam_idx_virtual_poses_ref >= 3 * self.cam_num:
-                    virtual_pose_ref_depth = self.disp_images[cam_idx_virtual_poses_ref].squeeze()
-                    ref_pose = self.camtoworlds[cam_idx_virtual_poses_ref].squeeze().copy()
-                    src_pose = self.virtual_poses[cam_idx_virtual_poses_src].squeeze().copy()
-
-                    ref_pose_opencv = ref_pose @ np.diag([1., -1., -1., 1.])
-                    src_pose_opencv = src_pose @ np.diag([1., -1., -1., 1.])
-                    virtual_intrinsic = np.linalg.inv(self.pixtocams[cam_idx_virtual_poses_ref].squeeze())
-                    pts_in_src, mask = train_utils.img_warping(ref_pose_opencv, src_pose_opencv, virtual_pose_ref_depth, virtual_intrinsic)
-                    if mask.sum() >= num_patches_for_virtual:
-                        break
-            
+            # Draw uniformly among the pairs with enough valid pixels (what the
+            # rejection loop over img_warping() did), then gather from its table.
+            accepted = np.flatnonzero(self._virtual_counts >= num_patches_for_virtual)
+            if len(accepted) == 0:
+                raise ValueError(f'No virtual pose pair has {num_patches_for_virtual} valid pixels')
+            pair = accepted[np.random.randint(0, len(accepted))]
+            cam_idx_virtual_poses_src, cam_idx_virtual_poses_ref = self._virtual_pair_idx[pair]
             cam_idx_virtual_poses_src += self._n_examples
 
-            ht, wd = virtual_pose_ref_depth.shape
-            y, x = torch.meshgrid(torch.arange(ht).float(), torch.arange(wd).float())
-            pixel_coords = torch.concat([x[:, :, None], y[:, :, None]], axis=-1)
-            valid_pixel_coords_all = pixel_coords[mask.to(torch.bool)]
-            random_valid_pixel_indexes = np.random.randint(0, valid_pixel_coords_all.shape[0], (num_patches_for_virtual, ))
-            valid_pixel_coords = valid_pixel_coords_all[random_valid_pixel_indexes]
-            ref_valid_pixel_x = valid_pixel_coords[:, 0]
-            ref_valid_pixel_y = valid_pixel_coords[:, 1]
-            src_valid_pixel_x = torch.round(pts_in_src[ref_valid_pixel_y.long(), ref_valid_pixel_x.long(), 0]).numpy()[:, None, None].astype(np.int32)
-            src_valid_pixel_y = torch.round(pts_in_src[ref_valid_pixel_y.long(), ref_valid_pixel_x.long(), 1]).numpy()[:, None, None].astype(np.int32)
+            table_start, table_stop = self._virtual_offsets[pair], self._virtual_offsets[pair + 1]
+            random_valid_pixel_indexes = np.random.randint(table_start, table_stop, (num_patches_for_virtual, ))
+            valid_pixels = self._virtual_tables[np.sort(random_valid_pixel_indexes)]
+            ref_valid_pixel_y, ref_valid_pixel_x = np.divmod(valid_pixels[:, 0], self.width)
+            src_valid_pixel_y, src_valid_pixel_x = np.divmod(valid_pixels[:, 1], self.width)
+            ref_valid_pixel_x = ref_valid_pixel_x[:, None, None]
+            ref_valid_pixel_y = ref_valid_pixel_y[:, None, None]
+            src_valid_pixel_x = src_valid_pixel_x[:, None, None]
+            src_valid_pixel_y = src_valid_pixel_y[:, None, None]
 
             cam_idx_virtual_poses_src = np.array([cam_idx_virtual_poses_src]).repeat(num_patches_for_virtual)[:, None, None]
             cam_idx_virtual_poses_ref = np.array([cam_idx_virtual_poses_ref]).repeat(num_patches_for_virtual)[:, None, None]
 
-            ref_valid_pixel_x = ref_valid_pixel_x.numpy()[:, None, None].astype(np.int32)
-            ref_valid_pixel_y = ref_valid_pixel_y.numpy()[:, None, None].astype(np.int32)
-
             cam_idx_with_src = np.concatenate((cam_idx, cam_idx_virtual_poses_src), axis=0)
             cam_idx_with_ref = np.concatenate((cam_idx, cam_idx_virtual_poses_ref), axis=0)
             pixel_x_int_with_src = np.concatenate((pix_x_int, src_valid_pixel_x), axis=0)
@@ -466,13 +894,98 @@ class Dataset(torch.utils.data.Dataset):
             lossmult = None
 
         if self.config.virtual_poses:
-            return self._make_ray_batch(pix_x_int, pix_y_int, cam_idx, 
-                                        lossmult=lossmult, cam_idx_with_src=cam_idx_with_src, cam_idx_with_ref=cam_idx_with_ref,
-                                        pixel_x_int_with_src=pixel_x_int_with_src, pixel_y_int_with_src=pixel_y_int_with_src,
-                                        pixel_x_int_with_ref=pixel_x_int_with_ref, pixel_y_int_with_ref=pixel_y_int_with_ref)
+            batch = self._make_ray_batch(pix_x_int, pix_y_int, cam_idx, 
+                                         lossmult=lossmult, cam_idx_with_src=cam_idx_with_src, cam_idx_with_ref=cam_idx_with_ref,
+                                         pixel_x_int_with_src=pixel_x_int_with_src, pixel_y_int_with_src=pixel_y_int_with_src,
+                                         pixel_x_int_with_ref=pixel_x_int_with_ref, pixel_y_int_with_ref=pixel_y_int_with_ref)
+        else:
+            batch = self._make_ray_batch(pix_x_int, pix_y_int, cam_idx,
+                                         lossmult=lossmult)
+        if self.config.error_sampling:
+            error_cell = np.broadcast_to(error_cell, pix_x_int.shape)
+            if self.config.virtual_poses:
+                # Virtual rays are not tracked by the error map.
+                error_cell = np.concatenate(
+                    (error_cell, np.full((num_patches_for_virtual, 1, 1), -1)), axis=0)
+            batch['error_cell'] = torch.from_numpy(error_cell.astype(np.int64))
+        return batch
+
+    def advance_stream(self, step):
+        """Moves the resident image window along the sequence, if streaming."""
+        if isinstance(self.images, FrameWindow):
+            self.images.advance(step)
+
+    def _error_cell(self, pix_x_int, pix_y_int, cam_idx):
+        """Linear index of the error map cell holding each pixel."""
+        _, cells_y, cells_x = self._error_map.shape
+        cell = self.config.error_map_cell
+        return (cam_idx * cells_y + pix_y_int // cell) * cells_x + pix_x_int // cell
+
+    def _sample_by_error(self, pix_x_int, pix_y_int, cam_idx, lower_border, upper_border):
+        """Resamples patch corners in place, proportionally to the error map.
+
+    A config.error_sampling_floor fraction of the patches keeps its uniform
+    sample, the others are moved to a random pixel of an error map cell drawn
+    proportionally to its error.
+    """
+        if self._batching != utils.BatchingMethod.ALL_IMAGES:
+            raise ValueError('error_sampling requires all_images batching')
+        resample = np.random.rand(*pix_x_int.shape) >= self.config.error_sampling_floor
+        num = int(resample.sum())
+        _, cells_y, cells_x = self._error_map.shape
+        cell = self.config.error_map_cell
+        error_map = self._error_map.numpy()
+        frames = (self.images.resident_frames() if isinstance(self.images, FrameWindow)
+                  else np.arange(len(error_map)))
+        cdf = np.cumsum(error_map[frames].reshape(-1), dtype=np.float64)
+        cells = np.searchsorted(cdf, np.random.rand(num) * cdf[-1], side='right')
+        cells = np.minimum(cells, len(cdf) - 1)
+        cam, cy, cx = np.unravel_index(cells, (len(frames),) + error_map.shape[1:])
+        cam = frames[cam]
+        cam_idx[resample] = cam
+        pix_x_int[resample] = np.clip(cx * cell + np.random.randint(0, cell, num),
+                                      lower_border, self.width - upper_border - 1)
+        pix_y_int[resample] = np.clip(cy * cell + np.random.randint(0, cell, num),
+                                      lower_border, self.height - upper_border - 1)
+
+    def update_error_map(self, batch, rgb):
+        """Accumulates the per-ray residuals of a training step into the error map.
+
+    Residuals are summed per cell on the device of `rgb`, without
+    synchronizing with it. Every config.error_map_update_every calls, the mean
+    residual of each cell touched since the previous blend is blended into the
+    shared error map, which only copies the touched cells to the host. Rays
+    with error_cell -1 (virtual rays) are ignored.
 
-        return self._make_ray_batch(pix_x_int, pix_y_int, cam_idx,
-                                    lossmult=lossmult)
+    Args:
+      batch: dict, the training batch, holding 'error_cell' and 'rgb'.
+      rgb: tensor, rendered colors for the batch.
+    """
+        resid_sq = ((rgb.detach() - batch['rgb'][..., :3]) ** 2).mean(dim=-1).reshape(-1).float()
+        device = resid_sq.device
+        num_cells = self._error_map.numel()
+        if self._error_sums is None or self._error_sums.device != device:
+            # The last entry collects the rays the map doesn't track.
+            self._error_sums = torch.zeros(num_cells + 1, device=device)
+            self._error_counts = torch.zeros(num_cells + 1, device=device)
+        cells = batch['error_cell'].reshape(-1).to(device)
+        cells = torch.where(cells >= 0, cells, torch.full_like(cells, num_cells))
+        self._error_sums.index_add_(0, cells, resid_sq)
+        self._error_counts.index_add_(0, cells, torch.ones_like(resid_sq))
+        self._error_steps += 1
+        if self._error_steps % self.config.error_map_update_every == 0:
+            self._blend_error_map()
+
+    def _blend_error_map(self):
+        counts = self._error_counts[:-1]
+        cells = torch.nonzero(counts)[:, 0]
+        cell_means = (self._error_sums[cells] / counts[cells]).cpu()
+        cells = cells.cpu()
+        self._error_sums.zero_()
+        self._error_counts.zero_()
+        error_map = self._error_map.view(-1)
+        decay = self.config.error_map_decay
+        error_map[cells] = decay * error_map[cells] + (1 - decay) * cell_means
 
     def generate_ray_batch(self, cam_idx: int):
         """Generate ray batch for a specified camera in the dataset."""
@@ -508,7 +1021,7 @@ class WaymoV2(Dataset):
         else:
             factor = 1
 
-        images = []
+        rgb_paths = []
         depths = []
         poses = []
         sky_segments = []
@@ -564,7 +1077,7 @@ class WaymoV2(Dataset):
         virtual_poses = []
         virtual_intrinsics = []
         if self.mode == 'train':
-            video_lens = 150
+            video_lens = self.config.train_frames
         else:
             video_lens = 30
         for idx in range(video_lens):
@@ -578,14 +1091,7 @@ class WaymoV2(Dataset):
                 pose_cam2world = poses_per_camera[cam_idx][0][idx]
                 intrinsic = intrinsics_per_camera[cam_idx][0][idx]
 
-                image = np.array(Image.open(rgb_path), dtype=np.float32)
-                ori_image_shape = image.shape
-                image = cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_AREA)
-                image = image / 255.
-                images.append(image)
-
-                intrinsic[0, :] *= self.width / ori_image_shape[1]
-                intrinsic[1, :] *= self.height / ori_image_shape[0]
+                rgb_paths.append(rgb_path)
                 intrinsics.append(intrinsic)
 
                 if config.refine_name == "":
@@ -606,7 +1112,6 @@ class WaymoV2(Dataset):
                     pose_cam2world = np.linalg.inv(pose_world2cam)
                     poses.append(pose_cam2world)
         poses = np.array(poses)
-        images = np.array(images)
         intrinsics = np.array(intrinsics)
   
 
@@ -624,19 +1129,23 @@ class WaymoV2(Dataset):
             virtual_poses[:, :3, 3] -= center[None]
             virtual_poses[:, :3, 3] = virtual_poses[:, :3, 3] * scale
 
-        all_indices = np.arange(len(images))
+        all_indices = np.arange(len(rgb_paths))
         train_indices = all_indices % (8 * len(sensor_type)) >= len(sensor_type)
         split_indices = {
             utils.DataSplit.TEST: all_indices[all_indices % (8 * len(sensor_type)) < len(sensor_type)],
             utils.DataSplit.TRAIN: train_indices
         }
         indices = split_indices[self.split]
-        virtual_indices = np.arange(len(images)*9) % (8 * len(sensor_type) * 9) >= len(sensor_type) * 9
+        virtual_indices = np.arange(len(rgb_paths)*9) % (8 * len(sensor_type) * 9) >= len(sensor_type) * 9
 
-        self.images = images[indices]
+        # Only the frames of this split are loaded (and packed), so an image
+        # store is never copied out of its memmap by indexing.
+        self.images, image_shapes = self._load_images([rgb_paths[i] for i in all_indices[indices]])
         self.n_examples = len(self.images)
 
         intrinsics = intrinsics[indices]
+        intrinsics[:, 0, :] *= self.width / image_shapes[:, 1:2]
+        intrinsics[:, 1, :] *= self.height / image_shapes[:, 0:1]
         self.pixtocams = np.array([np.linalg.inv(intrinsic) for intrinsic in intrinsics])
 
         poses = poses @ np.diag([1., -1., -1., 1.]).astype(np.float32)
@@ -673,7 +1182,7 @@ class Carlc(Dataset):
         else:
             factor = 1
 
-        images = []
+        rgb_paths = []
         depths = []
         poses = []
         sky_segments = []
@@ -752,7 +1261,7 @@ class Carlc(Dataset):
         virtual_poses = []
         virtual_intrinsics = []
         if self.mode == 'train':
-            video_lens = 150
+            video_lens = self.config.train_frames
         else:
             video_lens = 30
         for idx in range(video_lens):
@@ -768,14 +1277,7 @@ class Carlc(Dataset):
                 pose_cam2world = poses_per_camera[cam_idx][0][idx]
                 intrinsic = intrinsics_per_camera[cam_idx][0]
 
-                image = np.array(Image.open(rgb_path))
-                ori_image_shape = image.shape
-                image = cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_AREA)
-                image = image / 255.
-                images.append(image)
-
-                intrinsic[0, :] *= self.width / ori_image_shape[1]
-                intrinsic[1, :] *= self.height / ori_image_shape[0]
+                rgb_paths.append(rgb_path)
                 intrinsics.append(intrinsic)
                 poses.append(pose_cam2world)
 
@@ -790,8 +1292,10 @@ class Carlc(Dataset):
                 # sky_segments.append(segment)
                 
         poses = np.array(poses)
-        images = np.array(images)
         intrinsics = np.array(intrinsics)
+        self.images, image_shapes = self._load_images(rgb_paths)
+        intrinsics[:, 0, :] *= self.width / image_shapes[:, 1:2]
+        intrinsics[:, 1, :] *= self.height / image_shapes[:, 0:1]
         # sky_segments = np.array(sky_segments)
         if config.virtual_poses:
             virtual_poses = np.array(virtual_poses)
@@ -812,11 +1316,10 @@ class Carlc(Dataset):
             virtual_poses[:, :3, 3] -= center[None]
             virtual_poses[:, :3, 3] = virtual_poses[:, :3, 3] * scale
 
-        all_indices = np.arange(len(images))
+        all_indices = np.arange(len(rgb_paths))
 
-        virtual_indices = np.arange(len(images)*9) % (8 * len(sensor_type) * 9) >= len(sensor_type) * 9
+        virtual_indices = np.arange(len(rgb_paths)*9) % (8 * len(sensor_type) * 9) >= len(sensor_type) * 9
 
-        self.images = images
         self.n_examples = len(self.images)
         
 
@@ -869,7 +1372,7 @@ class Carlc(Dataset):
 
         pose_list = []
         if mode == 'train':
-            video_len = 150
+            video_len = self.config.train_frames
         else:
             video_len = 30
         for idx in range(video_len):
@@ -11,19 +11,49 @@ class BrightnessCorrection(torch.nn.Module):
             self.sky_latent_code = torch.nn.Parameter(torch.zeros(size=(n_views, 4), dtype=torch.float32), requires_grad=True)
         self.brightness_MLP = BrightnessMLP()
 
-    
+        self._cache = {}
+        self._cache_version = None
+
     def forward(self, indices: torch.tensor = None):
-        indices = indices.squeeze().to(torch.long)
-        latent_code = self.latent_code[indices]
-        affine_transformation = self.brightness_MLP(latent_code).view(indices.shape[0], 3, 4)
+        """Affine color transforms [N, 3, 4] of the cameras `indices` ([N]).
+
+  The MLP only runs once per distinct camera, its outputs are gathered per
+  index. Outside of training and without autograd the transforms are cached
+  per camera until any parameter of the module changes.
+  """
+        indices = indices.reshape(-1).to(torch.long)
+        cameras, inverse = torch.unique(indices, return_inverse=True)
+        if self.training or torch.is_grad_enabled():
+            affine_transformation = self._affine(cameras)
+        else:
+            affine_transformation = self._cached_affine(cameras)
+        affine_transformation = affine_transformation[:, inverse]
         if self.model_sky:
-            sky_latent_code = self.sky_latent_code[indices]
-            affine_transformation_sky = self.brightness_MLP(sky_latent_code).view(indices.shape[0], 3, 4)
+            return affine_transformation[0], affine_transformation[1]
+
+        return affine_transformation[0]
+
+    def _affine(self, cameras):
+        # The scene and sky transforms go through the MLP as a single batch.
+        latent_code = self.latent_code[cameras][None]
+        if self.model_sky:
+            latent_code = torch.cat([latent_code, self.sky_latent_code[cameras][None]])
+        return self.brightness_MLP(latent_code).view(latent_code.shape[:2] + (3, 4))
+
+    def _cached_affine(self, cameras):
+        version = tuple(p._version for p in self.parameters())
+        if version != self._cache_version:
+            self._cache = {}
+            self._cache_version = version
+        cameras = cameras.tolist()
+        missing = [c for c in cameras if c not in self._cache]
+        if missing:
+            affine_transformation = self._affine(torch.tensor(missing, device=self.latent_code.device))
+            for i, c in enumerate(missing):
+                self._cache[c] = affine_transformation[:, i]
+        return torch.stack([self._cache[c] for c in cameras], dim=1)
+
 
-            return affine_transformation, affine_transformation_sky
-        
-        return affine_transformation
-    
 class BrightnessMLP(torch.nn.Module):
     def __init__(self, D=3, W=256, input_ch=4, output_ch=12, use_viewdirs=False):
         super(BrightnessMLP, self).__init__()
@@ -0,0 +1,63 @@
+import fcntl
+import os
+from internal import utils
+import accelerate
+
+
+class FrameQueue:
+    """Hands out frame indices to processes from a counter file they all share.
+
+  Every process iterates over the same queue and gets the next frame not yet
+  taken by any process, so faster processes simply render more frames. The
+  counter is guarded by an exclusive lock on the file, the only synchronization
+  needed is a barrier when the queue is (re)created.
+
+  fcntl.flock() locks are only reliable between processes of one machine on a
+  local filesystem: on NFS they are emulated (or silently local to each client)
+  depending on the kernel and mount options, so processes on different nodes
+  may take the same frame. For multi-node runs `path` must be on a filesystem
+  with working cross-node flock, or every node needs its own queue.
+  """
+
+    def __init__(self, path, num_frames, accelerator):
+        self.path = path
+        self.num_frames = num_frames
+        if accelerator.is_main_process:
+            utils.makedirs(os.path.dirname(os.path.abspath(path)))
+            with open(path, 'w') as fp:
+                fp.write('0')
+        accelerator.wait_for_everyone()
+
+    def _take(self):
+        with open(self.path, 'r+') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                idx = int(fp.read())
+                fp.seek(0)
+                fp.write(str(idx + 1))
+                fp.truncate()
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+        return idx
+
+    def __iter__(self):
+        while True:
+            idx = self._take()
+            if idx >= self.num_frames:
+                return
+            yield idx
+
+
+def gather_by_frame(frames, *values):
+    """Gathers per-frame values from every process, in frame order.
+
+  Args:
+    frames: list of int, the frames this process handled.
+    *values: lists of the same length as `frames`, a value of each frame.
+
+  Returns:
+    One list per argument, holding the frames (then values) of all processes,
+    sorted by frame.
+  """
+    gathered = sorted(accelerate.utils.gather_object(list(zip(frames, *values))), key=lambda x: x[0])
+    return [[x[i] for x in gathered] for i in range(1 + len(values))]
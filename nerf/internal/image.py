@@ -1,12 +1,7 @@
 import torch
 import numpy as np
-from internal import math
-from skimage.metrics import structural_similarity, peak_signal_noise_ratio
-import cv2
 import lpips
 
-loss_fn_vgg = lpips.LPIPS(net='vgg')
-
 
 def mse_to_psnr(mse):
     """Compute PSNR given an MSE (we assume the maximum pixel value is 1)."""
@@ -68,66 +63,147 @@ def downsample(img, factor):
     return img
 
 
-def color_correct(img, ref, num_iters=5, eps=0.5 / 255):
-    """Warp `img` to match the colors in `ref_img`."""
+def color_correct(img, ref, num_iters=5, eps=0.5 / 255, num_samples=0):
+    """Warp `img` to match the colors in `ref_img`.
+
+  The warp of every channel is fit by least squares through its normal
+  equations, solved for all channels at once on the device of `img`. With
+  `num_samples` > 0 it is fit on about that many pixels, evenly strided over
+  the image, and then applied to all of them.
+  """
     if img.shape[-1] != ref.shape[-1]:
         raise ValueError(
             f'img\'s {img.shape[-1]} and ref\'s {ref.shape[-1]} channels must match'
         )
     num_channels = img.shape[-1]
     img_mat = img.reshape([-1, num_channels])
-    ref_mat = ref.reshape([-1, num_channels])
+    ref_mat = ref.reshape([-1, num_channels]).to(img_mat)
+    if num_samples > 0 and img_mat.shape[0] > num_samples:
+        step = -(-img_mat.shape[0] // num_samples)
+        fit = slice(None, None, step)
+    else:
+        fit = slice(None)
     is_unclipped = lambda z: (z >= eps) & (z <= (1 - eps))  # z \in [eps, 1-eps].
-    mask0 = is_unclipped(img_mat)
+    mask0 = is_unclipped(img_mat[fit]) & is_unclipped(ref_mat[fit])
+    ref_fit = ref_mat[fit].to(torch.float64)
+    # Indices of the quadratic terms, every product of two channels once.
+    rows, cols = torch.triu_indices(num_channels, num_channels, device=img_mat.device)
     # Because the set of saturated pixels may change after solving for a
     # transformation, we repeatedly solve a system `num_iters` times and update
     # our estimate of which pixels are saturated.
     for _ in range(num_iters):
         # Construct the left hand side of a linear system that contains a quadratic
         # expansion of each pixel of `img`.
-        a_mat = []
-        for c in range(num_channels):
-            a_mat.append(img_mat[:, c:(c + 1)] * img_mat[:, c:])  # Quadratic term.
-        a_mat.append(img_mat)  # Linear term.
-        a_mat.append(torch.ones_like(img_mat[:, :1]))  # Bias term.
-        a_mat = torch.cat(a_mat, dim=-1)
-        warp = []
-        for c in range(num_channels):
-            # Construct the right hand side of a linear system containing each color
-            # of `ref`.
-            b = ref_mat[:, c]
-            # Ignore rows of the linear system that were saturated in the input or are
-            # saturated in the current corrected color estimate.
-            mask = mask0[:, c] & is_unclipped(img_mat[:, c]) & is_unclipped(b)
-            ma_mat = torch.where(mask[:, None], a_mat, torch.zeros_like(a_mat))
-            mb = torch.where(mask, b, torch.zeros_like(b))
-            w = torch.linalg.lstsq(ma_mat, mb, rcond=-1)[0]
-            assert torch.all(torch.isfinite(w))
-            warp.append(w)
-        warp = torch.stack(warp, dim=-1)
+        a_mat = torch.cat([
+            img_mat[:, rows] * img_mat[:, cols],  # Quadratic term.
+            img_mat,  # Linear term.
+            torch.ones_like(img_mat[:, :1]),  # Bias term.
+        ], dim=-1)
+        # Ignore rows of the linear system that were saturated in the input or are
+        # saturated in the current corrected color estimate.
+        mask = (mask0 & is_unclipped(img_mat[fit])).to(torch.float64)
+        a_fit = a_mat[fit].to(torch.float64)
+        # Normal equations of every channel, [C, K, K] and [C, K].
+        ata = torch.einsum('pc,pk,pl->ckl', mask, a_fit, a_fit)
+        atb = torch.einsum('pc,pk->ck', mask * ref_fit, a_fit)
+        # The pseudo-inverse gives the minimum norm solution, like lstsq, when a
+        # channel has too few unclipped pixels.
+        warp = (torch.linalg.pinv(ata, hermitian=True) @ atb[..., None])[..., 0]
+        assert torch.all(torch.isfinite(warp))
         # Apply the warp to update img_mat.
-        img_mat = torch.clip(math.matmul(a_mat, warp), 0, 1)
+        img_mat = torch.clip(a_mat @ warp.T.to(a_mat.dtype), 0, 1)
     corrected_img = torch.reshape(img_mat, img.shape)
     return corrected_img
 
 
+def _rgb_to_gray(rgb, quantize):
+    """Luma of [N, H, W, 3] images, as cv2.COLOR_RGB2GRAY computes it."""
+    if quantize:
+        # OpenCV's fixed point coefficients for uint8, 15 fractional bits.
+        rgb = rgb.to(torch.int32)
+        gray = rgb[..., 0] * 9798 + rgb[..., 1] * 19235 + rgb[..., 2] * 3735
+        return (gray + (1 << 14)) >> 15
+    return rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+
+
+def _ssim(x, y, data_range, win_size=7):
+    """SSIM of [N, H, W] images with skimage's defaults (uniform window)."""
+    x = x.to(torch.float64)
+    y = y.to(torch.float64)
+    # skimage filters the whole image and crops the window radius off the SSIM
+    # map, which leaves exactly the windows that fit in the image.
+    box = lambda z: torch.nn.functional.avg_pool2d(z[:, None], win_size, stride=1)[:, 0]
+    ux, uy = box(x), box(y)
+    uxx, uyy, uxy = box(x * x), box(y * y), box(x * y)
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)  # Sample covariance.
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+    return s.mean((1, 2))
+
+
+_lpips_models = {}
+
+
+def get_lpips(device):
+    """The LPIPS (VGG) network on `device`, loaded on first use."""
+    key = str(device)
+    if key not in _lpips_models:
+        _lpips_models[key] = lpips.LPIPS(net='vgg', verbose=False).to(device).eval()
+    return _lpips_models[key]
+
+
 class MetricHarness:
-    """A helper class for evaluating several error metrics."""
+    """A helper class for evaluating several error metrics.
+
+  Metrics are computed in batches on `device`. With `quantize`, images are
+  converted to 8 bits first and PSNR, SSIM (on the luma) and LPIPS follow
+  skimage, OpenCV and lpips for uint8 inputs, otherwise the float images are
+  used as they are. LPIPS runs on at most `lpips_batch_size` images at a time.
+  """
+
+    def __init__(self, device='cpu', quantize=True, lpips_batch_size=4):
+        self.device = device
+        self.quantize = quantize
+        self.lpips_batch_size = lpips_batch_size
 
     def __call__(self, rgb_pred, rgb_gt, name_fn=lambda s: s):
         """Evaluate the error between a predicted rgb image and the true image."""
-        rgb_pred = (np.clip(rgb_pred, 0., 1) * 255).astype(np.uint8)
-        rgb_gt = (rgb_gt * 255).astype(np.uint8)
-        rgb_pred_gray = cv2.cvtColor(rgb_pred, cv2.COLOR_RGB2GRAY)
-        rgb_gt_gray = cv2.cvtColor(rgb_gt, cv2.COLOR_RGB2GRAY)
-        psnr = float(peak_signal_noise_ratio(rgb_pred, rgb_gt, data_range=255))
-        ssim = float(structural_similarity(rgb_pred_gray, rgb_gt_gray, data_range=255))
-        gt_ = torch.from_numpy(rgb_gt/255).permute(2, 0, 1).unsqueeze(0)*2 - 1.0
-        pred_ = torch.from_numpy(rgb_pred/255).permute(2, 0, 1).unsqueeze(0)*2 - 1.0
-        lp = loss_fn_vgg(gt_.to(torch.float32), pred_.to(torch.float32)).detach().numpy().item()
-
-        return {
-            name_fn('psnr'): psnr,
-            name_fn('ssim'): ssim,
-            name_fn('lpips'): lp
-        }
+        return self.evaluate([rgb_pred], [rgb_gt], name_fn)[0]
+
+    def evaluate(self, rgb_preds, rgb_gts, name_fn=lambda s: s):
+        """Evaluates pairs of predicted and true images, returns a list of metrics."""
+        if len({tuple(x.shape) for x in list(rgb_preds) + list(rgb_gts)}) > 1:
+            return [self(p, g, name_fn) for p, g in zip(rgb_preds, rgb_gts)]
+        to_tensor = lambda xs: torch.stack([torch.as_tensor(x) for x in xs]).to(self.device)
+        rgb_pred = torch.clip(to_tensor(rgb_preds), 0., 1)
+        rgb_gt = to_tensor(rgb_gts)
+        if self.quantize:
+            rgb_pred = (rgb_pred * 255).to(torch.uint8)
+            rgb_gt = (rgb_gt * 255).to(torch.uint8)
+            data_range = 255
+        else:
+            data_range = 1
+
+        with torch.no_grad():
+            err = rgb_pred.to(torch.float64) - rgb_gt.to(torch.float64)
+            psnr = 10 * torch.log10(data_range ** 2 / (err ** 2).mean((1, 2, 3)))
+            ssim = _ssim(_rgb_to_gray(rgb_pred, self.quantize),
+                         _rgb_to_gray(rgb_gt, self.quantize), data_range)
+            to_lpips = lambda x: (x.permute(0, 3, 1, 2).to(torch.float64) / data_range * 2 - 1).to(torch.float32)
+            lpips_fn = get_lpips(self.device)
+            lp = torch.cat([
+                lpips_fn(to_lpips(rgb_gt[i:i + self.lpips_batch_size]),
+                         to_lpips(rgb_pred[i:i + self.lpips_batch_size])).reshape(-1)
+                for i in range(0, len(rgb_pred), self.lpips_batch_size)
+            ])
+
+        psnr, ssim, lp = psnr.tolist(), ssim.tolist(), lp.tolist()
+        return [{
+            name_fn('psnr'): psnr[i],
+            name_fn('ssim'): ssim[i],
+            name_fn('lpips'): lp[i]
+        } for i in range(len(psnr))]
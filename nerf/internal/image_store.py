@@ -0,0 +1,182 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+from internal import utils
+import cv2
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+def decode_image(pth, width, height):
+    """Decodes an image and resizes it to (width, height).
+
+  Args:
+    pth: str, path to the image file.
+    width: int, target width.
+    height: int, target height.
+
+  Returns:
+    image: [height, width, C] float32 array with values in [0, 255].
+    shape: (height, width) of the image on disk.
+  """
+    image = np.array(Image.open(pth), dtype=np.float32)
+    shape = image.shape[:2]
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return image, shape
+
+
+def _cache_path(cache_dir, pth, width, height):
+    key = f'{os.path.abspath(pth)}:{os.path.getmtime(pth)}:{width}x{height}'
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def _decode_cached(pth, width, height, cache_dir):
+    """decode_image() through an on-disk cache of uint8 frames."""
+    if cache_dir is None:
+        return decode_image(pth, width, height)
+    cache_path = _cache_path(cache_dir, pth, width, height)
+    if utils.file_exists(cache_path):
+        with np.load(cache_path) as data:
+            return data['image'].astype(np.float32), tuple(data['shape'])
+    image, shape = decode_image(pth, width, height)
+    image = np.clip(np.round(image), 0, 255).astype(np.uint8)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with utils.open_file(tmp_path, 'wb') as fp:
+        np.savez(fp, image=image, shape=np.array(shape))
+    os.replace(tmp_path, cache_path)
+    return image.astype(np.float32), shape
+
+
+def decode_images(image_paths, width, height, num_workers=8, cache_dir=None):
+    """Decodes and resizes images concurrently, in order.
+
+  Decoding and resizing release the GIL, so a thread pool is enough and avoids
+  pickling frames between processes. If `cache_dir` is set, decoded frames are
+  kept there as uint8, keyed by (path, mtime, target size), and later runs only
+  read them back.
+
+  Args:
+    image_paths: list of str, images to decode.
+    width: int, target width.
+    height: int, target height.
+    num_workers: int, number of decoding threads, <= 1 decodes serially.
+    cache_dir: str, optional directory of the on-disk frame cache.
+
+  Yields:
+    (image, shape) tuples as returned by decode_image(), in input order.
+  """
+    if cache_dir is not None:
+        utils.makedirs(cache_dir)
+    decode_fn = lambda pth: _decode_cached(pth, width, height, cache_dir)
+    if num_workers <= 1:
+        yield from map(decode_fn, image_paths)
+        return
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        # Keep a bounded number of frames in flight.
+        futures = [executor.submit(decode_fn, pth)
+                   for pth in image_paths[:2 * num_workers]]
+        for i in range(len(image_paths)):
+            result = futures[i].result()
+            futures[i] = None
+            if i + 2 * num_workers < len(image_paths):
+                futures.append(executor.submit(decode_fn, image_paths[i + 2 * num_workers]))
+            yield result
+
+
+def _index_path(store_path):
+    return store_path + '.json'
+
+
+def _data_path(store_path):
+    return store_path + '.npy'
+
+
+def _make_index(image_paths, width, height):
+    return {
+        'width': width,
+        'height': height,
+        'paths': [os.path.abspath(p) for p in image_paths],
+        'mtimes': [os.path.getmtime(p) for p in image_paths],
+    }
+
+
+def _read_index(store_path):
+    if not (utils.file_exists(_index_path(store_path)) and
+            utils.file_exists(_data_path(store_path))):
+        return None
+    with utils.open_file(_index_path(store_path), 'r') as fp:
+        return json.load(fp)
+
+
+def pack_images(store_path, image_paths, width, height, num_workers=8, cache_dir=None):
+    """Decodes and resizes images into a single uint8 memory-mapped file.
+
+  Writes `<store_path>.npy` holding a [N, height, width, C] uint8 array and a
+  small `<store_path>.json` index with the source paths, their mtimes and their
+  original sizes. The index is written last, so an interrupted pack is simply
+  repacked on the next run.
+
+  Args:
+    store_path: str, path prefix of the store files.
+    image_paths: list of str, images to pack, in order.
+    width: int, target width.
+    height: int, target height.
+    num_workers: int, number of decoding threads.
+    cache_dir: str, optional directory of the on-disk frame cache.
+  """
+    utils.makedirs(os.path.dirname(os.path.abspath(store_path)))
+    index = _make_index(image_paths, width, height)
+    tmp_path = _data_path(store_path) + '.tmp'
+    images = None
+    shapes = []
+    decoded = decode_images(image_paths, width, height, num_workers, cache_dir)
+    for i, (pth, (image, shape)) in enumerate(
+            zip(image_paths, tqdm(decoded, total=len(image_paths), desc='Packing images'))):
+        if image.ndim == 2:
+            image = image[..., None]
+        if images is None:
+            images = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.uint8,
+                shape=(len(image_paths),) + image.shape)
+        if image.shape != images.shape[1:]:
+            raise ValueError(f'{pth} has shape {image.shape}, expected '
+                             f'{images.shape[1:]}')
+        images[i] = np.clip(np.round(image), 0, 255).astype(np.uint8)
+        shapes.append(shape)
+    images.flush()
+    del images
+    os.replace(tmp_path, _data_path(store_path))
+    index['shapes'] = [list(s) for s in shapes]
+    with utils.open_file(_index_path(store_path) + '.tmp', 'w') as fp:
+        json.dump(index, fp)
+    os.replace(_index_path(store_path) + '.tmp', _index_path(store_path))
+
+
+def open_images(store_path, image_paths, width, height, num_workers=8, cache_dir=None):
+    """Opens an image store read-only, (re)packing it if missing or stale.
+
+  The store is stale if its paths, their mtimes or the target size differ from
+  the requested ones. The returned array is backed by the page cache, so it is
+  shared by every DataLoader worker instead of being copied into each of them.
+
+  Args:
+    store_path: str, path prefix of the store files.
+    image_paths: list of str, images in the store, in order.
+    width: int, target width.
+    height: int, target height.
+    num_workers: int, number of decoding threads used when packing.
+    cache_dir: str, optional directory of the on-disk frame cache.
+
+  Returns:
+    images: [N, height, width, C] read-only uint8 memmap.
+    shapes: [N, 2] int array, (height, width) of each image on disk.
+  """
+    index = _read_index(store_path)
+    expected = _make_index(image_paths, width, height)
+    if index is None or any(index[k] != v for k, v in expected.items()):
+        pack_images(store_path, image_paths, width, height, num_workers, cache_dir)
+        index = _read_index(store_path)
+    images = np.load(_data_path(store_path), mmap_mode='r')
+    return images, np.array(index['shapes'])
@@ -0,0 +1,77 @@
+import concurrent.futures
+import os
+import threading
+from internal import utils
+
+
+class ImageWriter:
+    """Saves images on a pool of background threads.
+
+  Encoding a PNG or TIFF of a full frame takes a noticeable fraction of the
+  render time, with `render_save_async` it overlaps with rendering the next
+  frame instead. At most `max_pending` images are queued, saving one more
+  blocks until a worker is free, so memory stays bounded if rendering outpaces
+  the disk. flush() waits for every queued image, re-raises the first error of
+  a worker and checks that every file was written.
+  """
+
+    def __init__(self, config, num_workers=4, max_pending=16):
+        self.enabled = config.render_save_async
+        self.pending = []
+        self.paths = []
+        if self.enabled:
+            self.pool = concurrent.futures.ThreadPoolExecutor(num_workers)
+            self.slots = threading.BoundedSemaphore(max_pending)
+
+    def _submit(self, fn, img, pth):
+        if not self.enabled:
+            fn(img, pth)
+            return
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, img, pth)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append(future)
+        self.paths.append(pth)
+
+    def save_img_u8(self, img, pth):
+        """Queues utils.save_img_u8(img, pth)."""
+        self._submit(utils.save_img_u8, img, pth)
+
+    def save_img_f32(self, img, pth):
+        """Queues utils.save_img_f32(img, pth)."""
+        self._submit(utils.save_img_f32, img, pth)
+
+    def flush(self):
+        """Waits for every queued image to be saved."""
+        pending, paths = self.pending, self.paths
+        self.pending, self.paths = [], []
+        concurrent.futures.wait(pending)
+        for future in pending:
+            if future.exception() is not None:
+                raise future.exception()
+        missing = [p for p in paths if not utils.file_exists(p) or os.path.getsize(p) == 0]
+        if missing:
+            raise IOError(f'{len(missing)} images were not saved, eg. {missing[0]}.')
+
+    def close(self):
+        """Flushes and stops the workers."""
+        try:
+            self.flush()
+        finally:
+            if self.enabled:
+                self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.enabled:
+            # Don't mask the original error, but still finish what was queued.
+            concurrent.futures.wait(self.pending)
+            self.pool.shutdown()
@@ -0,0 +1,220 @@
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+import torch
+from torch.utils._pytree import tree_map, tree_flatten
+
+
+class RayStream(torch.utils.data.IterableDataset):
+    """Endless stream of training batches drawn from a training Dataset."""
+
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+
+    def __iter__(self):
+        while True:
+            yield self.dataset[0]
+
+
+class BatchRing:
+    """Ring of preallocated shared-memory batches filled by producer processes.
+
+  Producers draw batches from a RayStream and copy them into free slots of the
+  ring, the consumer hands filled slots out without copying. A batch returned
+  by next() stays valid until the following call to next(), which recycles its
+  slot. The ring never runs dry, so unlike a DataLoader over a fixed number of
+  indices it never has to be re-iterated. An error in a producer is sent back
+  and raised by next(), as is a producer dying without one (eg. killed by the
+  OOM killer), so the consumer never waits forever.
+  """
+
+    def __init__(self, dataset, num_workers=8, num_slots=16, seed=0):
+        template = next(iter(RayStream(dataset)))
+        self._keys = [k for k, v in template.items() if v is not None]
+        self._none_keys = [k for k, v in template.items() if v is None]
+        self._slots = [{k: torch.empty_like(template[k]).share_memory_() for k in self._keys}
+                       for _ in range(num_slots)]
+
+        ctx = torch.multiprocessing.get_context('fork')
+        self._free = ctx.Queue()
+        self._filled = ctx.Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+        self._producer_wait = ctx.Array('d', num_workers, lock=False)
+        self._workers = [ctx.Process(target=self._produce, args=(dataset, i, seed), daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+        self._current = None
+        self.consumer_wait = 0.
+        self.num_batches = 0
+
+    def _produce(self, dataset, worker_id, seed):
+        np.random.seed(seed + worker_id)
+        torch.manual_seed(seed + worker_id)
+        try:
+            for batch in RayStream(dataset):
+                start = time.time()
+                slot = self._free.get()
+                if slot is None:
+                    return
+                self._producer_wait[worker_id] += time.time() - start
+                for k in self._keys:
+                    self._slots[slot][k].copy_(batch[k])
+                self._filled.put(slot)
+        except Exception:  # pylint: disable=broad-except
+            # The exception itself may not be picklable, send its traceback.
+            self._filled.put(RuntimeError(
+                f'BatchRing producer {worker_id} failed:\n{traceback.format_exc()}'))
+
+    def _get_filled(self):
+        while True:
+            try:
+                return self._filled.get(timeout=1.)
+            except queue.Empty:
+                dead = [w for w in self._workers if not w.is_alive()]
+                if dead:
+                    raise RuntimeError(f'{len(dead)} BatchRing producers exited, '
+                                       f'eg. with exit code {dead[0].exitcode}')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._current is not None:
+            self._free.put(self._current)
+        self._current = None
+        start = time.time()
+        item = self._get_filled()
+        self.consumer_wait += time.time() - start
+        if isinstance(item, Exception):
+            raise item
+        self._current = item
+        self.num_batches += 1
+        batch = dict(self._slots[self._current])
+        batch.update({k: None for k in self._none_keys})
+        return batch
+
+    def stats(self):
+        """Queue depth and accumulated wait times (in seconds) of the ring.
+
+    producer_wait is the time producers spent waiting for a free slot (the
+    trainer is the bottleneck), consumer_wait the time the trainer spent
+    waiting for a filled one (the input pipeline is the bottleneck).
+    """
+        try:
+            queue_depth = self._filled.qsize()
+        except NotImplementedError:
+            queue_depth = -1
+        return {
+            'queue_depth': queue_depth,
+            'producer_wait': sum(self._producer_wait),
+            'consumer_wait': self.consumer_wait,
+            'batches': self.num_batches,
+        }
+
+    def close(self):
+        for _ in self._workers:
+            self._free.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+
+
+class DevicePrefetcher:
+    """Keeps batches already transferred to the training device ahead of use.
+
+  A background thread pulls batches from `iterable`, re-iterating it whenever
+  it is exhausted, and copies them to `device`. On CUDA the copy goes through
+  pinned host memory with non-blocking transfers on a side stream, so it
+  overlaps with the training step; elsewhere it is a plain synchronous copy,
+  which keeps the same code path usable without a GPU. `iterable` should yield
+  CPU tensors, tensors already on another device are passed through as is.
+  """
+
+    def __init__(self, iterable, device, depth=2):
+        self._iterable = iterable
+        self._device = torch.device(device)
+        self._cuda = self._device.type == 'cuda'
+        self._stream = torch.cuda.Stream(self._device) if self._cuda else None
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self.num_waits = 0
+        self.wait_time = 0.
+        self.num_batches = 0
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _copy(self, x):
+        if not torch.is_tensor(x) or x.device.type != 'cpu':
+            return x
+        if not self._cuda:
+            # Always copy: the source may be a BatchRing slot that gets recycled.
+            return x.to(self._device, copy=True)
+        return x.pin_memory().to(self._device, non_blocking=True)
+
+    def _to_device(self, batch):
+        if not self._cuda:
+            return tree_map(self._copy, batch), None
+        with torch.cuda.stream(self._stream):
+            batch = tree_map(self._copy, batch)
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return batch, event
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                for batch in self._iterable:
+                    self._put(self._to_device(batch))
+                    if self._stop.is_set():
+                        return
+        except Exception as e:  # pylint: disable=broad-except
+            self._put((e, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            batch, event = self._queue.get_nowait()
+        except queue.Empty:
+            self.num_waits += 1
+            start = time.time()
+            batch, event = self._queue.get()
+            self.wait_time += time.time() - start
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            stream = torch.cuda.current_stream(self._device)
+            stream.wait_event(event)
+            for x in tree_flatten(batch)[0]:
+                if torch.is_tensor(x):
+                    x.record_stream(stream)
+        self.num_batches += 1
+        return batch
+
+    def stats(self):
+        """How often, and for how long (in seconds), the trainer had to wait."""
+        return {
+            'prefetch_waits': self.num_waits,
+            'prefetch_wait_time': self.wait_time,
+            'prefetch_batches': self.num_batches,
+        }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
@@ -1,5 +1,6 @@
 import accelerate
 import gin
+from internal import chunking
 from internal import coord
 from internal import geopoly
 from internal import image
@@ -15,7 +16,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils._pytree import tree_map
-from tqdm import tqdm
 from gridencoder import GridEncoder
 from torch_scatter import segment_coo
 
@@ -53,6 +53,16 @@ class Model(nn.Module):
     power_lambda: float = -1.5
     std_scale: float = 0.5
     prop_desired_grid_size = [512, 2048]
+    occ_grid_resolution: int = 0  # Occupancy grid resolution, disabled if 0.
+    occ_grid_threshold: float = 0.01  # Density above which a cell is occupied.
+    occ_grid_decay: float = 0.95  # Decay of cell densities between refreshes.
+    occ_grid_update_every: int = 16  # Training steps between grid refreshes.
+    occ_grid_warmup: int = 256  # Training steps before the grid is used.
+    occ_grid_samples: int = 256  # Intervals per ray the grid is queried on.
+    occ_grid_floor: float = 0.01  # Weight of empty intervals while training.
+    early_stop_transmittance: float = 0.  # Inference only, cull samples behind this transmittance, disabled if 0.
+    early_stop_group_size: int = 16  # Samples evaluated per ray between transmittance checks.
+    sky_lut_resolution: int = 0  # Height of the baked sky texture used at inference, disabled if 0.
 
     def __init__(self, config=None, **kwargs):
         super().__init__()
@@ -90,10 +100,16 @@ class Model(nn.Module):
                 output_ch=4,
                 skips=[4]
             )
+            self._sky_lut = None
 
         if self.config.brightness_correction:
             self.brightness_corr = BrightnessCorrection(self.config.training_views, model_sky=self.config.model_sky)
 
+        if self.occ_grid_resolution > 0:
+            self.occ_grid = OccupancyGrid(self.occ_grid_resolution,
+                                          threshold=self.occ_grid_threshold,
+                                          decay=self.occ_grid_decay)
+
     def forward(
             self,
             rand,
@@ -101,7 +117,8 @@ class Model(nn.Module):
             train_frac,
             compute_extras,
             zero_glo=True,
-            eval_camidx=None
+            eval_camidx=None,
+            compute_normals=None
     ):
         """The mip-NeRF Model.
 
@@ -111,6 +128,8 @@ class Model(nn.Module):
       train_frac: float in [0, 1], what fraction of training is complete.
       compute_extras: bool, if True, compute extra quantities besides color.
       zero_glo: bool, if True, when using GLO pass in vector of zeros.
+      compute_normals: bool, whether the MLPs compute density gradient normals,
+        if None only while gradients are enabled.
 
     Returns:
       ret: list, [*(rgb, distance, acc)]
@@ -147,6 +166,22 @@ class Model(nn.Module):
         weights = torch.ones_like(batch['near'])
         prod_num_samples = 1
 
+        # Replace the single initial interval by a fine partition of the ray
+        # weighted by the occupancy grid, so the first level only samples the
+        # segments that may contain something.
+        use_occ_grid = (self.occ_grid_resolution > 0 and
+                        self.occ_grid.num_steps >= self.occ_grid_warmup)
+        if use_occ_grid:
+            sdist = torch.linspace(init_s_near, init_s_far, self.occ_grid_samples + 1, device=device)
+            sdist = torch.broadcast_to(sdist, batch['near'].shape[:-1] + sdist.shape)
+            occupied = self.occupied(batch, s_to_t(sdist))
+            # Keep sampling empty segments sparsely while training, so cells
+            # whose content appears later can still be marked as occupied.
+            floor = self.occ_grid_floor if self.training else 0.
+            weights = floor + (1 - floor) * occupied.float()
+            # Rays the grid sees as empty are sampled as usual.
+            weights = torch.where(occupied.any(dim=-1, keepdim=True), weights, torch.ones_like(weights))
+
         ray_history = []
         renderings = []
         for i_level in range(self.num_levels):
@@ -220,14 +255,33 @@ class Model(nn.Module):
             # Push our Gaussians through one of our two MLPs.
             mlp = (self.get_submodule(
                 f'prop_mlp_{i_level}') if self.distinct_prop else self.prop_mlp) if is_prop else self.nerf_mlp
-            ray_results = mlp(
-                rand,
-                means, stds,
-                viewdirs=batch['viewdirs'] if self.use_viewdirs else None,
-                imageplane=batch.get('imageplane'),
-                glo_vec=None if is_prop else glo_vec,
-                exposure=batch.get('exposure_values'),
-            )
+            # At inference, samples in empty cells of the grid are not evaluated.
+            cull_empty = not self.training and use_occ_grid
+            if (not self.training and (self.early_stop_transmittance > 0 or cull_empty)
+                    and tdist.dim() == 2):
+                ray_results = self.march_mlp(
+                    mlp,
+                    rand,
+                    means, stds,
+                    tdist,
+                    batch,
+                    glo_vec=None if is_prop else glo_vec,
+                    compute_normals=compute_normals,
+                    occupied=self.occupied(batch, tdist) if cull_empty else None,
+                )
+            else:
+                ray_results = mlp(
+                    rand,
+                    means, stds,
+                    viewdirs=batch['viewdirs'] if self.use_viewdirs else None,
+                    imageplane=batch.get('imageplane'),
+                    glo_vec=None if is_prop else glo_vec,
+                    exposure=batch.get('exposure_values'),
+                    compute_normals=compute_normals,
+                )
+
+            if self.training and self.occ_grid_resolution > 0:
+                self.occ_grid.observe(ray_results['coord'], ray_results['density'])
 
             #gradient scaling
             if self.config.brightness_correction:
@@ -310,6 +364,9 @@ class Model(nn.Module):
             ray_results['weights'] = weights.clone()
             ray_history.append(ray_results)
 
+        if self.training and self.occ_grid_resolution > 0:
+            self.occ_grid.step(self.occ_grid_update_every)
+
         if compute_extras:
             # Because the proposal network doesn't produce meaningful colors, for
             # easier visualization we replace their colors with the final average
@@ -324,34 +381,31 @@ class Model(nn.Module):
                 renderings[i]['ray_rgbs'] = avg_rgbs[i]
 
         if self.config.model_sky:
-            network_fn = self.skynerf
-            sky_near = batch['far'].squeeze().unsqueeze(-1)
-            sky_far = torch.full_like(sky_near*1.2, sky_near[0].detach().cpu().item()*1.5)
-            bounds = torch.concat([sky_near, sky_far], dim=-1)
-            ray_batch = torch.concat([batch['origins'].squeeze(), batch['directions'].squeeze(), bounds, batch['cam_dirs'].squeeze()], dim=-1)
-
-            #render
-            ret = render_rays(ray_batch=ray_batch, network_fn=network_fn)
+            if not self.training and self.sky_lut_resolution > 0:
+                sky_rgbs = self.lookup_sky(batch)
+            else:
+                sky_rgbs = self.render_sky(batch['origins'], batch['directions'], batch['far'], batch['cam_dirs'])
 
             for num_level in range(len(renderings)):
-                renderings[num_level]['sky_rgbs'] = ret['rgb_map']
+                renderings[num_level]['sky_rgbs'] = sky_rgbs
 
         if self.config.brightness_correction:
             if eval_camidx is None:
                 camera_idxs = batch['cam_idx'][..., 0]
             else:
-                camera_idxs = eval_camidx.repeat(renderings[0]['rgb'].shape[0])
+                # A single camera, its transform is broadcast over the rays.
+                camera_idxs = torch.as_tensor(eval_camidx, device=device).reshape(1)
 
             if self.config.model_sky:
                 affine_trans, affine_trans_sky = self.brightness_corr(indices=camera_idxs)
             else:
                 affine_trans = self.brightness_corr(indices=camera_idxs)
 
+            sky_opacity = 1 - torch.sum(rendering['weights'], dim=-1, keepdim=True)
             for num_level in range(len(renderings)):
-                sky_opacity = 1 - torch.sum(rendering['weights'], dim=-1, keepdim=True)
-                renderings[num_level]['rgb'] = torch.bmm(affine_trans[:, :3, :3], renderings[num_level]['rgb'].squeeze().unsqueeze(-1)) + affine_trans[:, :3, 3:]
+                renderings[num_level]['rgb'] = torch.matmul(affine_trans[:, :3, :3], renderings[num_level]['rgb'].squeeze().unsqueeze(-1)) + affine_trans[:, :3, 3:]
                 if self.config.model_sky:
-                    renderings[num_level]['rgb'] += sky_opacity.squeeze().unsqueeze(-1).unsqueeze(-1).repeat(1, 3, 1) * (torch.bmm(affine_trans_sky[:, :3, :3], renderings[num_level]['sky_rgbs'].squeeze().unsqueeze(-1)) + affine_trans_sky[:, :3, 3:])
+                    renderings[num_level]['rgb'] += sky_opacity.squeeze().unsqueeze(-1).unsqueeze(-1) * (torch.matmul(affine_trans_sky[:, :3, :3], renderings[num_level]['sky_rgbs'].squeeze().unsqueeze(-1)) + affine_trans_sky[:, :3, 3:])
 
                 if eval_camidx is None:
                     renderings[num_level]['rgb'] = renderings[num_level]['rgb'].squeeze().unsqueeze(1).unsqueeze(1)
@@ -364,6 +418,226 @@ class Model(nn.Module):
 
         return renderings, ray_history
 
+    def render_sky(self, origins, directions, far, cam_dirs):
+        """Renders the sky network along rays, returns [N, 3] colors."""
+        sky_near = far.reshape(-1, 1)
+        sky_far = torch.full_like(sky_near, sky_near[0].detach().cpu().item() * 1.5)
+        bounds = torch.concat([sky_near, sky_far], dim=-1)
+        ray_batch = torch.concat([origins.reshape(-1, 3), directions.reshape(-1, 3), bounds, cam_dirs.reshape(-1, 3)],
+                                 dim=-1)
+        return render_rays(ray_batch=ray_batch, network_fn=self.skynerf)['rgb_map']
+
+    @torch.no_grad()
+    def bake_sky(self, origin, cam_dir, far):
+        """Samples the sky network into an equirectangular texture.
+
+    The sky network sees the origin and the unnormalized direction of each ray,
+    and the optical axis of its camera, so a texture is only valid for one
+    camera. Texels are baked for pinhole rays, whose length is one over the
+    cosine of their angle to the optical axis.
+
+    Args:
+      origin: [3], the camera center.
+      cam_dir: [3], the optical axis of the camera.
+      far: [], the far plane of the camera's rays.
+
+    Returns:
+      [1, 3, sky_lut_resolution, 2 * sky_lut_resolution + 1] texture over
+      (elevation, azimuth), its last column repeats the first one.
+    """
+        height = self.sky_lut_resolution
+        width = 2 * height + 1
+        theta = torch.linspace(-np.pi, np.pi, width, device=origin.device)
+        phi = torch.linspace(-np.pi / 2, np.pi / 2, height, device=origin.device)
+        phi, theta = torch.meshgrid(phi, theta, indexing='ij')
+        dirs = torch.stack([torch.cos(phi) * torch.cos(theta),
+                            torch.cos(phi) * torch.sin(theta),
+                            torch.sin(phi)], dim=-1).reshape(-1, 3)
+        cos = torch.sum(dirs * F.normalize(cam_dir, dim=-1), dim=-1, keepdim=True)
+        # Directions behind the image plane are never seen by a pinhole camera.
+        dirs = torch.where(cos > 1e-2, dirs / cos.clamp_min(1e-2), dirs)
+        rgbs = []
+        for i in range(0, dirs.shape[0], self.config.render_chunk_size):
+            chunk_dirs = dirs[i:i + self.config.render_chunk_size]
+            rgbs.append(self.render_sky(origin.expand_as(chunk_dirs),
+                                        chunk_dirs,
+                                        far.reshape(1).expand(chunk_dirs.shape[0]),
+                                        cam_dir.expand_as(chunk_dirs)))
+        return torch.cat(rgbs).float().reshape(height, width, 3).permute(2, 0, 1)[None]
+
+    def lookup_sky(self, batch):
+        """Sky colors [N, 3] of rays sharing a camera, from its baked texture.
+
+    The texture is baked on the first call for a camera and reused while the
+    following batches (ie, the other chunks of the same image) come from it and
+    the sky network is unchanged.
+    """
+        origin = batch['origins'].reshape(-1, 3)[0]
+        cam_dir = batch['cam_dirs'].reshape(-1, 3)[0]
+        far = batch['far'].reshape(-1)[0]
+        key = (tuple(torch.cat([origin, cam_dir, far[None]]).tolist()),
+               tuple(p._version for p in self.skynerf.parameters()))
+        if self._sky_lut is None or self._sky_lut[0] != key:
+            self._sky_lut = (key, self.bake_sky(origin, cam_dir, far))
+        dirs = F.normalize(batch['directions'].reshape(-1, 3), dim=-1)
+        theta = torch.atan2(dirs[:, 1], dirs[:, 0])
+        phi = torch.asin(dirs[:, 2].clamp(-1, 1))
+        grid = torch.stack([theta / np.pi, phi / (np.pi / 2)], dim=-1)
+        rgbs = F.grid_sample(self._sky_lut[1], grid[None, None].float(), mode='bilinear', align_corners=True)
+        return rgbs[0, :, 0].T
+
+    def occupied(self, batch, tdist):
+        """Whether the midpoints of the intervals `tdist` are in occupied grid cells."""
+        t_mid = (tdist[..., 1:] + tdist[..., :-1]) / 2
+        points = batch['origins'][..., None, :] + t_mid[..., None] * batch['directions'][..., None, :]
+        return self.occ_grid.query(coord.contract(points) / 2)
+
+    def march_mlp(self, mlp, rand, means, stds, tdist, batch, glo_vec=None, compute_normals=None,
+                  occupied=None):
+        """Evaluates `mlp` front to back, culling samples of opaque rays and empty space.
+
+    Samples are evaluated in groups of `early_stop_group_size` along each ray.
+    After every group, rays whose transmittance dropped below
+    `early_stop_transmittance` are removed from the set of rays evaluated next,
+    and their remaining samples get zero density and outputs. This changes the
+    rendering weights of every sample by less than the threshold. Samples that
+    `occupied` marks as empty are never evaluated and get zero density and
+    outputs too. Without early termination all samples form a single group.
+
+    Args:
+      mlp: the MLP to evaluate.
+      rand: if random.
+      means: [num_rays, n, ..., 3], coordinate means.
+      stds: [num_rays, n, ...], coordinate stds.
+      tdist: [num_rays, n + 1], metric distances of the sample intervals.
+      batch: the rays the samples belong to.
+      glo_vec: [num_rays, num_glo_features], or None.
+      compute_normals: bool, passed on to `mlp`.
+      occupied: [num_rays, n] bool, samples to evaluate, or None for all.
+
+    Returns:
+      The output of `mlp` as if it had been evaluated at every sample.
+    """
+        num_rays, num_samples = tdist.shape[0], tdist.shape[-1] - 1
+        device = tdist.device
+        delta = (tdist[..., 1:] - tdist[..., :-1]) * torch.norm(batch['directions'], dim=-1, keepdim=True)
+        if self.early_stop_transmittance > 0:
+            min_log_trans = np.log(self.early_stop_transmittance)
+            group_size = self.early_stop_group_size
+        else:
+            min_log_trans = -np.inf
+            group_size = num_samples
+        log_trans = torch.zeros(num_rays, device=device)
+        alive = torch.arange(num_rays, device=device)
+
+        def evaluate(ray_idx, sample_idx):
+            # Each selected sample is evaluated as a ray of its own.
+            gather = lambda x: None if x is None else x[ray_idx]
+            return mlp(
+                rand,
+                means[ray_idx, sample_idx, None], stds[ray_idx, sample_idx, None],
+                viewdirs=gather(batch['viewdirs']) if self.use_viewdirs else None,
+                imageplane=gather(batch.get('imageplane')),
+                glo_vec=gather(glo_vec),
+                exposure=gather(batch.get('exposure_values')),
+                compute_normals=compute_normals,
+            )
+
+        def allocate(results):
+            return {k: None if v is None else v.new_zeros((num_rays, num_samples) + v.shape[2:])
+                    for k, v in results.items()}
+
+        ray_results = None
+        for start in range(0, num_samples, group_size):
+            if alive.numel() == 0:
+                break
+            stop = min(start + group_size, num_samples)
+            if occupied is None:
+                keep = torch.ones((alive.numel(), stop - start), dtype=torch.bool, device=device)
+            else:
+                keep = occupied[alive, start:stop]
+            ray_idx, sample_idx = torch.nonzero(keep, as_tuple=True)
+            ray_idx, sample_idx = alive[ray_idx], sample_idx + start
+            if ray_idx.numel() > 0:
+                group_results = evaluate(ray_idx, sample_idx)
+                if ray_results is None:
+                    ray_results = allocate(group_results)
+                for k, v in group_results.items():
+                    if v is not None:
+                        ray_results[k][ray_idx, sample_idx] = v[:, 0].to(ray_results[k].dtype)
+                density = group_results['density'][:, 0].to(log_trans.dtype)
+                log_trans.index_add_(0, ray_idx, -density * delta[ray_idx, sample_idx])
+            alive = alive[log_trans[alive] > min_log_trans]
+        if ray_results is None:
+            # Every sample was culled, evaluate one only for the output shapes.
+            zero = torch.zeros(1, dtype=torch.long, device=device)
+            ray_results = allocate(evaluate(zero, zero))
+        return ray_results
+
+class OccupancyGrid(nn.Module):
+    """A bitfield over contracted space marking where the scene has density.
+
+  Densities seen at training samples are max-pooled into the cells of a
+  [resolution]^3 grid over the contracted [-1, 1]^3 cube. Every refresh the
+  pooled densities are max-reduced across processes, merged into a decaying
+  running max and thresholded into the bitfield. Cells no sample has landed in
+  yet are kept occupied. Each process observes its own samples, so DDP must not
+  broadcast these buffers from the first process (train.py turns
+  broadcast_buffers off). The step counter is kept on the host, so checking it
+  doesn't synchronize with the device, and saved as extra state.
+  """
+
+    def __init__(self, resolution, threshold=0.01, decay=0.95):
+        super().__init__()
+        self.resolution = resolution
+        self.threshold = threshold
+        self.decay = decay
+        self.register_buffer('density', torch.full((resolution ** 3,), torch.inf))
+        self.register_buffer('pending', torch.zeros(resolution ** 3))
+        self.register_buffer('bitfield', torch.ones(resolution ** 3, dtype=torch.bool))
+        self.num_steps = 0
+
+    def get_extra_state(self):
+        return {'num_steps': self.num_steps}
+
+    def set_extra_state(self, state):
+        self.num_steps = state['num_steps']
+
+    def cell_index(self, x):
+        """Linear cell index of points `x` in [-1, 1]^3."""
+        ijk = ((x + 1) / 2 * self.resolution).long().clamp(0, self.resolution - 1)
+        return (ijk[..., 0] * self.resolution + ijk[..., 1]) * self.resolution + ijk[..., 2]
+
+    def query(self, x):
+        """Whether the cells containing points `x` in [-1, 1]^3 are occupied."""
+        return self.bitfield[self.cell_index(x)]
+
+    @torch.no_grad()
+    def observe(self, x, density):
+        """Pools densities at points `x` in [-1, 1]^3 until the next refresh."""
+        self.pending.scatter_reduce_(0, self.cell_index(x).reshape(-1),
+                                     density.detach().reshape(-1).float(), reduce='amax')
+
+    @torch.no_grad()
+    def step(self, update_every):
+        """Counts a training step, refreshing the bitfield every `update_every`."""
+        self.num_steps += 1
+        if self.num_steps % update_every != 0:
+            return
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.pending, op=torch.distributed.ReduceOp.MAX)
+        seen = self.pending > 0
+        self.density.copy_(torch.where(
+            seen & torch.isinf(self.density), self.pending,
+            torch.maximum(self.density * self.decay, self.pending)))
+        self.pending.zero_()
+        self.bitfield.copy_(self.density > self.threshold)
+
+    def occupancy(self):
+        """Fraction of occupied cells."""
+        return self.bitfield.float().mean().item()
+
+
 class MLP(nn.Module):
     """A PosEnc MLP."""
     bottleneck_width: int = 256  # The width of the bottleneck vector.
@@ -518,7 +792,8 @@ class MLP(nn.Module):
                 imageplane=None,
                 glo_vec=None,
                 exposure=None,
-                no_warp=False):
+                no_warp=False,
+                compute_normals=None):
         """Evaluate the MLP.
 
     Args:
@@ -535,6 +810,8 @@ class MLP(nn.Module):
         learned vignette mapping.
       glo_vec: [..., num_glo_features], The GLO vector for each ray.
       exposure: [..., 1], exposure value (shutter_speed * ISO) for each ray.
+      compute_normals: bool, if False skip the density gradient normals. If None,
+        they are computed while gradients are enabled, and skipped otherwise.
 
     Returns:
       rgb: [..., num_rgb_channels].
@@ -543,7 +820,13 @@ class MLP(nn.Module):
       normals_pred: [..., 3], or None.
       roughness: [..., 1], or None.
     """
-        if self.disable_density_normals:
+        grad_enabled = torch.is_grad_enabled()
+        if compute_normals is None:
+            compute_normals = grad_enabled
+        # Colors depend on the normals when they are used to shade.
+        if (self.use_reflections or self.use_n_dot_v) and not self.enable_pred_normals:
+            compute_normals = True
+        if self.disable_density_normals or not compute_normals:
             raw_density, x, means_contract = self.predict_density(means, stds, rand=rand, no_warp=no_warp)
             raw_grad_density = None
             normals = None
@@ -552,12 +835,13 @@ class MLP(nn.Module):
                 means.requires_grad_(True)
                 raw_density, x, means_contract = self.predict_density(means, stds, rand=rand, no_warp=no_warp)
                 d_output = torch.ones_like(raw_density, requires_grad=False, device=raw_density.device)
+                # Only keep the graph of the gradient if it is backpropagated through.
                 raw_grad_density = torch.autograd.grad(
                     outputs=raw_density,
                     inputs=means,
                     grad_outputs=d_output,
-                    create_graph=True,
-                    retain_graph=True,
+                    create_graph=grad_enabled,
+                    retain_graph=grad_enabled,
                     only_inputs=True)[0]
             raw_grad_density = raw_grad_density.mean(-2)
             # Compute normal vectors as negative normalized density gradient.
@@ -700,13 +984,7 @@ class Embedder:
         self.create_embedding_fn()
 
     def create_embedding_fn(self):
-        embed_fns = []
         d = self.kwargs['input_dims']
-        out_dim = 0
-        if self.kwargs['include_input']:
-            embed_fns.append(lambda x: x)
-            out_dim += d
-        
         max_freq = self.kwargs['max_freq_log2']
         N_freqs = self.kwargs['num_freqs']
 
@@ -715,16 +993,20 @@ class Embedder:
         else:
             freq_bands = torch.linspace(2.**0., 2.**max_freq, N_freqs)
 
-        for freq in freq_bands:
-            for p_fn in self.kwargs['periodic_fns']:
-                embed_fns.append(lambda x, p_fn=p_fn, freq=freq: p_fn(x * freq))
-                out_dim += d
-        
-        self.embed_fns = embed_fns
-        self.out_dim = out_dim
+        self.freq_bands = freq_bands
+        self.periodic_fns = self.kwargs['periodic_fns']
+        self.out_dim = d * (int(self.kwargs['include_input']) + N_freqs * len(self.periodic_fns))
 
     def embed(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        """Encodes every frequency at once, channels ordered as
+    [x, p_0(f_0 x), p_1(f_0 x), p_0(f_1 x), ...]."""
+        if self.freq_bands.device != inputs.device:
+            self.freq_bands = self.freq_bands.to(inputs.device)
+        x = inputs[..., None, :] * self.freq_bands[:, None].to(inputs.dtype)
+        outputs = torch.stack([p_fn(x) for p_fn in self.periodic_fns], dim=-2).flatten(-3)
+        if self.kwargs['include_input']:
+            outputs = torch.cat([inputs, outputs], -1)
+        return outputs
         
 def get_embedder(multires, input_dims=3):
     embed_kwargs = {
@@ -913,7 +1195,9 @@ def render_image(model,
                  config,
                  verbose=True,
                  return_weights=False,
-                 eval_camidx=0):
+                 eval_camidx=0,
+                 compute_normals=None,
+                 local=False):
     """Render all the pixels of an image (in test mode).
 
   Args:
@@ -922,6 +1206,10 @@ def render_image(model,
     batch: a `Rays` pytree, the rays to be rendered.
     rand: if random
     config: A Config class.
+    compute_normals: bool, whether to render normals. They need density
+      gradients, so by default (None) they are skipped under torch.no_grad().
+    local: bool, if True this process renders the whole image by itself,
+      without communicating with other processes.
 
   Returns:
     rgb: rendered color image.
@@ -934,23 +1222,20 @@ def render_image(model,
     num_rays = height * width
     batch = {k: v.reshape((num_rays, -1)) for k, v in batch.items() if v is not None}
 
-    global_rank = accelerator.process_index
-    chunks = []
-    idx0s = tqdm(range(0, num_rays, config.render_chunk_size),
-                 desc="Rendering chunk", leave=False,
-                 disable=not (accelerator.is_main_process and verbose))
+    global_rank = 0 if local else accelerator.process_index
+    num_processes = 1 if local else accelerator.num_processes
 
-    for i_chunk, idx0 in enumerate(idx0s):
-        chunk_batch = tree_map(lambda r: r[idx0:idx0 + config.render_chunk_size], batch)
+    def render_chunk(idx0, idx1):
+        chunk_batch = tree_map(lambda r: r[idx0:idx1], batch)
         actual_chunk_size = chunk_batch['origins'].shape[0]
-        rays_remaining = actual_chunk_size % accelerator.num_processes
+        rays_remaining = actual_chunk_size % num_processes
         if rays_remaining != 0:
-            padding = accelerator.num_processes - rays_remaining
+            padding = num_processes - rays_remaining
             chunk_batch = tree_map(lambda v: torch.cat([v, torch.zeros_like(v[-padding:])], dim=0), chunk_batch)
         else:
             padding = 0
         # After padding the number of chunk_rays is always divisible by host_count.
-        rays_per_host = chunk_batch['origins'].shape[0] // accelerator.num_processes
+        rays_per_host = chunk_batch['origins'].shape[0] // num_processes
         start, stop = global_rank * rays_per_host, (global_rank + 1) * rays_per_host
         chunk_batch = tree_map(lambda r: r[start:stop], chunk_batch)
 
@@ -960,10 +1245,19 @@ def render_image(model,
                                                   train_frac=train_frac,
                                                   compute_extras=True,
                                                   zero_glo=True,
-                                                  eval_camidx=eval_camidx)
+                                                  eval_camidx=eval_camidx,
+                                                  compute_normals=compute_normals)
+        if return_weights:
+            ray_history = [{k: ray_history[-1][k] for k in ['weights', 'coord']}]
+        return chunk_renderings, ray_history, padding
 
-        gather = lambda v: accelerator.gather(v.contiguous())[:-padding] \
-            if padding > 0 else accelerator.gather(v.contiguous())
+    def gather_chunk(chunk):
+        chunk_renderings, ray_history, padding = chunk
+        if local:
+            gather = lambda v: v
+        else:
+            gather = lambda v: accelerator.gather(v.contiguous())[:-padding] \
+                if padding > 0 else accelerator.gather(v.contiguous())
         # Unshard the renderings.
         chunk_renderings = tree_map(gather, chunk_renderings)
 
@@ -976,7 +1270,11 @@ def render_image(model,
         if return_weights:
             chunk_rendering['weights'] = gather(ray_history[-1]['weights'])
             chunk_rendering['coord'] = gather(ray_history[-1]['coord'])
-        chunks.append(chunk_rendering)
+        return chunk_rendering
+
+    tuner = chunking.get_tuner('render_image', config, accelerator, local=local)
+    chunks = tuner.map(render_chunk, num_rays, gather_fn=gather_chunk,
+                       desc="Rendering chunk", verbose=verbose)
 
     # Concatenate all chunks within each leaf of a single pytree.
     rendering = {}
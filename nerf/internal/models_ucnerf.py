@@ -87,6 +87,7 @@ class Model(nn.Module):
             train_frac,
             compute_extras,
             zero_glo=True,
+            compute_normals=None,
     ):
         """The mip-NeRF Model.
 
@@ -96,6 +97,8 @@ class Model(nn.Module):
       train_frac: float in [0, 1], what fraction of training is complete.
       compute_extras: bool, if True, compute extra quantities besides color.
       zero_glo: bool, if True, when using GLO pass in vector of zeros.
+      compute_normals: bool, whether the MLPs compute density gradient normals,
+        if None only while gradients are enabled.
 
     Returns:
       ret: list, [*(rgb, distance, acc)]
@@ -212,6 +215,7 @@ class Model(nn.Module):
                 imageplane=batch.get('imageplane'),
                 glo_vec=None if is_prop else glo_vec,
                 exposure=batch.get('exposure_values'),
+                compute_normals=compute_normals,
             )
             if self.config.gradient_scaling:
                 ray_results['rgb'], ray_results['density'] = train_utils.GradientScaler.apply(
@@ -462,7 +466,8 @@ class MLP(nn.Module):
                 imageplane=None,
                 glo_vec=None,
                 exposure=None,
-                no_warp=False):
+                no_warp=False,
+                compute_normals=None):
         """Evaluate the MLP.
 
     Args:
@@ -479,6 +484,8 @@ class MLP(nn.Module):
         learned vignette mapping.
       glo_vec: [..., num_glo_features], The GLO vector for each ray.
       exposure: [..., 1], exposure value (shutter_speed * ISO) for each ray.
+      compute_normals: bool, if False skip the density gradient normals. If None,
+        they are computed while gradients are enabled, and skipped otherwise.
 
     Returns:
       rgb: [..., num_rgb_channels].
@@ -487,7 +494,13 @@ class MLP(nn.Module):
       normals_pred: [..., 3], or None.
       roughness: [..., 1], or None.
     """
-        if self.disable_density_normals:
+        grad_enabled = torch.is_grad_enabled()
+        if compute_normals is None:
+            compute_normals = grad_enabled
+        # Colors depend on the normals when they are used to shade.
+        if (self.use_reflections or self.use_n_dot_v) and not self.enable_pred_normals:
+            compute_normals = True
+        if self.disable_density_normals or not compute_normals:
             raw_density, x, means_contract = self.predict_density(means, stds, rand=rand, no_warp=no_warp)
             raw_grad_density = None
             normals = None
@@ -496,12 +509,13 @@ class MLP(nn.Module):
                 means.requires_grad_(True)
                 raw_density, x, means_contract = self.predict_density(means, stds, rand=rand, no_warp=no_warp)
                 d_output = torch.ones_like(raw_density, requires_grad=False, device=raw_density.device)
+                # Only keep the graph of the gradient if it is backpropagated through.
                 raw_grad_density = torch.autograd.grad(
                     outputs=raw_density,
                     inputs=means,
                     grad_outputs=d_output,
-                    create_graph=True,
-                    retain_graph=True,
+                    create_graph=grad_enabled,
+                    retain_graph=grad_enabled,
                     only_inputs=True)[0]
             raw_grad_density = raw_grad_density.mean(-2)
             # Compute normal vectors as negative normalized density gradient.
@@ -647,7 +661,8 @@ def render_image(model,
                  train_frac,
                  config,
                  verbose=True,
-                 return_weights=False):
+                 return_weights=False,
+                 compute_normals=None):
     """Render all the pixels of an image (in test mode).
 
   Args:
@@ -656,6 +671,8 @@ def render_image(model,
     batch: a `Rays` pytree, the rays to be rendered.
     rand: if random
     config: A Config class.
+    compute_normals: bool, whether to render normals. They need density
+      gradients, so by default (None) they are skipped under torch.no_grad().
 
   Returns:
     rgb: rendered color image.
@@ -693,7 +710,8 @@ def render_image(model,
                                                   chunk_batch,
                                                   train_frac=train_frac,
                                                   compute_extras=True,
-                                                  zero_glo=True)
+                                                  zero_glo=True,
+                                                  compute_normals=compute_normals)
 
         gather = lambda v: accelerator.gather(v.contiguous())[:-padding] \
             if padding > 0 else accelerator.gather(v.contiguous())
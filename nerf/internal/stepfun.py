@@ -18,10 +18,13 @@ def searchsorted(a, v):
     range [a[0], a[-1]] in which case idx_lo and idx_hi are both the first or
     last index of a.
   """
-    i = torch.arange(a.shape[-1], device=a.device)
-    v_ge_a = v[..., None, :] >= a[..., :, None]
-    idx_lo = torch.max(torch.where(v_ge_a, i[..., :, None], i[..., :1, None]), -2).values
-    idx_hi = torch.min(torch.where(~v_ge_a, i[..., :, None], i[..., -1:, None]), -2).values
+    batch_shape = torch.broadcast_shapes(a.shape[:-1], v.shape[:-1])
+    a = a.expand(batch_shape + a.shape[-1:]).contiguous()
+    v = v.expand(batch_shape + v.shape[-1:]).contiguous()
+    # Number of entries of a that are <= v, i.e. one past the last a[i] <= v.
+    idx = torch.searchsorted(a, v, right=True)
+    idx_lo = torch.clamp_min(idx - 1, 0)
+    idx_hi = torch.clamp_max(idx, a.shape[-1] - 1)
     return idx_lo, idx_hi
 
 
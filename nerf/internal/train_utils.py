@@ -55,6 +55,33 @@ def img_warping(ref_pose, src_pose, virtual_pose_ref_depth, virtual_intrinsic):
     return pts_in_tgt, mask
 
 
+def img_warping_table(ref_pose, src_pose, virtual_pose_ref_depth, virtual_intrinsic, max_size):
+    """Compact table of the reference pixels that img_warping() keeps valid.
+
+  Args:
+    ref_pose, src_pose, virtual_pose_ref_depth, virtual_intrinsic: as in
+      img_warping().
+    max_size: int, maximum number of table rows, 0 for no limit. Larger valid
+      sets are uniformly subsampled, once, so sampling from the table is
+      unbiased but only ever reaches that subset.
+
+  Returns:
+    table: [min(count, max_size), 2] int32 array of linear (y * width + x)
+      pixel indices, reference pixel first, rounded warped source pixel second.
+    count: int, number of valid reference pixels.
+  """
+    pts_in_src, mask = img_warping(ref_pose, src_pose, virtual_pose_ref_depth, virtual_intrinsic)
+    ht, wd = mask.shape
+    ref_idx = torch.nonzero(mask.reshape(-1).to(torch.bool))[:, 0]
+    count = ref_idx.shape[0]
+    if 0 < max_size < count:
+        ref_idx = ref_idx[torch.randperm(count)[:max_size].sort().values]
+    src_xy = torch.round(pts_in_src.reshape(-1, 2)[ref_idx]).long()
+    src_idx = src_xy[:, 1] * wd + src_xy[:, 0]
+    table = torch.stack([ref_idx, src_idx], dim=-1).numpy().astype(np.int32)
+    return table, count
+
+
 def img_warping_for_depth(ref_pose, src_pose, virtual_pose_ref_depth, virtual_intrinsic):
     ref_depth = virtual_pose_ref_depth
     ref_pose = ref_pose
@@ -10,8 +10,6 @@ from PIL import Image
 import collections
 import random
 from internal import vis
-from matplotlib import cm
-import matplotlib.pyplot as plt
 import matplotlib as mpl
 
 class Timing:
@@ -115,13 +113,23 @@ def save_img_u8(img, pth):
         pth, 'PNG')
 
 
+# Sampled once on import, pyplot and colormap objects are not thread-safe and
+# save_img_f32() runs on the threads of an ImageWriter.
+_MAGMA_R = mpl.colormaps['magma_r'](np.arange(256))[:, :3]
+
+
 def save_img_f32(depthmap, pth, p=0.5):
-    """Save an image (probably a depthmap) to disk as a float32 TIFF."""
+    """Save an image (probably a depthmap) to disk as a float32 TIFF.
+
+  A magma_r visualization is saved next to it as a PNG.
+  """
     Image.fromarray(np.nan_to_num(depthmap).astype(np.float32)).save(pth, 'TIFF')
 
     constant_max = np.percentile(depthmap, 99)
-    normalizer = mpl.colors.Normalize(vmin=np.percentile(depthmap, 0)-0.1, vmax=np.percentile(depthmap[depthmap!=constant_max], 99))
-    mapper = cm.ScalarMappable(norm=normalizer, cmap='magma_r')
-    depth_vis_volor = (mapper.to_rgba(depthmap)[:, :, :3] * 255).astype(np.uint8)
-
-    plt.imsave(pth[:-4]+'png', depth_vis_volor)
+    vmin = np.percentile(depthmap, 0) - 0.1
+    vmax = np.percentile(depthmap[depthmap != constant_max], 99)
+    # Like Colormap.__call__ on normalized values, out of range ones are clipped.
+    normalized = np.nan_to_num((depthmap - vmin) / (vmax - vmin))
+    idx = np.clip((normalized * 256).astype(np.int64), 0, 255)
+    depth_vis_color = (_MAGMA_R[idx] * 255).astype(np.uint8)
+    Image.fromarray(depth_vis_color).save(pth[:-4] + 'png', 'PNG')
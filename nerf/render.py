@@ -1,19 +1,23 @@
 import glob
 import logging
 import os
+import queue
 import sys
+import threading
 import time
 
 from absl import app
 import gin
 from internal import configs
 from internal import datasets
+from internal import frame_queue
+from internal import image_writer
 from internal import models
 from internal import train_utils
 from internal import checkpoints
 from internal import utils
 from internal import vis
-from matplotlib import cm
+import matplotlib as mpl
 import mediapy as media
 import torch
 import numpy as np
@@ -24,12 +28,108 @@ from torch.utils._pytree import tree_map
 configs.define_common_flags()
 
 
-def create_videos(config, base_dir, out_dir, out_name, num_frames):
-    """Creates videos out of the images saved to disk."""
+VIDEO_KEYS = ['color', 'normals', 'acc', 'distance_mean', 'depth']
+
+
+def video_prefix_for(config, out_name):
     names = [n for n in config.exp_path.split("/") if n]
     # Last two parts of checkpoint path are experiment name and scene name.
     exp_name, scene_name = names[-2:]
-    video_prefix = f'{scene_name}_{exp_name}_{out_name}'
+    return f'{scene_name}_{exp_name}_{out_name}'
+
+
+def depth_limits(config, depth_frame):
+    """The depth range videos are colorized with, taken from one frame."""
+    p = config.render_dist_percentile
+    return np.percentile(depth_frame.flatten(), [p, 100 - p])
+
+
+def video_frame(k, img, lo, hi):
+    """Turns an output in [0, 1] (or a distance) into a uint8 video frame."""
+    if k.startswith('distance') or k == 'depth':
+        # img = config.render_dist_curve_fn(img)
+        # img = np.clip((img - np.minimum(lo, hi)) / np.abs(hi - lo), 0, 1)
+        # img = cm.get_cmap('turbo')(img)[..., :3]
+        depth_curve_fn = lambda x: -np.log(x + np.finfo(np.float32).eps)
+        img = vis.visualize_cmap(img, np.ones_like(img), mpl.colormaps['turbo'], lo, hi, curve_fn=depth_curve_fn)
+    return (np.clip(np.nan_to_num(img), 0., 1.) * 255.).astype(np.uint8)
+
+
+class VideoSink:
+    """Encodes rendered frames into one video per output as they are produced.
+
+  Every output has its own encoder thread fed through a bounded queue, so
+  colorizing and encoding overlap with rendering the next frames. Frames must
+  be added in order. Like create_videos(), distances are colorized with the
+  range of the first frame that has 'distance_mean', frames without it use
+  their own range.
+  """
+
+    def __init__(self, config, base_dir, video_prefix, max_pending=4):
+        self.config = config
+        self.base_dir = base_dir
+        self.video_prefix = video_prefix
+        self.max_pending = max_pending
+        self.limits = (None, None)
+        self.streams = {}
+        self.errors = []
+        utils.makedirs(base_dir)
+
+    def _encode(self, k, frames):
+        video_file = os.path.join(self.base_dir, f'{self.video_prefix}_{k}.mp4')
+        print(f'Making video {video_file}...')
+        try:
+            with imageio.get_writer(video_file, fps=self.config.render_video_fps) as writer:
+                while True:
+                    img = frames.get()
+                    if img is None:
+                        return
+                    writer.append_data(video_frame(k, img, *self.limits))
+        except Exception as e:  # pylint: disable=broad-except
+            self.errors.append(e)
+            # Keep draining so that add() never blocks on a dead stream.
+            while frames.get() is not None:
+                pass
+
+    def add(self, frame):
+        """Queues a frame, a dict of outputs keyed by VIDEO_KEYS."""
+        if self.limits == (None, None) and 'distance_mean' in frame:
+            self.limits = tuple(depth_limits(self.config, frame['distance_mean']))
+        if not self.streams and frame:
+            print(f'Video shape is {next(iter(frame.values())).shape[:2]}')
+        for k, img in frame.items():
+            if k not in self.streams:
+                frames = queue.Queue(maxsize=self.max_pending)
+                thread = threading.Thread(target=self._encode, args=(k, frames), daemon=True)
+                thread.start()
+                self.streams[k] = (frames, thread)
+            self.streams[k][0].put(img)
+
+    def close(self):
+        """Finishes every video, raising the first encoding error if any."""
+        for frames, _ in self.streams.values():
+            frames.put(None)
+        for _, thread in self.streams.values():
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def load_frame(path_fn, idx_str):
+    """Reads back the outputs of a frame saved to disk, keyed by VIDEO_KEYS."""
+    frame = {}
+    for k in VIDEO_KEYS:
+        file_ext = 'png' if k in ['color', 'normals'] else 'tiff'
+        img_file = path_fn(f'{k}_{idx_str}.{file_ext}')
+        if utils.file_exists(img_file):
+            img = utils.load_img(img_file)
+            frame[k] = img / 255. if file_ext == 'png' else img
+    return frame
+
+
+def create_videos(config, base_dir, out_dir, out_name, num_frames):
+    """Creates videos out of the images saved to disk."""
+    video_prefix = video_prefix_for(config, out_name)
 
     zpad = max(3, len(str(num_frames - 1)))
     idx_to_str = lambda idx: str(idx).zfill(zpad)
@@ -40,14 +140,11 @@ def create_videos(config, base_dir, out_dir, out_name, num_frames):
     depth_file = os.path.join(out_dir, f'distance_mean_{idx_to_str(0)}.tiff')
     depth_frame = utils.load_img(depth_file)
     shape = depth_frame.shape
-    p = config.render_dist_percentile
-    distance_limits = np.percentile(depth_frame.flatten(), [p, 100 - p])
     # lo, hi = [config.render_dist_curve_fn(x) for x in distance_limits]
-    depth_curve_fn = lambda x: -np.log(x + np.finfo(np.float32).eps)
-    lo, hi = distance_limits
+    lo, hi = depth_limits(config, depth_frame)
     print(f'Video shape is {shape[:2]}')
 
-    for k in ['color', 'normals', 'acc', 'distance_mean', 'depth']:
+    for k in VIDEO_KEYS:
         video_file = os.path.join(base_dir, f'{video_prefix}_{k}.mp4')
         file_ext = 'png' if k in ['color', 'normals'] else 'tiff'
         file0 = os.path.join(out_dir, f'{k}_{idx_to_str(0)}.{file_ext}')
@@ -65,15 +162,7 @@ def create_videos(config, base_dir, out_dir, out_name, num_frames):
             img = utils.load_img(img_file)
             if k in ['color', 'normals']:
                 img = img / 255.
-            elif k.startswith('distance') or k=='depth':
-                # img = config.render_dist_curve_fn(img)
-                # img = np.clip((img - np.minimum(lo, hi)) / np.abs(hi - lo), 0, 1)
-                # img = cm.get_cmap('turbo')(img)[..., :3]
-
-                img = vis.visualize_cmap(img, np.ones_like(img), cm.get_cmap('turbo'), lo, hi, curve_fn=depth_curve_fn)
-
-            frame = (np.clip(np.nan_to_num(img), 0., 1.) * 255.).astype(np.uint8)
-            writer.append_data(frame)
+            writer.append_data(video_frame(k, img, lo, hi))
         writer.close()
 
 
@@ -132,36 +221,72 @@ def main(unused_argv):
     zpad = max(3, len(str(dataset.size - 1)))
     idx_to_str = lambda idx: str(idx).zfill(zpad)
 
-    for idx in range(dataset.size):
+    if config.render_stream_video and config.render_frame_parallel:
+        raise ValueError('render_stream_video needs frames in order, it cannot be '
+                         'combined with render_frame_parallel.')
+    if not (config.render_save_frames or config.render_stream_video):
+        raise ValueError('Nothing to output, set render_save_frames or render_stream_video.')
+    sink = None
+    if config.render_stream_video and accelerator.is_main_process:
+        sink = VideoSink(config, config.render_dir, video_prefix_for(config, out_name))
+
+    writer = image_writer.ImageWriter(config)
+    if config.render_frame_parallel:
+        # Every process renders and writes whole frames taken from a shared queue.
+        frames = frame_queue.FrameQueue(path_fn('.frame_queue'), dataset.size, accelerator)
+    else:
+        frames = range(dataset.size)
+    for idx in frames:
         # If current image and next image both already exist, skip ahead.
         idx_str = idx_to_str(idx)
         curr_file = path_fn(f'color_{idx_str}.png')
         if utils.file_exists(curr_file):
-            logger.info(f'Image {idx + 1}/{dataset.size} already exists, skipping')
+            logger.info(f'Image {idx + 1}/{dataset.size} already exists, skipping', main_process_only=False)
+            if sink is not None:
+                sink.add(load_frame(path_fn, idx_str))
             continue
-        batch, eval_camidx = next(dataiter)
+        if config.render_frame_parallel:
+            batch, eval_camidx = dataset[idx]
+        else:
+            batch, eval_camidx = next(dataiter)
         batch = tree_map(lambda x: x.to(accelerator.device) if x is not None else None, batch)
-        logger.info(f'Evaluating image {idx + 1}/{dataset.size}')
+        logger.info(f'Evaluating image {idx + 1}/{dataset.size}', main_process_only=False)
         eval_start_time = time.time()
         rendering = models.render_image(model, accelerator,
-                                        batch, False, 1, config, eval_camidx=torch.tensor(0))
+                                        batch, False, 1, config, eval_camidx=torch.tensor(0),
+                                        compute_normals=config.render_normals,
+                                        local=config.render_frame_parallel)
 
-        logger.info(f'Rendered in {(time.time() - eval_start_time):0.3f}s')
+        logger.info(f'Rendered in {(time.time() - eval_start_time):0.3f}s', main_process_only=False)
 
-        if accelerator.is_main_process:  # Only record via host 0.
+        # Only record via host 0, unless every host renders its own frames.
+        if accelerator.is_main_process or config.render_frame_parallel:
             rendering['rgb'] = postprocess_fn(rendering['rgb'])
             rendering = tree_map(lambda x: x.detach().cpu().numpy() if x is not None else None, rendering)
-            utils.save_img_u8(rendering['rgb'], path_fn(f'color_{idx_str}.png'))
+            if sink is not None:
+                frame = {k: rendering[k] for k in ['acc', 'distance_mean', 'depth']}
+                frame['color'] = rendering['rgb']
+                if 'normals' in rendering:
+                    frame['normals'] = rendering['normals'] / 2. + 0.5
+                sink.add(frame)
+            if not config.render_save_frames:
+                continue
+            writer.save_img_u8(rendering['rgb'], path_fn(f'color_{idx_str}.png'))
             if 'normals' in rendering:
-                utils.save_img_u8(rendering['normals'] / 2. + 0.5,
-                                  path_fn(f'normals_{idx_str}.png'))
-            utils.save_img_f32(rendering['distance_mean'],
-                               path_fn(f'distance_mean_{idx_str}.tiff'))
-            utils.save_img_f32(rendering['depth'],
-                               path_fn(f'depth_{idx_str}.tiff'))
-            utils.save_img_f32(rendering['acc'], path_fn(f'acc_{idx_str}.tiff'))
+                writer.save_img_u8(rendering['normals'] / 2. + 0.5,
+                                   path_fn(f'normals_{idx_str}.png'))
+            writer.save_img_f32(rendering['distance_mean'],
+                                path_fn(f'distance_mean_{idx_str}.tiff'))
+            writer.save_img_f32(rendering['depth'],
+                                path_fn(f'depth_{idx_str}.tiff'))
+            writer.save_img_f32(rendering['acc'], path_fn(f'acc_{idx_str}.tiff'))
+    writer.close()
+    if sink is not None:
+        sink.close()
+        logger.info('Videos encoded while rendering.')
+    accelerator.wait_for_everyone()
     num_files = len(glob.glob(path_fn('acc_*.tiff')))
-    if accelerator.is_main_process and num_files == dataset.size:
+    if accelerator.is_main_process and sink is None and num_files == dataset.size:
         logger.info(f'All files found, creating videos.')
         create_videos(config, config.render_dir, out_dir, out_name, dataset.size)
     accelerator.wait_for_everyone()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the `internal` package the way the entry points do, from nerf/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+from internal import camera_utils
+
+
+def _cameras(num_cameras, rng):
+    pixtocams = np.stack([
+        np.linalg.inv(camera_utils.intrinsic_matrix(f, f, 32 + rng.normal(), 24 + rng.normal()))
+        for f in rng.uniform(40, 80, num_cameras)])
+    rotations = np.linalg.qr(rng.normal(size=(num_cameras, 3, 3)))[0]
+    camtoworlds = np.concatenate([rotations, rng.normal(size=(num_cameras, 3, 1))], axis=-1)
+    return pixtocams, camtoworlds
+
+
+@pytest.mark.parametrize('camtype', [camera_utils.ProjectionType.PERSPECTIVE,
+                                     camera_utils.ProjectionType.FISHEYE,
+                                     'panoroma'])
+def test_pixels_to_rays_torch_matches_numpy(camtype):
+    rng = np.random.default_rng(0)
+    pixtocams, camtoworlds = _cameras(4, rng)
+    # The panorama path indexes [3, ...] stacks of 3D pixel arrays, like patches.
+    pix_x_int = rng.integers(0, 64, (8, 2, 2))
+    pix_y_int = rng.integers(0, 48, (8, 2, 2))
+    cam_idx = rng.integers(0, 4, (8, 1, 1))
+    expected = camera_utils.pixels_to_rays(
+        pix_x_int, pix_y_int, pixtocams[cam_idx], camtoworlds[cam_idx], camtype=camtype)
+    rays = camera_utils.pixels_to_rays_torch(
+        torch.from_numpy(pix_x_int), torch.from_numpy(pix_y_int),
+        torch.from_numpy(pixtocams[cam_idx]), torch.from_numpy(camtoworlds[cam_idx]),
+        camtype=camtype)
+    for name, x, y in zip(['origins', 'directions', 'viewdirs', 'radii', 'imageplane'],
+                          rays, expected):
+        assert x.shape == y.shape, name
+        np.testing.assert_allclose(x.numpy(), y, rtol=1e-10, atol=1e-12, err_msg=name)
+
+
+def test_pixels_to_rays_torch_rejects_distortion_and_ndc():
+    rng = np.random.default_rng(0)
+    pixtocams, camtoworlds = (torch.from_numpy(x) for x in _cameras(1, rng))
+    pix = torch.zeros((2,), dtype=torch.long)
+    with pytest.raises(ValueError, match='distortion'):
+        camera_utils.pixels_to_rays_torch(pix, pix, pixtocams[0], camtoworlds[0],
+                                          distortion_params={'k1': 0.1})
+    with pytest.raises(ValueError, match='NDC'):
+        camera_utils.pixels_to_rays_torch(pix, pix, pixtocams[0], camtoworlds[0],
+                                          pixtocam_ndc=pixtocams[0])
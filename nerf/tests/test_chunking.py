@@ -0,0 +1,27 @@
+import types
+
+import accelerate
+import numpy as np
+from internal import chunking
+
+
+def _config(budget, chunk_size=256):
+    return types.SimpleNamespace(render_memory_budget=budget, render_chunk_size=chunk_size,
+                                 render_chunk_cache=None)
+
+
+def test_chunk_tuner_sizes_cpu_chunks_from_current_rss():
+    # Raise the lifetime peak RSS well above what the chunks will use.
+    np.ones(1 << 27).sum()
+    item_bytes = 1 << 16
+    target = 1 << 26
+    budget = (chunking._cpu_rss() + target) / chunking._total_cpu_memory()
+    tuner = chunking.ChunkTuner('test', _config(budget), accelerate.Accelerator(cpu=True))
+
+    def fn(start, stop):
+        return np.ones((stop - start, item_bytes // 8)).sum()
+
+    outputs = tuner.map(fn, 1 << 14, verbose=False)
+    assert sum(outputs) == (1 << 14) * item_bytes // 8
+    assert tuner.tuned
+    assert target // item_bytes // 2 <= tuner.chunk_size <= 2 * target // item_bytes
@@ -0,0 +1,166 @@
+import types
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+try:
+    from internal import datasets
+except (ImportError, RuntimeError) as e:  # gridencoder is built on import.
+    pytest.skip(f'internal.datasets is not importable: {e}', allow_module_level=True)
+
+
+def _write_frames(tmp_path, num_frames, size=8):
+    paths = []
+    for i in range(num_frames):
+        path = str(tmp_path / f'{i:03d}.png')
+        Image.fromarray(np.full((size, size, 3), i, dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+def _check_resident(frames):
+    for frame in frames.resident_frames():
+        assert np.all(frames[frame, 1, 2] == frame)
+
+
+def test_frame_window_pages_images(tmp_path):
+    paths = _write_frames(tmp_path, 12)
+    frames = datasets.FrameWindow(paths, 8, 8, window=4, overlap=1, replay=2,
+                                  steps_per_window=10, num_workers=2)
+    assert frames.resident_frames().tolist() == [0, 1, 2, 3]
+    _check_resident(frames)
+    for step in range(0, 60, 5):
+        frames.advance(step)
+        resident = frames.resident_frames()
+        start = frames._window_start(step)
+        assert set(range(start, start + 4)) <= set(resident.tolist())
+        assert len(resident) <= 6
+        _check_resident(frames)
+    assert frames.resident_frames().max() == 11
+    # The replay buffer keeps some images that already left the window.
+    assert len(frames.resident_frames()) == 6
+
+
+def test_frame_window_rejects_evicted_frames(tmp_path):
+    paths = _write_frames(tmp_path, 8)
+    frames = datasets.FrameWindow(paths, 8, 8, window=2, overlap=0, replay=0,
+                                  steps_per_window=1, num_workers=2)
+    frames.advance(1)
+    assert frames.resident_frames().tolist() == [2, 3]
+    with pytest.raises(datasets.StaleFrameError):
+        frames[np.array([2, 0]), 0, 0]
+
+
+def test_frame_window_rejects_reads_during_advance(tmp_path):
+    paths = _write_frames(tmp_path, 4)
+    frames = datasets.FrameWindow(paths, 8, 8, window=2, overlap=0, replay=0,
+                                  steps_per_window=1, num_workers=2)
+    frames._version += 1
+    with pytest.raises(datasets.StaleFrameError):
+        frames[0, 0, 0]
+
+
+def test_frame_window_pages_layers_with_images(tmp_path):
+    paths = _write_frames(tmp_path, 12)
+    frames = datasets.FrameWindow(paths, 8, 8, window=4, overlap=1, replay=2,
+                                  steps_per_window=10, num_workers=2)
+    depths = frames.add_layer('depths', np.arange(12, dtype=np.float32)[:, None, None] * np.ones((1, 8, 8)))
+    assert depths.shape == (12, 8, 8)
+    for step in range(0, 60, 5):
+        frames.advance(step)
+        resident = frames.resident_frames()
+        # Layer rows follow the images, through replay slots too.
+        np.testing.assert_array_equal(depths[resident, 3, 4], resident)
+        assert np.all(depths[resident[0]] == resident[0])
+    evicted = np.setdiff1d(np.arange(12), frames.resident_frames())[0]
+    with pytest.raises(datasets.StaleFrameError):
+        depths[evicted, 0, 0]
+
+
+def test_page_frame_arrays_replaces_depths_and_sky(tmp_path):
+    dataset = object.__new__(datasets.Dataset)
+    dataset.config = types.SimpleNamespace(image_cache_dir=str(tmp_path / 'cache'))
+    dataset.images = datasets.FrameWindow(_write_frames(tmp_path, 6), 8, 8, window=2, overlap=0,
+                                          replay=0, steps_per_window=1, num_workers=2)
+    dataset.disp_images = np.arange(6, dtype=np.float32)[:, None, None] * np.ones((1, 8, 8))
+    dataset.sky_segments = np.arange(6)[:, None, None, None] % 2 == np.ones((1, 8, 8, 1))
+    dataset._page_frame_arrays()
+    assert isinstance(dataset.disp_images, datasets.FrameLayer)
+    assert isinstance(dataset.sky_segments, datasets.FrameLayer)
+    dataset.images.advance(2)
+    assert dataset.images.resident_frames().tolist() == [4, 5]
+    np.testing.assert_array_equal(dataset.disp_images[np.array([4, 5]), 0, 0], [4, 5])
+    np.testing.assert_array_equal(dataset.sky_segments[np.array([4, 5]), 0, 0, 0], [False, True])
+
+
+def _error_dataset(error_map, cell=4, floor=0.25, decay=0.5, update_every=1):
+    dataset = object.__new__(datasets.Dataset)
+    num_frames, cells_y, cells_x = error_map.shape
+    dataset.config = types.SimpleNamespace(error_map_cell=cell, error_sampling_floor=floor,
+                                           error_map_decay=decay,
+                                           error_map_update_every=update_every)
+    dataset._batching = datasets.utils.BatchingMethod.ALL_IMAGES
+    dataset.width, dataset.height = cells_x * cell, cells_y * cell
+    dataset.images = np.zeros((num_frames, dataset.height, dataset.width, 3))
+    dataset._error_map = torch.as_tensor(error_map, dtype=torch.float32)
+    dataset._error_sums = None
+    dataset._error_counts = None
+    dataset._error_steps = 0
+    return dataset
+
+
+def _sample(dataset, num, lower_border=2, upper_border=4):
+    shape = (num, 1, 1)
+    pix_x_int = np.full(shape, -1)
+    pix_y_int = np.full(shape, -1)
+    cam_idx = np.full(shape, -1)
+    dataset._sample_by_error(pix_x_int, pix_y_int, cam_idx, lower_border, upper_border)
+    return pix_x_int.ravel(), pix_y_int.ravel(), cam_idx.ravel()
+
+
+def test_sample_by_error_follows_error_map():
+    np.random.seed(0)
+    error_map = np.full((3, 4, 4), 1e-9)
+    error_map[1, 0, 3] = 1.
+    error_map[2, 3, 0] = 3.
+    x, y, cam = _sample(_error_dataset(error_map), 8000)
+    kept = cam == -1
+    # The floor share keeps its uniform sample (here the -1 placeholders).
+    assert abs(kept.mean() - 0.25) < 0.02
+    assert np.all(x[kept] == -1) and np.all(y[kept] == -1)
+    x, y, cam = x[~kept], y[~kept], cam[~kept]
+    assert set(cam.tolist()) == {1, 2}
+    assert abs(np.mean(cam == 2) - 0.75) < 0.02
+    # Pixels are drawn in their cell, then clipped to [lower_border, 16 - upper_border - 1].
+    assert np.all(x[cam == 1] == 11)
+    assert set(y[cam == 1].tolist()) == {2, 3}
+    assert set(x[cam == 2].tolist()) == {2, 3}
+    assert set(y[cam == 2].tolist()) == {11}
+
+
+def test_sample_by_error_without_floor():
+    np.random.seed(0)
+    x, y, cam = _sample(_error_dataset(np.ones((2, 4, 4)), floor=0.), 1000)
+    assert np.all(cam >= 0)
+    assert np.all((x >= 2) & (x <= 11) & (y >= 2) & (y <= 11))
+
+
+def test_update_error_map_blends_cell_means():
+    dataset = _error_dataset(np.ones((2, 2, 2)), update_every=2)
+    gt = torch.zeros(4, 3)
+    batch = {'rgb': gt, 'error_cell': torch.tensor([[0], [0], [5], [-1]])}
+    # Squared residuals averaged over the channels: 4, 2, 3 and 100 (untracked).
+    rgb = torch.sqrt(torch.tensor([4., 2., 3., 100.]))[:, None].expand(4, 3)
+    dataset.update_error_map(batch, rgb)
+    # Nothing is blended before error_map_update_every steps.
+    assert torch.all(dataset._error_map == 1)
+    batch['error_cell'] = torch.tensor([[5], [-1], [-1], [-1]])
+    dataset.update_error_map(batch, rgb)
+    expected = torch.ones(8)
+    expected[0] = 0.5 * 1 + 0.5 * (4 + 2) / 2
+    expected[5] = 0.5 * 1 + 0.5 * (3 + 4) / 2
+    torch.testing.assert_close(dataset._error_map.view(-1), expected)
+    # The accumulators start over after a blend.
+    assert dataset._error_counts.sum() == 0
@@ -0,0 +1,58 @@
+import json
+import os
+import random
+import socket
+import time
+
+import accelerate
+import torch
+from internal import frame_queue
+
+NUM_FRAMES = 23
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _evaluate(rank, world_size, port, tmp_dir):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank),
+                      LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size))
+    accelerator = accelerate.Accelerator(cpu=True)
+    queue = frame_queue.FrameQueue(os.path.join(tmp_dir, 'queue'), NUM_FRAMES, accelerator)
+    frames, metrics = [], []
+    for idx in queue:
+        # Uneven frame times, so the processes interleave.
+        time.sleep(random.random() * 0.01)
+        frames.append(idx)
+        metrics.append({'psnr': 20 + idx / 7, 'rank': rank})
+    rendered = accelerate.utils.gather_object([frames])
+    frames, metrics = frame_queue.gather_by_frame(frames, metrics)
+    if accelerator.is_main_process:
+        with open(os.path.join(tmp_dir, 'out.json'), 'w') as fp:
+            json.dump({'rendered': rendered, 'frames': frames, 'metrics': metrics}, fp)
+    accelerator.wait_for_everyone()
+    torch.distributed.destroy_process_group()
+
+
+def _run(world_size, tmp_dir):
+    os.makedirs(tmp_dir)
+    # Spawned, a forked process would inherit the accelerate state of this one.
+    torch.multiprocessing.start_processes(_evaluate, args=(world_size, _free_port(), tmp_dir),
+                                          nprocs=world_size, start_method='spawn')
+    with open(os.path.join(tmp_dir, 'out.json')) as fp:
+        return json.load(fp)
+
+
+def test_frame_queue_renders_every_frame_once(tmp_path):
+    single = _run(1, str(tmp_path / 'single'))
+    parallel = _run(2, str(tmp_path / 'parallel'))
+    rendered = [idx for frames in parallel['rendered'] for idx in frames]
+    assert sorted(rendered) == list(range(NUM_FRAMES))
+    assert all(len(frames) > 0 for frames in parallel['rendered'])
+    assert parallel['frames'] == single['frames'] == list(range(NUM_FRAMES))
+    strip = lambda metrics: [m['psnr'] for m in metrics]
+    assert strip(parallel['metrics']) == strip(single['metrics'])
+    assert {m['rank'] for m in parallel['metrics']} == {0, 1}
@@ -0,0 +1,30 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from internal import image
+
+
+def test_rgb_to_gray_matches_opencv():
+    rgb = np.random.RandomState(0).randint(0, 256, (64, 64, 3)).astype(np.uint8)
+    gray = image._rgb_to_gray(torch.from_numpy(rgb)[None], quantize=True)[0].numpy()
+    np.testing.assert_array_equal(gray, cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY))
+
+
+def test_metric_harness_matches_skimage(monkeypatch):
+    # LPIPS needs pretrained weights, only PSNR and SSIM are checked here.
+    monkeypatch.setitem(image._lpips_models, 'cpu', lambda x, y: torch.zeros(len(x)))
+    rng = np.random.RandomState(0)
+    gts = rng.randint(0, 256, (3, 32, 40, 3)) / 255.
+    preds = np.clip(gts + rng.normal(0, 0.1, gts.shape), -0.1, 1.1)
+    metrics = image.MetricHarness().evaluate(list(preds), list(gts))
+    for pred, gt, metric in zip(preds, gts, metrics):
+        pred = (np.clip(pred, 0., 1) * 255).astype(np.uint8)
+        gt = (gt * 255).astype(np.uint8)
+        psnr = peak_signal_noise_ratio(pred, gt, data_range=255)
+        ssim = structural_similarity(cv2.cvtColor(pred, cv2.COLOR_RGB2GRAY),
+                                     cv2.cvtColor(gt, cv2.COLOR_RGB2GRAY), data_range=255)
+        assert metric['psnr'] == pytest.approx(psnr, abs=1e-6)
+        assert metric['ssim'] == pytest.approx(ssim, abs=1e-6)
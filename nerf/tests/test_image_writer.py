@@ -0,0 +1,41 @@
+import types
+
+import matplotlib as mpl
+import numpy as np
+from matplotlib import cm
+from PIL import Image
+from internal import image_writer
+from internal import utils
+
+
+def _reference_png(depthmap):
+    """The ScalarMappable colors save_img_f32 used to write with plt.imsave."""
+    constant_max = np.percentile(depthmap, 99)
+    normalizer = mpl.colors.Normalize(vmin=np.percentile(depthmap, 0) - 0.1,
+                                      vmax=np.percentile(depthmap[depthmap != constant_max], 99))
+    mapper = cm.ScalarMappable(norm=normalizer, cmap='magma_r')
+    return (mapper.to_rgba(depthmap)[:, :, :3] * 255).astype(np.uint8)
+
+
+def test_save_img_f32_on_writer_threads(tmp_path):
+    rng = np.random.default_rng(0)
+    depthmaps = [rng.uniform(1, 50, (24, 32)).astype(np.float32) for _ in range(16)]
+    config = types.SimpleNamespace(render_save_async=True)
+    with image_writer.ImageWriter(config, num_workers=4, max_pending=4) as writer:
+        for i, depthmap in enumerate(depthmaps):
+            writer.save_img_f32(depthmap, str(tmp_path / f'depth_{i:03d}.tiff'))
+    for i, depthmap in enumerate(depthmaps):
+        tiff = np.array(Image.open(tmp_path / f'depth_{i:03d}.tiff'))
+        np.testing.assert_array_equal(tiff, depthmap)
+        png = np.array(Image.open(tmp_path / f'depth_{i:03d}.png'))
+        np.testing.assert_array_equal(png, _reference_png(depthmap))
+
+
+def test_image_writer_saves_synchronously_when_disabled(tmp_path):
+    config = types.SimpleNamespace(render_save_async=False)
+    img = np.linspace(0, 1, 4 * 5 * 3).reshape(4, 5, 3)
+    with image_writer.ImageWriter(config) as writer:
+        writer.save_img_u8(img, str(tmp_path / 'color.png'))
+        assert utils.file_exists(str(tmp_path / 'color.png'))
+    np.testing.assert_array_equal(np.array(Image.open(tmp_path / 'color.png')),
+                                  (img * 255).astype(np.uint8))
@@ -0,0 +1,127 @@
+import os
+import time
+
+import pytest
+import torch
+
+from internal import loaders
+
+
+def make_batches(n):
+    return [{'rgb': torch.full((4, 3), float(i)), 'cam_idx': torch.tensor([i]), 'lossmult': None}
+            for i in range(n)]
+
+
+def test_device_prefetcher_cpu():
+    batches = make_batches(3)
+    prefetcher = loaders.DevicePrefetcher(batches, 'cpu', depth=2)
+    try:
+        # More batches than the iterable holds: it is re-iterated.
+        out = [next(prefetcher) for _ in range(7)]
+    finally:
+        prefetcher.close()
+    for i, batch in enumerate(out):
+        src = batches[i % 3]
+        assert torch.equal(batch['rgb'], src['rgb'])
+        assert batch['lossmult'] is None
+        # Batches are copies, the source may be recycled (eg. a BatchRing slot).
+        assert batch['rgb'].data_ptr() != src['rgb'].data_ptr()
+    stats = prefetcher.stats()
+    assert stats['prefetch_batches'] == 7
+    assert 0 <= stats['prefetch_waits'] <= 7
+    assert stats['prefetch_wait_time'] >= 0
+
+
+def test_device_prefetcher_counts_waits():
+    class Slow:
+        def __iter__(self):
+            for batch in make_batches(2):
+                time.sleep(0.05)
+                yield batch
+
+    prefetcher = loaders.DevicePrefetcher(Slow(), 'cpu', depth=1)
+    try:
+        for _ in range(4):
+            next(prefetcher)
+    finally:
+        prefetcher.close()
+    stats = prefetcher.stats()
+    assert stats['prefetch_batches'] == 4
+    assert stats['prefetch_waits'] >= 1
+    assert stats['prefetch_wait_time'] > 0
+
+
+def test_device_prefetcher_raises_producer_errors():
+    class Broken:
+        def __iter__(self):
+            raise RuntimeError('broken loader')
+            yield
+
+    prefetcher = loaders.DevicePrefetcher(Broken(), 'cpu')
+    try:
+        with pytest.raises(RuntimeError, match='broken loader'):
+            next(prefetcher)
+    finally:
+        prefetcher.close()
+
+
+class CountingDataset:
+    """Batches numbered per producer, raising after `fail_after` in producers."""
+
+    def __init__(self, fail_after=None, exit_after=None):
+        self.parent = os.getpid()
+        self.fail_after = fail_after
+        self.exit_after = exit_after
+        self.count = 0
+
+    def __getitem__(self, item):
+        in_producer = os.getpid() != self.parent
+        if in_producer and self.fail_after is not None and self.count >= self.fail_after:
+            raise ValueError('broken dataset')
+        if in_producer and self.exit_after is not None and self.count >= self.exit_after:
+            os._exit(3)
+        self.count += 1
+        return {'rgb': torch.full((4, 3), float(self.count)), 'lossmult': None}
+
+
+def test_batch_ring_recycles_slots():
+    ring = loaders.BatchRing(CountingDataset(), num_workers=1, num_slots=2)
+    try:
+        slot_ptrs = {slot['rgb'].data_ptr() for slot in ring._slots}
+        values = []
+        for _ in range(10):
+            batch = next(ring)
+            assert batch['rgb'].data_ptr() in slot_ptrs
+            assert batch['lossmult'] is None
+            assert torch.all(batch['rgb'] == batch['rgb'][0, 0])
+            values.append(batch['rgb'][0, 0].item())
+        # A single producer fills the slots in order, none is skipped or reused
+        # early. It is forked after the template batch was drawn.
+        assert values == list(range(2, 12))
+        stats = ring.stats()
+    finally:
+        ring.close()
+    assert stats['batches'] == 10
+    assert stats['queue_depth'] in (-1, 0, 1, 2)
+    assert stats['consumer_wait'] >= 0
+    assert stats['producer_wait'] >= 0
+
+
+def test_batch_ring_raises_producer_errors():
+    ring = loaders.BatchRing(CountingDataset(fail_after=3), num_workers=2, num_slots=4)
+    try:
+        with pytest.raises(RuntimeError, match='broken dataset'):
+            for _ in range(20):
+                next(ring)
+    finally:
+        ring.close()
+
+
+def test_batch_ring_raises_when_producers_die():
+    ring = loaders.BatchRing(CountingDataset(exit_after=2), num_workers=1, num_slots=4)
+    try:
+        with pytest.raises(RuntimeError, match='exit code 3'):
+            for _ in range(20):
+                next(ring)
+    finally:
+        ring.close()
@@ -0,0 +1,124 @@
+import types
+
+import pytest
+import torch
+
+from internal import configs
+
+try:
+    from internal import models
+except (ImportError, RuntimeError) as e:  # gridencoder is built on import.
+    pytest.skip(f'internal.models is not importable: {e}', allow_module_level=True)
+
+
+class _CountingMLP:
+    """Density and color as smooth functions of the sample means."""
+
+    def __init__(self):
+        self.num_samples = 0
+
+    def __call__(self, rand, means, stds, viewdirs=None, imageplane=None, glo_vec=None,
+                 exposure=None, compute_normals=None):
+        self.num_samples += means.shape[0] * means.shape[1]
+        density = means.norm(dim=-1).mean(dim=-1)
+        rgb = torch.sigmoid(means.mean(dim=-2))
+        return {'density': density, 'rgb': rgb, 'normals': None}
+
+
+def _march(occupied=None, early_stop_transmittance=0.):
+    torch.manual_seed(0)
+    num_rays, num_samples = 5, 12
+    tdist = torch.sort(torch.rand(num_rays, num_samples + 1), dim=-1)[0]
+    means = torch.randn(num_rays, num_samples, 4, 3)
+    stds = torch.rand(num_rays, num_samples, 4)
+    batch = {'directions': torch.randn(num_rays, 3), 'viewdirs': torch.randn(num_rays, 3)}
+    model = types.SimpleNamespace(early_stop_transmittance=early_stop_transmittance,
+                                  early_stop_group_size=4, use_viewdirs=True)
+    mlp = _CountingMLP()
+    results = models.Model.march_mlp(model, mlp, None, means, stds, tdist, batch, occupied=occupied)
+    return results, mlp.num_samples, mlp(None, means, stds)
+
+
+def test_march_mlp_evaluates_every_sample():
+    results, num_evaluated, full = _march()
+    assert num_evaluated == 5 * 12
+    torch.testing.assert_close(results['density'], full['density'])
+    torch.testing.assert_close(results['rgb'], full['rgb'])
+    assert results['normals'] is None
+
+
+def test_march_mlp_skips_empty_samples():
+    occupied = torch.rand(5, 12, generator=torch.Generator().manual_seed(1)) > 0.5
+    results, num_evaluated, full = _march(occupied)
+    assert num_evaluated == occupied.sum()
+    torch.testing.assert_close(results['density'], torch.where(occupied, full['density'], 0.))
+    torch.testing.assert_close(results['rgb'], full['rgb'] * occupied[..., None])
+
+
+def test_march_mlp_all_empty():
+    results, _, _ = _march(torch.zeros(5, 12, dtype=torch.bool))
+    assert torch.all(results['density'] == 0)
+    assert results['rgb'].shape == (5, 12, 3)
+
+
+def test_occupancy_grid_counts_steps_on_host():
+    grid = models.OccupancyGrid(4, threshold=0.5)
+    points = torch.tensor([[-0.9, -0.9, -0.9], [0.9, 0.9, 0.9]])
+    grid.observe(points, torch.tensor([1., 0.1]))
+    for _ in range(3):
+        grid.step(update_every=2)
+    assert grid.num_steps == 3
+    assert grid.query(points).tolist() == [True, False]
+    assert grid.occupancy() == 1 - 1 / 64
+
+    restored = models.OccupancyGrid(4, threshold=0.5)
+    restored.load_state_dict(grid.state_dict())
+    assert restored.num_steps == 3
+    assert torch.equal(restored.bitfield, grid.bitfield)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='gridencoder needs a GPU')
+def test_early_termination_bounds_rendering_error():
+    device = torch.device('cuda')
+    torch.manual_seed(0)
+    model = models.Model(config=configs.Config(), num_levels=1, num_nerf_samples=64,
+                         early_stop_group_size=8).to(device).eval()
+    # A dense field, so that most rays become opaque well before the far plane.
+    model.nerf_mlp.density_bias = 5.
+    num_evaluated = []
+    model.nerf_mlp.register_forward_hook(
+        lambda module, args, output: num_evaluated.append(args[1].shape[:2].numel()))
+
+    num_rays, near, far = 256, 0.1, 2.
+    directions = torch.nn.functional.normalize(torch.randn(num_rays, 3, device=device), dim=-1)
+    batch = {
+        'origins': torch.zeros(num_rays, 3, device=device),
+        'directions': directions,
+        'viewdirs': directions,
+        'cam_dirs': directions,
+        'radii': torch.full((num_rays, 1), 1e-3, device=device),
+        'near': torch.full((num_rays, 1), near, device=device),
+        'far': torch.full((num_rays, 1), far, device=device),
+    }
+
+    def render(threshold):
+        model.early_stop_transmittance = threshold
+        num_evaluated.clear()
+        # cast_rays draws random basis vectors even for deterministic rays.
+        torch.manual_seed(1)
+        with torch.no_grad():
+            rendering = model(None, batch, train_frac=1., compute_extras=False)[0][-1]
+        return rendering, sum(num_evaluated)
+
+    threshold = 1e-2
+    full, num_full = render(0.)
+    early, num_early = render(threshold)
+    assert num_full == num_rays * 64
+    assert num_early < num_full
+    # The culled samples carry less than `threshold` of each ray's weight, so
+    # colors (in [0, 1] up to the padding) move by at most that much, and
+    # expected depths by that share of the ray length.
+    rgb_bound = threshold * (1 + 2 * model.nerf_mlp.rgb_padding)
+    depth_bound = threshold * (far - near) / (1 - threshold)
+    assert (early['rgb'] - full['rgb']).abs().max() <= rgb_bound + 1e-4
+    assert (early['depth'] - full['depth']).abs().max() <= depth_bound + 1e-4
@@ -0,0 +1,88 @@
+import types
+
+import numpy as np
+import pytest
+
+try:
+    import render
+except (ImportError, RuntimeError) as e:  # gridencoder is built on import.
+    pytest.skip(f'render is not importable: {e}', allow_module_level=True)
+
+
+class RecordingWriter:
+    """Stands in for an imageio video writer, keeps the frames per file."""
+
+    videos = {}
+
+    def __init__(self, path, fps):
+        self.frames = RecordingWriter.videos.setdefault(path, [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def append_data(self, img):
+        self.frames.append(img)
+
+
+@pytest.fixture
+def videos(monkeypatch):
+    RecordingWriter.videos = {}
+    monkeypatch.setattr(render.imageio, 'get_writer', RecordingWriter)
+    return RecordingWriter.videos
+
+
+def _sink(tmp_path):
+    config = types.SimpleNamespace(render_video_fps=10, render_dist_percentile=0.5)
+    return render.VideoSink(config, str(tmp_path), 'scene', max_pending=2)
+
+
+def _frame(i, keys=('color', 'distance_mean')):
+    frame = {'color': np.full((6, 8, 3), i / 10.),
+             'distance_mean': np.linspace(1, 2 + i, 48).reshape(6, 8)}
+    return {k: frame[k] for k in keys}
+
+
+def test_video_sink_streams_every_frame(tmp_path, videos):
+    sink = _sink(tmp_path)
+    for i in range(7):
+        sink.add(_frame(i))
+    sink.close()
+    assert sorted(videos) == [str(tmp_path / 'scene_color.mp4'),
+                              str(tmp_path / 'scene_distance_mean.mp4')]
+    for frames in videos.values():
+        assert len(frames) == 7
+        assert all(f.shape == (6, 8, 3) and f.dtype == np.uint8 for f in frames)
+    # Distances are colorized with the range of the first frame.
+    assert sink.limits == pytest.approx(tuple(np.percentile(_frame(0)['distance_mean'], [0.5, 99.5])))
+
+
+def test_video_sink_without_distances(tmp_path, videos):
+    # Frames read back by load_frame() may lack distance_mean.
+    sink = _sink(tmp_path)
+    for i in range(3):
+        sink.add(_frame(i, keys=('color',)))
+    sink.close()
+    assert sink.limits == (None, None)
+    assert len(videos[str(tmp_path / 'scene_color.mp4')]) == 3
+
+
+def test_video_sink_raises_encoding_errors_on_close(tmp_path, videos, monkeypatch):
+    video_frame = render.video_frame
+
+    def failing_video_frame(k, img, lo, hi):
+        if k == 'color' and img[0, 0, 0] >= 0.3:
+            raise ValueError('broken frame')
+        return video_frame(k, img, lo, hi)
+
+    monkeypatch.setattr(render, 'video_frame', failing_video_frame)
+    sink = _sink(tmp_path)
+    # More frames than max_pending, add() must not block on the failed stream.
+    for i in range(8):
+        sink.add(_frame(i))
+    with pytest.raises(ValueError, match='broken frame'):
+        sink.close()
+    assert len(videos[str(tmp_path / 'scene_color.mp4')]) == 3
+    assert len(videos[str(tmp_path / 'scene_distance_mean.mp4')]) == 8
@@ -0,0 +1,52 @@
+import pytest
+import torch
+from internal import stepfun
+
+
+def searchsorted_broadcast(a, v):
+    """The [..., N, M] comparison implementation stepfun.searchsorted replaced."""
+    i = torch.arange(a.shape[-1], device=a.device)
+    v_ge_a = v[..., None, :] >= a[..., :, None]
+    idx_lo = torch.max(torch.where(v_ge_a, i[..., :, None], i[..., :1, None]), -2).values
+    idx_hi = torch.min(torch.where(~v_ge_a, i[..., :, None], i[..., -1:, None]), -2).values
+    return idx_lo, idx_hi
+
+
+def random_sorted(shape, generator):
+    # Rounding to a coarse grid makes ties within a and between a and v likely.
+    return torch.sort(torch.round(torch.rand(shape, generator=generator) * 20) / 20, dim=-1)[0]
+
+
+def random_queries(a, shape, generator):
+    # Some queries below a[0] and above a[-1], some exactly on entries of a.
+    v = torch.rand(shape, generator=generator) * 1.4 - 0.2
+    on_a = torch.take_along_dim(
+        a.expand(shape[:-1] + a.shape[-1:]),
+        torch.randint(0, a.shape[-1], shape, generator=generator), dim=-1)
+    return torch.where(torch.rand(shape, generator=generator) < 0.3, on_a, v)
+
+
+@pytest.mark.parametrize('a_shape,v_shape', [
+    ((17,), (40,)),
+    ((3, 17), (3, 40)),
+    ((1, 17), (4, 40)),
+    ((2, 3, 1), (2, 3, 5)),
+    ((2, 1, 9), (2, 6, 33)),
+])
+def test_searchsorted_matches_broadcast(a_shape, v_shape):
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(20):
+        a = random_sorted(a_shape, generator)
+        v = random_queries(a, v_shape, generator)
+        idx_lo, idx_hi = stepfun.searchsorted(a, v)
+        ref_lo, ref_hi = searchsorted_broadcast(a, v)
+        assert torch.equal(idx_lo, ref_lo)
+        assert torch.equal(idx_hi, ref_hi)
+
+
+def test_searchsorted_out_of_range():
+    a = torch.tensor([0., 1., 1., 2.])
+    v = torch.tensor([-1., 0., 1., 1.5, 2., 3.])
+    idx_lo, idx_hi = stepfun.searchsorted(a, v)
+    assert idx_lo.tolist() == [0, 0, 2, 2, 3, 3]
+    assert idx_hi.tolist() == [0, 1, 3, 3, 3, 3]
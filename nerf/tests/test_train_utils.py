@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+try:
+    from internal import train_utils
+except (ImportError, RuntimeError) as e:  # gridencoder is built on import.
+    pytest.skip(f'internal.train_utils is not importable: {e}', allow_module_level=True)
+
+
+def _warp_table(max_size):
+    height, width = 6, 8
+    depth = np.ones((height, width))
+    # The source camera is shifted by one pixel along x.
+    src_pose = np.eye(4)
+    src_pose[0, 3] = -1 / 10
+    intrinsic = np.array([[10., 0., 0.], [0., 10., 0.], [0., 0., 1.]])
+    return train_utils.img_warping_table(np.eye(4), src_pose, depth, intrinsic, max_size)
+
+
+def test_img_warping_table_keeps_every_valid_pixel():
+    table, count = _warp_table(0)
+    # The last column warps out of the source image.
+    assert count == 6 * 7
+    assert len(table) == count
+    _, ref_x = np.divmod(table[:, 0], 8)
+    assert np.all(ref_x < 7)
+    assert np.array_equal(table[:, 1], table[:, 0] + 1)
+
+
+def test_img_warping_table_subsamples():
+    table, count = _warp_table(10)
+    assert count == 6 * 7
+    assert len(table) == 10
+    assert np.all(np.diff(table[:, 0]) > 0)
+    full, _ = _warp_table(0)
+    assert np.isin(table[:, 0], full[:, 0]).all()
@@ -0,0 +1,47 @@
+"""Times stepfun.searchsorted against the broadcast implementation it replaced.
+
+Usage, from nerf/: python tests/time_searchsorted.py [--device cuda]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from internal import stepfun  # pylint: disable=wrong-import-position
+from test_stepfun import searchsorted_broadcast  # pylint: disable=wrong-import-position
+
+
+def time_fn(fn, device, repeats):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--rays', type=int, default=4096)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    print(f'{"N":>5} {"M":>5} {"searchsorted":>14} {"broadcast":>14}')
+    for n, m in [(33, 33), (65, 65), (129, 129), (257, 65), (65, 257)]:
+        a = torch.sort(torch.rand(args.rays, n, device=device), dim=-1)[0]
+        v = torch.rand(args.rays, m, device=device)
+        new = time_fn(lambda: stepfun.searchsorted(a, v), device, args.repeats)
+        old = time_fn(lambda: searchsorted_broadcast(a, v), device, args.repeats)
+        print(f'{n:>5} {m:>5} {new * 1e3:>11.3f} ms {old * 1e3:>11.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,7 @@ import gin
 from internal import configs
 from internal import datasets
 from internal import image
+from internal import loaders
 from internal import models
 from internal import train_utils
 from internal import utils
@@ -40,7 +41,10 @@ def main(unused_argv):
         f.write(gin.config_str())
 
     # accelerator for DDP
-    accelerator = accelerate.Accelerator()
+    # Every process keeps its own occupancy grid observations until they are
+    # reduced, they must not be overwritten by the buffers of the first one.
+    ddp_kwargs = accelerate.DistributedDataParallelKwargs(broadcast_buffers=False)
+    accelerator = accelerate.Accelerator(kwargs_handlers=[ddp_kwargs])
 
     # setup logger
     logging.basicConfig(
@@ -69,15 +73,19 @@ def main(unused_argv):
     optimizer, lr_fn = train_utils.create_optimizer(config, model)
 
     # load dataset
-    dataset = datasets.load_dataset('train', config.data_dir, config)
-    test_dataset = datasets.load_dataset('test', config.data_dir, config)
-    dataloader = torch.utils.data.DataLoader(np.arange(len(dataset)),
-                                             num_workers=8,
-                                             shuffle=True,
-                                             batch_size=1,
-                                             collate_fn=dataset.collate_fn,
-                                             persistent_workers=True,
-                                             )
+    # The main process builds the on-disk caches (image store, virtual pose
+    # tables) once, the others load them.
+    with accelerator.main_process_first():
+        dataset = datasets.load_dataset('train', config.data_dir, config)
+        test_dataset = datasets.load_dataset('test', config.data_dir, config)
+    if not config.batch_ring:
+        dataloader = torch.utils.data.DataLoader(np.arange(len(dataset)),
+                                                 num_workers=8,
+                                                 shuffle=True,
+                                                 batch_size=1,
+                                                 collate_fn=dataset.collate_fn,
+                                                 persistent_workers=True,
+                                                 )
     test_dataloader = torch.utils.data.DataLoader(np.arange(len(test_dataset)),
                                                   num_workers=4,
                                                   shuffle=False,
@@ -91,7 +99,13 @@ def main(unused_argv):
         postprocess_fn = lambda z, _=None: z
 
     # use accelerate to prepare.
-    model, dataloader, optimizer = accelerator.prepare(model, dataloader, optimizer)
+    if config.batch_ring:
+        model, optimizer = accelerator.prepare(model, optimizer)
+    else:
+        model, optimizer = accelerator.prepare(model, optimizer)
+        # The prefetcher does the device transfer itself, it needs the batches on the CPU.
+        dataloader = accelerator.prepare_data_loader(dataloader,
+                                                     device_placement=config.prefetch_batches == 0)
 
     if config.resume_from_checkpoint:
         init_step = checkpoints.restore_checkpoint(config.checkpoint_dir, accelerator, logger)
@@ -99,7 +113,18 @@ def main(unused_argv):
         init_step = 0
 
     module = accelerator.unwrap_model(model)
-    dataiter = iter(dataloader)
+    if config.batch_ring:
+        # Endless producer ring, next() never raises StopIteration.
+        ring = loaders.BatchRing(dataset, num_workers=config.batch_ring_workers, num_slots=config.batch_ring_slots,
+                                 seed=config.seed + 1000 * config.global_rank)
+        dataiter = ring
+    else:
+        dataiter = iter(dataloader)
+    if config.prefetch_batches > 0:
+        # Re-iterates the dataloader by itself, so it never runs out either.
+        prefetcher = loaders.DevicePrefetcher(dataiter if config.batch_ring else dataloader,
+                                              accelerator.device, config.prefetch_batches)
+        dataiter = prefetcher
     test_dataiter = iter(test_dataloader)
 
     num_params = train_utils.tree_len(list(model.parameters()))
@@ -111,7 +136,7 @@ def main(unused_argv):
                          f'{dataset.size}')
 
     # metric handler
-    metric_harness = image.MetricHarness()
+    metric_harness = image.MetricHarness(accelerator.device)
 
     # tensorboard
     if accelerator.is_main_process:
@@ -144,12 +169,18 @@ def main(unused_argv):
             except StopIteration:
                 dataiter = iter(dataloader)
                 batch = next(dataiter)
-            batch = accelerate.utils.send_to_device(batch, accelerator.device)
+            if config.prefetch_batches == 0:
+                batch = accelerate.utils.send_to_device(batch, accelerator.device)
+            if config.device_rays:
+                batch = dataset.cast_device_rays(batch)
             if reset_stats and accelerator.is_main_process:
                 stats_buffer = []
                 train_start_time = time.time()
                 reset_stats = False
 
+            if config.stream_window > 0:
+                dataset.advance_stream(step)
+
             # use lr_fn to control learning rate
             learning_rate = lr_fn(step)
             for param_group in optimizer.param_groups:
@@ -173,6 +204,8 @@ def main(unused_argv):
 
             # supervised by data
             data_loss, stats = train_utils.compute_data_loss(batch, renderings, config)
+            if config.error_sampling:
+                dataset.update_error_map(batch, renderings[-1]['rgb'])
             losses['data'] = data_loss
 
             #sky segment
@@ -275,6 +308,15 @@ def main(unused_argv):
                     summ_fn('train_learning_rate', learning_rate)
                     summ_fn('train_steps_per_sec', steps_per_sec)
                     summ_fn('train_rays_per_sec', rays_per_sec)
+                    input_stats = {}
+                    if config.batch_ring:
+                        input_stats.update(ring.stats())
+                    if config.prefetch_batches > 0:
+                        input_stats.update(prefetcher.stats())
+                    for k, v in input_stats.items():
+                        summ_fn(f'train_input_{k}', v)
+                    if module.occ_grid_resolution > 0:
+                        summ_fn('train_occupancy', module.occ_grid.occupancy())
 
                     summary_writer.add_scalar('train_avg_psnr_timed', avg_stats['psnr'],
                                               total_time // TIME_PRECISION)
@@ -386,6 +428,10 @@ def main(unused_argv):
         checkpoints.save_checkpoint(config.checkpoint_dir,
                                     accelerator, step,
                                     config.checkpoints_total_limit)
+    if config.prefetch_batches > 0:
+        prefetcher.close()
+    if config.batch_ring:
+        ring.close()
     logger.info('Finish training.')
 
 
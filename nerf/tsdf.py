@@ -10,6 +10,8 @@ from absl import app
 import gin
 from internal import configs
 from internal import datasets
+from internal import frame_queue
+from internal import image_writer
 from internal import models
 from internal import utils
 from internal import coord
@@ -281,30 +283,45 @@ def main(unused_argv):
     zpad = max(3, len(str(dataset.size - 1)))
     idx_to_str = lambda idx: str(idx).zfill(zpad)
 
-    for idx in range(dataset.size):
+    writer = image_writer.ImageWriter(config)
+    if config.render_frame_parallel:
+        # Every process renders and writes whole frames taken from a shared queue.
+        frames = frame_queue.FrameQueue(path_fn('.frame_queue'), dataset.size, accelerator)
+    else:
+        frames = range(dataset.size)
+    for idx in frames:
         # If current image and next image both already exist, skip ahead.
         idx_str = idx_to_str(idx)
         curr_file = path_fn(f'color_{idx_str}.png')
         if utils.file_exists(curr_file):
-            logger.info(f'Image {idx + 1}/{dataset.size} already exists, skipping')
+            logger.info(f'Image {idx + 1}/{dataset.size} already exists, skipping', main_process_only=False)
             continue
-        batch = next(dataiter)
+        if config.render_frame_parallel:
+            batch, _ = dataset[idx]
+        else:
+            batch = next(dataiter)
         batch = tree_map(lambda x: x.to(accelerator.device) if x is not None else None, batch)
-        logger.info(f'Evaluating image {idx + 1}/{dataset.size}')
+        logger.info(f'Evaluating image {idx + 1}/{dataset.size}', main_process_only=False)
         eval_start_time = time.time()
         rendering = models.render_image(model, accelerator,
-                                        batch, False, 1, config)
+                                        batch, False, 1, config,
+                                        local=config.render_frame_parallel)
 
-        logger.info(f'Rendered in {(time.time() - eval_start_time):0.3f}s')
+        logger.info(f'Rendered in {(time.time() - eval_start_time):0.3f}s', main_process_only=False)
 
-        if accelerator.is_main_process:  # Only record via host 0.
+        # Only record via host 0, unless every host renders its own frames.
+        if accelerator.is_main_process or config.render_frame_parallel:
             rendering['rgb'] = postprocess_fn(rendering['rgb'])
             rendering = tree_map(lambda x: x.detach().cpu().numpy() if x is not None else None, rendering)
-            utils.save_img_u8(rendering['rgb'], path_fn(f'color_{idx_str}.png'))
-            utils.save_img_f32(rendering['distance_mean'],
-                               path_fn(f'distance_mean_{idx_str}.tiff'))
-            utils.save_img_f32(rendering['distance_median'],
-                               path_fn(f'distance_median_{idx_str}.tiff'))
+            writer.save_img_u8(rendering['rgb'], path_fn(f'color_{idx_str}.png'))
+            writer.save_img_f32(rendering['distance_mean'],
+                                path_fn(f'distance_mean_{idx_str}.tiff'))
+            writer.save_img_f32(rendering['distance_median'],
+                                path_fn(f'distance_median_{idx_str}.tiff'))
+
+    # Every frame has to be on disk before integrating them.
+    writer.close()
+    accelerator.wait_for_everyone()
 
     # if accelerator.is_main_process:
     tsdf = TSDF(config, accelerator)